@@ -4,11 +4,30 @@ from .web.server import CameraServer
 from .utils.display import Display
 from .utils.frame_rate_monitor import FrameRateMonitor, StatsMonitor
 from .camera.utils.capture import CaptureController
-from .camera.captures.v4l2 import V4L2CapturedImage, V4L2CameraController
-from .camera.captures.picamera2 import Picamera2CapturedImage, Picamera2Controller
+from .camera.captures.v4l2 import V4L2CapturedImage, V4L2MappedImage, V4L2BufferLease, V4L2CameraController
+from .camera.captures.picamera2 import Picamera2CapturedImage, Picamera2ArrayImage, Picamera2Controller
 from .camera.controllers.system import SystemController
 from .camera.captures.abstract import AbstractCameraController
+from .camera.captures.image import CapturedImage
+from .camera.captures.synthetic import SyntheticCapturedImage, SyntheticCameraController
+from .camera.captures.replay import ReplayCameraController
 from .gpio.wavegen import WaveGen
+from .gpio.timing import TimingRecorder, EdgeRing
+from .gpio.capture import GPIOCapture, raw_to_vcd
+from .gpio.vcd import VCDWriter
+from .gpio.emulator import PiGPIOEmulator, PiGPIOEmulatorServer, VirtualClock
+from .camera.utils.ring import FrameRing, FrameRingReader
+from .camera.utils.recorder import FrameRecorder, RecordingReader
+from .camera.utils.archive import ArchiveWriter, ArchiveReader
+from .camera.utils.burst import Burst, read_burst
+from .camera.utils.accumulator import FrameAccumulator
+from .camera.utils.pixelstats import PixelStatistics
+from .camera.utils.binning import bin_image
+from .camera.utils.pipeline import FramePipeline, ProcessedImage
+from .camera.utils.calibration import CalibrationStore, CalibrationStage
+from .camera.utils.events import EventRecorder
+from .camera.utils.history import MetadataHistory
+from .camera.utils.multiplex import SubframeDemultiplexer, pack_field_patterns
 
 
 from .camera.models.OV2311 import OV2311Defaults
@@ -21,17 +40,51 @@ __all__ = [
 	'PiGPIOScript',
 	'PiGPIOWave',
 	'WaveGen',
+	'TimingRecorder',
+	'EdgeRing',
+	'GPIOCapture',
+	'raw_to_vcd',
+	'VCDWriter',
+	'PiGPIOEmulator',
+	'PiGPIOEmulatorServer',
+	'VirtualClock',
+	'FrameRing',
+	'FrameRingReader',
+	'FrameRecorder',
+	'RecordingReader',
+	'ArchiveWriter',
+	'ArchiveReader',
+	'Burst',
+	'FrameAccumulator',
+	'PixelStatistics',
+	'bin_image',
+	'FramePipeline',
+	'ProcessedImage',
+	'CalibrationStore',
+	'CalibrationStage',
+	'read_burst',
+	'EventRecorder',
+	'MetadataHistory',
+	'SubframeDemultiplexer',
+	'pack_field_patterns',
 	'CameraServer',
 	'Display',
 	'FrameRateMonitor',
 	'StatsMonitor',
 	'CaptureController',
 	'V4L2CapturedImage',
+	'V4L2MappedImage',
+	'V4L2BufferLease',
  	'V4L2CameraController',
 	'Picamera2CapturedImage',
+	'Picamera2ArrayImage',
  	'Picamera2Controller',
 	'SystemController',
     'AbstractCameraController',
+	'CapturedImage',
+	'SyntheticCapturedImage',
+	'SyntheticCameraController',
+	'ReplayCameraController',
 	'IMX296Defaults',
 	'OV2311Defaults'
 ]
@@ -26,6 +26,28 @@ class AbstractCameraController(ABC):
     def get_controls(self):
         pass
 
+    def set_roi(self, roi=None):
+        """
+        Read out only roi = (x, y, width, height) of the sensor, or all of it
+        with None, and return the new geometry as from get_geometry(). Only
+        backends whose geometry has 'roi_supported' set implement it.
+        """
+        raise ValueError(f"{type(self).__name__} doesn't support a sensor ROI")
+
+    def get_geometry(self):
+        """
+        The frame size and sensor crop, with 'roi_supported' telling whether
+        set_roi() can change the crop.
+        """
+        width, height = getattr(self, 'width', 0), getattr(self, 'height', 0)
+        return {
+            'roi': None,
+            'roi_supported': False,
+            'sensor_size': [width, height],
+            'width': width,
+            'height': height,
+        }
+
 # here are common control names comprising a superset of the capabilities
 # exposed by v4l2py and picamera2
 common_control_names = {
@@ -0,0 +1,198 @@
+import cv2
+import numpy as np
+
+# Pixel format names used by the backends, mapped to how they are decoded
+_decoders = {
+    'jpeg': 'jpeg',
+    'MJPEG': 'jpeg',
+    'JPEG': 'jpeg',
+    'yuyv': 'yuyv',
+    'YUYV': 'yuyv',
+    'yuv420': 'yuv420',
+    'YUV420': 'yuv420',
+    'raw': 'mono',
+    'GREY': 'mono',
+}
+
+_jpeg_gray_flags = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+_jpeg_color_flags = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+class CapturedImage:
+    """
+    A captured frame plus its metadata and geometry.
+
+    Pixels are decoded lazily, once per representation: to_grayscale() and
+    to_rgb() cache their result, so pipeline stages that all need pixels
+    share one decode. `reduce` (1, 2, 4 or 8) asks for a smaller image,
+    which for JPEG is decoded at reduced resolution and is much cheaper.
+    For uncompressed formats luma is a zero-copy view of the frame data.
+    release() drops the cached decodes; the FrameRing calls it when a frame
+    is evicted.
+    """
+
+    __slots__ = ('frame', 'metadata', 'format', 'width', 'height', 'stride', '_cache')
+
+    def __init__(self, frame, metadata=None, format='jpeg', width=0, height=0, stride=0):
+        self.frame = frame
+        self.metadata = metadata if metadata is not None else {}
+        self.format = format
+        self.width = width
+        self.height = height
+        # Bytes per line of the (first) plane; 0 means tightly packed
+        self.stride = stride
+        self._cache = {}
+
+    def to_bytes(self):
+        return self.frame
+
+    def release(self):
+        self._cache = {}
+
+    def _pixels(self):
+        """The frame data as a flat uint8 array."""
+        return np.frombuffer(self.to_bytes(), dtype=np.uint8)
+
+    def _luma(self):
+        decoder = _decoders.get(self.format)
+        pixels = self._pixels()
+        if decoder == 'yuyv':
+            stride = self.stride or 2 * self.width
+            return pixels[:stride * self.height].reshape((self.height, stride))[:, 0:2 * self.width:2]
+        elif decoder in ('yuv420', 'mono'):
+            stride = self.stride or self.width
+            return pixels[:stride * self.height].reshape((self.height, stride))[:, :self.width]
+        else:
+            raise Exception(f"CapturedImage: unknown image format {self.format}")
+
+    def _decode(self, kind, reduce):
+        decoder = _decoders.get(self.format)
+        if decoder == 'jpeg':
+            flags = _jpeg_gray_flags if kind == 'gray' else _jpeg_color_flags
+            return cv2.imdecode(self._pixels(), flags[reduce])
+        if kind == 'gray':
+            return self._luma()[::reduce, ::reduce]
+        if decoder == 'yuyv':
+            stride = self.stride or 2 * self.width
+            yuyv = self._pixels()[:stride * self.height].reshape((self.height, stride))[:, :2 * self.width]
+            img = cv2.cvtColor(yuyv.reshape((self.height, self.width, 2)), cv2.COLOR_YUV2RGB_YUYV)
+        elif decoder == 'yuv420':
+            stride = self.stride or self.width
+            if stride == self.width:
+                yuv = self._pixels()[:self.width * self.height * 3 // 2].reshape((self.height * 3 // 2, self.width))
+            else:
+                # Chroma planes follow the luma at half the stride; crop each
+                # plane's padding into a packed I420 buffer for cvtColor
+                pixels = self._pixels()
+                w, h = self.width // 2, self.height // 2
+                u_start = stride * self.height
+                v_start = u_start + stride // 2 * h
+                yuv = np.concatenate((
+                    self._luma().ravel(),
+                    pixels[u_start:v_start].reshape((h, stride // 2))[:, :w].ravel(),
+                    pixels[v_start:v_start + stride // 2 * h].reshape((h, stride // 2))[:, :w].ravel(),
+                )).reshape((self.height * 3 // 2, self.width))
+            img = cv2.cvtColor(yuv, cv2.COLOR_YUV2RGB_I420)
+        else:
+            img = cv2.cvtColor(np.ascontiguousarray(self._luma()), cv2.COLOR_GRAY2RGB)
+        return img[::reduce, ::reduce]
+
+    def _cached(self, kind, reduce):
+        key = (kind, reduce)
+        img = self._cache.get(key)
+        if img is None:
+            img = self._cache[key] = self._decode(kind, reduce)
+        return img
+
+    def to_grayscale(self, reduce=1):
+        return self._cached('gray', reduce)
+
+    def to_rgb(self, reduce=1):
+        return self._cached('rgb', reduce)
+
+import unittest
+
+class TestCapturedImage(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.luma = rng.integers(0, 256, (4, 6), dtype=np.uint8)
+
+    def pad(self, plane, stride):
+        return np.pad(plane, ((0, 0), (0, stride - plane.shape[1])), constant_values=255)
+
+    def test_luma(self):
+        chroma = np.random.default_rng(1).integers(0, 256, (4, 6), dtype=np.uint8)
+        yuyv = np.stack((self.luma, chroma), axis=2).reshape((4, 12))
+        u, v = chroma[:2, :3], chroma[2:, 3:]
+        yuv420 = [self.luma, u, v]
+        # (packed, padded) pairs of each format
+        for packed, padded in (
+                (CapturedImage(self.luma.tobytes(), format='raw', width=6, height=4),
+                 CapturedImage(self.pad(self.luma, 8).tobytes(), format='GREY', width=6, height=4, stride=8)),
+                (CapturedImage(yuyv.tobytes(), format='yuyv', width=6, height=4),
+                 CapturedImage(self.pad(yuyv, 16).tobytes(), format='YUYV', width=6, height=4, stride=16)),
+                (CapturedImage(np.concatenate([p.ravel() for p in yuv420]).tobytes(), format='yuv420', width=6, height=4),
+                 CapturedImage(np.concatenate([self.pad(p, s).ravel() for p, s in zip(yuv420, (8, 4, 4))]).tobytes(),
+                               format='YUV420', width=6, height=4, stride=8))):
+            with self.subTest(format=packed.format):
+                for image in (packed, padded):
+                    np.testing.assert_array_equal(image.to_grayscale(), self.luma)
+                    np.testing.assert_array_equal(image.to_grayscale(2), self.luma[::2, ::2])
+                    # Uncompressed luma is a view of the frame, not a copy
+                    self.assertFalse(image.to_grayscale().flags.owndata)
+                self.assertEqual(packed.to_rgb().shape, (4, 6, 3))
+                np.testing.assert_array_equal(padded.to_rgb(), packed.to_rgb())
+
+    def test_jpeg_reduce(self):
+        # Smooth, so the decodes at reduced resolution agree with a downscaled full decode
+        y, x = np.mgrid[0:64, 0:96]
+        gray = (x * 2 + y).astype(np.uint8)
+        jpeg = cv2.imencode('.jpg', cv2.merge((gray, gray, gray)), [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+        image = CapturedImage(jpeg, format='jpeg', width=96, height=64)
+        for reduce in (1, 2, 4, 8):
+            with self.subTest(reduce=reduce):
+                small = image.to_grayscale(reduce)
+                self.assertEqual(small.shape, (64 // reduce, 96 // reduce))
+                expected = cv2.resize(gray, (96 // reduce, 64 // reduce), interpolation=cv2.INTER_AREA)
+                np.testing.assert_allclose(small, expected, atol=4)
+                self.assertEqual(image.to_rgb(reduce).shape, (64 // reduce, 96 // reduce, 3))
+
+    def test_cache(self):
+        image = CapturedImage(self.pad(self.luma, 8).tobytes(), format='raw', width=6, height=4, stride=8)
+        gray, rgb, small = image.to_grayscale(), image.to_rgb(), image.to_grayscale(2)
+        # One decode per representation and reduce factor, shared by later callers
+        self.assertIs(image.to_grayscale(), gray)
+        self.assertIs(image.to_rgb(), rgb)
+        self.assertIs(image.to_grayscale(2), small)
+        self.assertIsNot(small, gray)
+        self.assertEqual(set(image._cache), {('gray', 1), ('rgb', 1), ('gray', 2)})
+        image.release()
+        self.assertIsNot(image.to_grayscale(), gray)
+        np.testing.assert_array_equal(image.to_grayscale(), gray)
+
+    def test_padded_yuv420_rgb(self):
+        rng = np.random.default_rng(0)
+        width, height, stride = 6, 4, 8
+        y = rng.integers(0, 256, (height, width), dtype=np.uint8)
+        u, v = (rng.integers(0, 256, (height // 2, width // 2), dtype=np.uint8) for _ in range(2))
+        packed = CapturedImage(np.concatenate((y.ravel(), u.ravel(), v.ravel())).tobytes(), format='yuv420',
+                               width=width, height=height)
+        pad = lambda plane, s: np.pad(plane, ((0, 0), (0, s - plane.shape[1])), constant_values=255).ravel()
+        padded = CapturedImage(np.concatenate((pad(y, stride), pad(u, stride // 2), pad(v, stride // 2))).tobytes(),
+                               format='yuv420', width=width, height=height, stride=stride)
+        np.testing.assert_array_equal(padded.to_rgb(), packed.to_rgb())
+        np.testing.assert_array_equal(padded.to_rgb(2), packed.to_rgb()[::2, ::2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,40 +15,49 @@ import queue
 from utils.frame_rate_monitor import FrameRateMonitor
 from .abstract import AbstractCameraController
 from camera.utils.utils import BoundedQueue, IntegerControl, BooleanControl, FloatControl, MenuControl
+from camera.utils.roi import check_roi, fit_size
+from camera.utils.ring import FrameRing
+from camera.utils.metadata import CaptureMonitor, boottime_ns, DEQUEUE_TIMESTAMP, SENSOR_SEQUENCE
+from .image import CapturedImage
 
 from camera.models.IMX296 import IMX296Defaults
 
-class Picamera2CapturedImage:
-    def __init__(self, frame, metadata={}):
-        self.frame = frame
-        self.metadata = metadata
-        self.format = "jpeg"
+class Picamera2CapturedImage(CapturedImage):
+    __slots__ = ()
 
-    def to_grayscale(self):
-        if self.format == 'jpeg':
-            img = np.frombuffer(self.frame.getbuffer(), dtype=np.uint8)
-            return cv2.imdecode(img, cv2.IMREAD_GRAYSCALE)
-        else:
-            raise Exception(f"CapturedImage: unknown image format {self.format}")
-
-    def to_rgb(self):
-        if self.format == 'jpeg':
-            img = np.frombuffer(self.frame.getbuffer(), dtype=np.uint8)
-            return cv2.imdecode(img, cv2.IMREAD_COLOR)
-        else:
-            raise Exception(f"CapturedImage: unknown image format {self.format}")
+    def __init__(self, frame, metadata={}, width=0, height=0):
+        super().__init__(frame, metadata, "jpeg", width, height)
 
     def to_bytes(self):
         return self.frame.getbuffer()
 
+class Picamera2ArrayImage(CapturedImage):
+    """A frame from a picamera2 stream as an uncompressed array, e.g. the main stream in dual mode."""
+
+    __slots__ = ()
+
+    def __init__(self, array, metadata={}, format='yuv420', width=0, height=0):
+        # Rows of the array are padded to the stream's stride
+        super().__init__(array, metadata, format, width, height, array.shape[1])
+
+    def _pixels(self):
+        return self.frame.reshape(-1)
+
+    def to_bytes(self):
+        return np.ascontiguousarray(self.frame).data
+
 class Picamera2Controller(AbstractCameraController):
-    def __init__(self, device_id=0, controls={}):
+    def __init__(self, device_id=0, controls={}, lores_size=(640, 480), preview_quality=75):
         self.picam2 = Picamera2()
         self.controls = controls
         self.reader_fps = FrameRateMonitor("Picamera2Controller:reader", 1)
-        self.still_config = self.picam2.create_still_configuration()
-        self.preview_config = self.picam2.create_preview_configuration()
-        self.video_config = self.picam2.create_video_configuration()
+        self.lores_size = lores_size
+        self.roi = None
+        self._build_configs()
+        self.capture_mode = None
+        self.dual = False
+        self.luma = False
+        self.preview_quality = preview_quality
         self.picam2.start()
         self.set_capture_mode("preview")
         # picamera2 likes to log a lot of things
@@ -56,8 +65,11 @@ class Picamera2Controller(AbstractCameraController):
         logger.setLevel(logging.WARNING)
 
         self.frame_queue = queue.Queue(maxsize=1)
+        # Every frame captured, for recorders and other consumers that can't miss frames
+        self.frame_ring = FrameRing()
         self.running = False
         self.reader_fps = FrameRateMonitor("Picamera2Controller:reader", 1)
+        self.capture_monitor = CaptureMonitor("Picamera2Controller")
 
         self.common_to_imx296 = {
             'brightness': 'Brightness',
@@ -193,6 +205,86 @@ class Picamera2Controller(AbstractCameraController):
                 controls[control_name] = BooleanControl(control_name, control_id.id, control_type, default_value, default_value)
         return controls
 
+    def _build_configs(self, roi=None, sensor_mode=None):
+        if roi is None:
+            self.still_config = self.picam2.create_still_configuration()
+            self.preview_config = self.picam2.create_preview_configuration()
+            self.video_config = self.picam2.create_video_configuration()
+            # Full resolution main stream for analysis plus a small lores stream for viewing
+            self.dual_config = self.picam2.create_video_configuration(
+                main={'size': self.picam2.sensor_resolution, 'format': 'YUV420'},
+                lores={'size': self.lores_size, 'format': 'YUV420'})
+            # Main stream only, as YUV420 so its Y plane can be used without any conversion
+            self.luma_config = self.picam2.create_video_configuration(
+                main={'size': self.picam2.sensor_resolution, 'format': 'YUV420'})
+            return
+
+        # Every stream covers just the crop, unscaled where it can be, read out
+        # in the sensor mode chosen for it and limited only by that mode's fps
+        size = tuple(roi[2:])
+        min_duration = int(1e6 / sensor_mode['fps'])
+        max_duration = self.picam2.camera_controls['FrameDurationLimits'][1]
+        sensor = {'output_size': sensor_mode['size'], 'bit_depth': sensor_mode['bit_depth']}
+        controls = {'ScalerCrop': tuple(roi), 'FrameDurationLimits': (min_duration, max_duration)}
+        self.still_config = self.picam2.create_still_configuration(
+            main={'size': size}, sensor=sensor, controls=controls)
+        self.preview_config = self.picam2.create_preview_configuration(
+            main={'size': fit_size(size, (640, 480))}, sensor=sensor, controls=controls)
+        self.video_config = self.picam2.create_video_configuration(
+            main={'size': fit_size(size, (1280, 720))}, sensor=sensor, controls=controls)
+        self.dual_config = self.picam2.create_video_configuration(
+            main={'size': size, 'format': 'YUV420'},
+            lores={'size': fit_size(size, self.lores_size), 'format': 'YUV420'},
+            sensor=sensor, controls=controls)
+        self.luma_config = self.picam2.create_video_configuration(
+            main={'size': size, 'format': 'YUV420'}, sensor=sensor, controls=controls)
+
+    def _sensor_mode_for(self, roi):
+        # The fastest unbinned mode whose readout covers the crop, or the full sensor mode
+        x, y, width, height = roi
+        modes = self.picam2.sensor_modes
+        covering = [mode for mode in modes
+                    if tuple(mode['size']) == tuple(mode['crop_limits'][2:])
+                    and mode['crop_limits'][0] <= x and mode['crop_limits'][1] <= y
+                    and x + width <= mode['crop_limits'][0] + mode['crop_limits'][2]
+                    and y + height <= mode['crop_limits'][1] + mode['crop_limits'][3]]
+        if not covering:
+            return max(modes, key=lambda mode: mode['size'][0] * mode['size'][1])
+        return max(covering, key=lambda mode: mode['fps'])
+
+    def set_roi(self, roi=None):
+        """
+        Crop the sensor to roi = (x, y, width, height) in full resolution
+        pixels, or restore the whole sensor with None. The streams are rebuilt
+        at the size of the crop, so frames and all buffers downstream shrink
+        with it, and the current capture mode restarts with the new
+        configuration.
+        """
+        if roi is not None:
+            roi = check_roi(roi, self.picam2.sensor_resolution)
+            sensor_mode = self._sensor_mode_for(roi)
+        else:
+            sensor_mode = None
+        self._build_configs(roi, sensor_mode)
+        self.roi = roi
+        self.set_capture_mode(self.capture_mode or 'preview')
+        geometry = self.get_geometry()
+        logging.info(f"Picamera2Controller ROI {roi}: {geometry}")
+        return geometry
+
+    def get_geometry(self):
+        config = self.picam2.camera_config
+        width, height = config['main']['size']
+        return {
+            'roi': list(self.roi) if self.roi is not None else None,
+            'roi_supported': True,
+            'sensor_size': list(self.picam2.sensor_resolution),
+            'width': width,
+            'height': height,
+            'frame_duration_limits': list(config['controls'].get('FrameDurationLimits', ())),
+            'capture_mode': self.capture_mode,
+        }
+
     def _start_reader(self):
         self.running = True
         self.thread = threading.Thread(target=self._read_frames)
@@ -201,14 +293,80 @@ class Picamera2Controller(AbstractCameraController):
     def _read_frames(self):
         while self.running:
             try:
-                data = io.BytesIO()
-                metadata = self.picam2.capture_file(data, format='jpeg')
+                if self.dual:
+                    self._read_dual_frame()
+                    continue
+                if self.luma:
+                    self._read_luma_frame()
+                    continue
+                request = self.picam2.capture_request()
+                try:
+                    metadata = self._request_metadata(request)
+                    config = request.config
+                    data = io.BytesIO()
+                    request.save('main', data, format='jpeg')
+                finally:
+                    request.release()
                 self.reader_fps.update()
+                self.capture_monitor.update(metadata)
+                frame = Picamera2CapturedImage(data, metadata, *config['main']['size'])
+                self.frame_ring.put(frame)
                 if not self.frame_queue.full():
-                    self.frame_queue.put(Picamera2CapturedImage(data, metadata))
+                    self.frame_queue.put(frame)
             except Exception as e:
                 logging.error(f"Error capturing frame: {e}")
 
+    def _request_metadata(self, request):
+        # libcamera's metadata has SensorTimestamp; add the rest of the shared schema
+        metadata = request.get_metadata()
+        metadata[DEQUEUE_TIMESTAMP] = boottime_ns()
+        try:
+            buffer = request.request.buffers[self.picam2.stream_map['main']]
+            metadata[SENSOR_SEQUENCE] = buffer.metadata.sequence
+        except Exception as e:
+            logging.debug(f"Picamera2Controller: no buffer sequence number: {e}")
+        return metadata
+
+    def _read_dual_frame(self):
+        request = self.picam2.capture_request()
+        try:
+            metadata = self._request_metadata(request)
+            config = request.config
+            main = request.make_array('main')
+            lores = request.make_array('lores')
+        finally:
+            request.release()
+        self.reader_fps.update()
+        self.capture_monitor.update(metadata)
+
+        # The main stream only goes to the ring, for recorders and analysis
+        width, height = config['main']['size']
+        self.frame_ring.put(Picamera2ArrayImage(main, metadata, 'yuv420', width, height))
+
+        # The live view gets the lores luma as JPEG, encoded only when it will be used
+        if not self.frame_queue.full():
+            lores_width, lores_height = config['lores']['size']
+            ok, jpeg = cv2.imencode('.jpg', lores[:lores_height, :lores_width],
+                                    [cv2.IMWRITE_JPEG_QUALITY, self.preview_quality])
+            self.frame_queue.put(Picamera2CapturedImage(io.BytesIO(jpeg.tobytes()), metadata,
+                                                           lores_width, lores_height))
+
+    def _read_luma_frame(self):
+        request = self.picam2.capture_request()
+        try:
+            metadata = self._request_metadata(request)
+            config = request.config
+            main = request.make_array('main')
+        finally:
+            request.release()
+        self.reader_fps.update()
+        self.capture_monitor.update(metadata)
+        width, height = config['main']['size']
+        frame = Picamera2ArrayImage(main, metadata, 'yuv420', width, height)
+        self.frame_ring.put(frame)
+        if not self.frame_queue.full():
+            self.frame_queue.put(frame)
+
     def _stop_reader(self):
         try:
             self.running = False
@@ -232,10 +390,19 @@ class Picamera2Controller(AbstractCameraController):
         self.picam2.stop()
 
     def set_capture_mode(self, mode):
+        self.capture_mode = mode
+        self.dual = False
+        self.luma = False
         if mode == 'still':
             self.picam2.switch_mode(self.still_config)
         elif mode == 'preview':
             self.picam2.switch_mode(self.preview_config)
         elif mode == 'video':
             self.picam2.switch_mode(self.video_config)
+        elif mode == 'dual':
+            self.picam2.switch_mode(self.dual_config)
+            self.dual = True
+        elif mode == 'luma':
+            self.picam2.switch_mode(self.luma_config)
+            self.luma = True
 
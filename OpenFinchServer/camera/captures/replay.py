@@ -0,0 +1,129 @@
+import time
+import logging
+import threading
+import queue
+from utils.frame_rate_monitor import FrameRateMonitor
+from .abstract import AbstractCameraController
+from .synthetic import SyntheticCapturedImage
+from camera.utils.ring import FrameRing
+from camera.utils.recorder import RecordingReader
+
+# Recorded frame formats, as named by each backend, in SyntheticCapturedImage terms
+_replay_formats = {
+    'jpeg': 'jpeg',
+    'MJPEG': 'jpeg',
+    'yuyv': 'yuyv',
+    'YUYV': 'yuyv',
+    'raw': 'raw',
+    'yuv420': 'yuv420',
+}
+
+class ReplayCameraController(AbstractCameraController):
+    """
+    Plays back a recording made by FrameRecorder as if it were a camera.
+
+    With speed > 0 frames are released at their original SensorTimestamp
+    spacing (scaled by `speed`); with speed <= 0 they are released as fast
+    as consumers take them, without dropping any. Frame data are zero-copy
+    views of the memory-mapped recording and metadata is passed through
+    unchanged.
+    """
+
+    def __init__(self, path, speed=1.0, loop=False):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.recording = RecordingReader(path)
+        self.format = _replay_formats.get(self.recording.format)
+        if self.format is None:
+            raise ValueError(f"Can't replay frames of format '{self.recording.format}'")
+
+        self.width, self.height = self.recording.width, self.recording.height
+
+        self.frame_queue = queue.Queue(maxsize=1)
+        self.frame_ring = FrameRing()
+        self.running = False
+        self.position = 0
+        self.reader_fps = FrameRateMonitor("ReplayCameraController:reader", 1)
+        logging.info(f"ReplayCameraController: {len(self.recording)} {self.recording.format} frames from {path}")
+
+    def _start_reader(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._read_frames)
+        self.thread.start()
+
+    def _read_frames(self):
+        timestamps = self.recording.timestamps()
+        expected = None
+        while self.running:
+            if self.position >= len(self.recording):
+                if not self.loop:
+                    logging.info("ReplayCameraController reached the end of the recording")
+                    break
+                self.position = 0
+            if self.position != expected:
+                # Started, looped or seeked: restart the clock from this frame
+                start_time = time.monotonic()
+                start_index = self.position
+
+            i = self.position
+            if self.speed > 0:
+                delay = start_time + (timestamps[i] - timestamps[start_index]) / 1e9 / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            frame = SyntheticCapturedImage(self.recording.frame(i), self.recording.metadata(i), self.format,
+                                           self.recording.width, self.recording.height, self.recording.stride)
+            self.position = expected = i + 1
+            self.reader_fps.update()
+            self.frame_ring.put(frame)
+            if self.speed > 0:
+                if not self.frame_queue.full():
+                    self.frame_queue.put(frame)
+            else:
+                # As fast as possible, but every frame is delivered
+                while self.running:
+                    try:
+                        self.frame_queue.put(frame, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+
+    def _stop_reader(self):
+        try:
+            self.running = False
+            self.thread.join()
+        except Exception as e:
+            logging.exception("ReplayCameraController._stop_reader()")
+
+    def capture_frame(self, blocking=True):
+        if not blocking and self.frame_queue.empty():
+            return None
+        else:
+            frame = self.frame_queue.get()
+            return frame
+
+    def seek(self, index):
+        self.position = index
+
+    def open(self):
+        self._start_reader()
+
+    def close(self):
+        self._stop_reader()
+
+    def set_capture_mode(self, mode):
+        logging.debug(f"ReplayCameraController ignoring capture mode {mode}")
+
+    def set_control(self, control_name, value):
+        logging.warning(f"Control '{control_name}' can't be set on a replayed recording")
+        return False
+
+    def get_control(self, control_name):
+        return False
+
+    def get_controls(self):
+        return {}
+
+    def get_control_descriptors(self):
+        return {}
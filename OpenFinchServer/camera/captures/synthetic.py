@@ -0,0 +1,215 @@
+import cv2
+import numpy as np
+import time
+import logging
+import threading
+import queue
+from utils.frame_rate_monitor import FrameRateMonitor
+from .abstract import AbstractCameraController
+from camera.utils.utils import IntegerControl, FloatControl
+from camera.utils.ring import FrameRing
+from camera.utils.metadata import CaptureMonitor, boottime_ns
+from camera.utils.roi import check_roi
+from .image import CapturedImage
+
+class SyntheticCapturedImage(CapturedImage):
+    __slots__ = ()
+
+class SyntheticCameraController(AbstractCameraController):
+    """
+    A camera that needs no hardware, for load testing the streaming path.
+
+    A reader thread produces deterministic frames (a test pattern that
+    scrolls by `step` pixels per frame) at `fps`, in 'jpeg', 'yuyv', 'yuv420'
+    or 'raw' (8 bit mono) format, with libcamera style metadata. The first
+    `pattern_count` frames are encoded once and then cycled, so producing a
+    frame costs almost nothing and benchmarks measure the code downstream.
+    """
+
+    formats = ('jpeg', 'yuyv', 'yuv420', 'raw')
+
+    def __init__(self, width=1456, height=1088, format='jpeg', fps=60.0, pattern_count=16,
+                 step=8, jpeg_quality=75, controls={}):
+        if format not in self.formats:
+            raise ValueError(f"Invalid format '{format}'. Choose one of {self.formats}.")
+        self.sensor_size = (width, height)
+        # Frames cover roi = (x, y, width, height) of the sensor
+        self.roi = None
+        self.width = width
+        self.height = height
+        self.format = format
+        self.fps = fps
+        self.pattern_count = pattern_count
+        self.step = step
+        self.jpeg_quality = jpeg_quality
+
+        self.common_to_synthetic = {
+            'exposure_time': 'ExposureTime',
+            'exposure_absolute': 'ExposureTime',
+            'gain': 'AnalogueGain',
+            'analog_gain': 'AnalogueGain',
+            'analogue_gain': 'AnalogueGain',
+            'brightness': 'Brightness',
+        }
+        self.control_values = {
+            'ExposureTime': 10000,
+            'AnalogueGain': 1.0,
+            'Brightness': 0.0,
+        }
+        for control_name, value in controls.items():
+            self.set_control(control_name, value)
+
+        self.frame_queue = queue.Queue(maxsize=1)
+        # Every frame captured, for recorders and other consumers that can't miss frames
+        self.frame_ring = FrameRing()
+        self.running = False
+        self.sequence = 0
+        self.dropped = 0
+        self.patterns = None
+        self.reader_fps = FrameRateMonitor("SyntheticCameraController:reader", 1)
+        self.capture_monitor = CaptureMonitor("SyntheticCameraController")
+
+    def render_patterns(self, x0, y0, width, height):
+        """The 8 bit mono test pattern of each frame in the cycle, over the given region of the sensor."""
+        # One wide pattern; each frame is a window shifted by `step` pixels
+        y, x = np.ogrid[y0:y0 + height, x0:x0 + width + self.pattern_count * self.step]
+        img = ((x + y) % 256) ^ (((x >> 5) ^ (y >> 5)) & 1) * 64
+        scale = (self.control_values['ExposureTime'] / 10000) * self.control_values['AnalogueGain']
+        img = np.clip(img * scale + self.control_values['Brightness'] * 255, 0, 255).astype(np.uint8)
+        return [img[:, i * self.step:i * self.step + width] for i in range(self.pattern_count)]
+
+    def encode_pattern(self, img):
+        height, width = img.shape
+        if self.format == 'jpeg':
+            ok, buf = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            return buf.tobytes()
+        elif self.format == 'yuyv':
+            yuyv = np.empty((height, width, 2), dtype=np.uint8)
+            yuyv[:, :, 0] = img
+            yuyv[:, :, 1] = 128
+            return yuyv.tobytes()
+        elif self.format == 'yuv420':
+            yuv = np.full((height * 3 // 2, width), 128, dtype=np.uint8)
+            yuv[:height] = img
+            return yuv.tobytes()
+        else:
+            return np.ascontiguousarray(img).tobytes()
+
+    def _build_patterns(self):
+        # Snapshot the geometry so the patterns and the size they're tagged with always agree
+        x, y, width, height = self.roi or (0, 0, *self.sensor_size)
+        tic = time.time()
+        patterns = [self.encode_pattern(img) for img in self.render_patterns(x, y, width, height)]
+        logging.debug(f"SyntheticCameraController built {self.pattern_count} {self.format} frames in {time.time() - tic:.2f}s")
+        return patterns, width, height
+
+    def _start_reader(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._read_frames)
+        self.thread.start()
+
+    def _read_frames(self):
+        period = 1.0 / self.fps
+        next_time = time.monotonic()
+        while self.running:
+            patterns = self.patterns
+            if patterns is None:
+                patterns = self.patterns = self._build_patterns()
+            patterns, width, height = patterns
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Fell behind; don't try to catch up with a burst of frames
+                next_time = time.monotonic()
+            next_time += period
+
+            data = patterns[self.sequence % len(patterns)]
+            exposure = self.control_values['ExposureTime']
+            now = boottime_ns()
+            metadata = {
+                'SensorTimestamp': now,
+                'SensorSequence': self.sequence,
+                'DequeueTimestamp': now,
+                'ExposureTime': exposure,
+                'AnalogueGain': self.control_values['AnalogueGain'],
+                'DigitalGain': 1.0,
+                'FrameDuration': int(period * 1e6),
+            }
+            self.sequence += 1
+            self.reader_fps.update()
+            self.capture_monitor.update(metadata)
+            frame = SyntheticCapturedImage(data, metadata, self.format, width, height)
+            self.frame_ring.put(frame)
+            if not self.frame_queue.full():
+                self.frame_queue.put(frame)
+            else:
+                self.dropped += 1
+
+    def _stop_reader(self):
+        try:
+            self.running = False
+            self.thread.join()
+        except Exception as e:
+            logging.exception("SyntheticCameraController._stop_reader()")
+
+    def capture_frame(self, blocking=True):
+        if not blocking and self.frame_queue.empty():
+            return None
+        else:
+            frame = self.frame_queue.get()
+            return frame
+
+    def open(self):
+        self._start_reader()
+
+    def close(self):
+        self._stop_reader()
+
+    def set_capture_mode(self, mode):
+        logging.debug(f"SyntheticCameraController ignoring capture mode {mode}")
+
+    def set_roi(self, roi=None):
+        if roi is not None:
+            roi = check_roi(roi, self.sensor_size)
+        self.roi = roi
+        self.width, self.height = roi[2:] if roi is not None else self.sensor_size
+        self.patterns = None
+        return self.get_geometry()
+
+    def get_geometry(self):
+        return {
+            'roi': list(self.roi) if self.roi is not None else None,
+            'roi_supported': True,
+            'sensor_size': list(self.sensor_size),
+            'width': self.width,
+            'height': self.height,
+            'frame_duration_limits': [int(1e6 / self.fps)] * 2,
+        }
+
+    def set_control(self, control_name, value):
+        backend_control_name = self.common_to_synthetic.get(control_name, control_name)
+        if backend_control_name not in self.control_values:
+            logging.warning(f"Control '{control_name}' is not supported by SyntheticCameraController")
+            return False
+        self.control_values[backend_control_name] = value
+        # The patterns depend on exposure, gain and brightness; rebuild them on the next frame
+        self.patterns = None
+        return True
+
+    def get_control(self, control_name):
+        backend_control_name = self.common_to_synthetic.get(control_name, control_name)
+        return self.control_values.get(backend_control_name, False)
+
+    def get_controls(self):
+        return dict(self.control_values)
+
+    def get_control_descriptors(self):
+        return {
+            'ExposureTime': IntegerControl('ExposureTime', 0, 'Integer32', (30, 70000), None,
+                                           10000, self.control_values['ExposureTime']),
+            'AnalogueGain': FloatControl('AnalogueGain', 1, 'Float', (1.0, 16.0),
+                                         1.0, self.control_values['AnalogueGain']),
+            'Brightness': FloatControl('Brightness', 2, 'Float', (-1.0, 1.0),
+                                       0.0, self.control_values['Brightness']),
+        }
@@ -13,55 +13,101 @@ import logging
 import subprocess
 import threading
 import queue
+import select
+import weakref
 from utils.frame_rate_monitor import FrameRateMonitor
+from camera.utils.ring import FrameRing
+from camera.utils.metadata import CaptureMonitor, buffer_metadata
+from .image import CapturedImage
 
 from camera.models.OV2311 import OV2311Defaults
 
-class V4L2CapturedImage:
-    def __init__(self, frame, metadata={}):
-        self.frame = frame
-        self.metadata = metadata
-        self.format = frame.pixel_format.name
-
-    def to_grayscale(self):
-        if self.format == 'YUYV':
-            # Convert YUYV raw data to grayscale
-            return cv2.cvtColor(np.frombuffer(self.frame.data, dtype=np.uint8).reshape((1200,1600,2)), cv2.COLOR_YUV2GRAY_YUYV)
-        elif self.format == 'MJPEG':
-            # Decode MJPG data to grayscale
-            img = np.frombuffer(self.frame.data, dtype=np.uint8)
-            return cv2.imdecode(img, cv2.IMREAD_GRAYSCALE)
-        else:
-            raise Exception(f"CapturedImage: unknown image format {self.format}")
-
-    def to_rgb(self):
-        if self.format == 'YUYV':
-            # Convert YUYV raw data to RGB
-            return cv2.cvtColor(np.frombuffer(self.frame.data, dtype=np.uint8).reshape((1200,1600,2)), cv2.COLOR_YUV2RGB_YUYV)
+class V4L2CapturedImage(CapturedImage):
+    __slots__ = ()
 
-        elif self.format == 'MJPEG':
-            # Decode MJPG data to RGB
-            img = np.frombuffer(self.frame.data, dtype=np.uint8)
-            return cv2.imdecode(img, cv2.IMREAD_COLOR)
-        else:
-            raise Exception(f"CapturedImage: unknown image format {self.format}")
+    def __init__(self, frame, metadata={}, width=0, height=0, stride=0):
+        super().__init__(frame, metadata, frame.pixel_format.name,
+                         width or frame.width, height or frame.height, stride)
 
     def to_bytes(self):
         return self.frame.data
 
+class V4L2MappedImage(CapturedImage):
+    """A frame whose data is a read-only NumPy view of a driver mmap buffer, see V4L2BufferLease."""
+
+    __slots__ = ('lease', '__weakref__')
+
+    def __init__(self, view, metadata={}, format='YUYV', width=0, height=0, stride=0):
+        super().__init__(view, metadata, format, width, height, stride)
+        self.lease = None
+
+    def _pixels(self):
+        return self.frame
+
+class V4L2BufferLease:
+    """
+    Lends a dequeued mmap buffer out as a read-only NumPy view, without
+    copying it. The view is tracked by a weak reference: once it and every
+    array derived from it (to_grayscale() results, slices, the frame
+    itself) have been dropped, the buffer's index is put on `released` for
+    the reader to requeue (QBUF).
+
+    detach() is the fallback for a consumer that holds on too long: the
+    frame gets a private copy of its data and the buffer can be requeued
+    at once. Arrays taken from the frame before that still point into the
+    buffer and will be overwritten by later frames.
+    """
+
+    def __init__(self, index, view, image, released):
+        self.index = index
+        self.time = time.monotonic()
+        self.image = weakref.ref(image)
+        self.finalizer = weakref.finalize(view, released.put, index)
+
+    def detach(self):
+        self.finalizer.detach()
+        image = self.image()
+        if image is not None:
+            image.frame = np.frombuffer(bytes(image.frame), dtype=np.uint8)
+            image.release()
+
 import v4l2py
+from v4l2py.device import BufferType, Memory
 
 from .abstract import AbstractCameraController
 
 class V4L2CameraController(AbstractCameraController):
-    def __init__(self, device_id='/dev/video0', controls=OV2311Defaults):
+    """
+    Captures from a V4L2 device through v4l2py.
+
+    The capture format and frame rate are negotiated with ioctls on the open
+    device (set_format(), set_fps()); the driver may adjust what was asked
+    for, and the geometry it settled on is what frames are tagged with.
+    `buffers` is the number of mmap buffers queued to the driver: more of
+    them let the driver keep capturing through longer stalls of the reader.
+
+    With zero_copy=True frames are V4L2MappedImages, views of the mmap
+    buffers themselves rather than copies (see V4L2BufferLease). A buffer
+    still referenced `max_hold` seconds after it was dequeued, when the
+    driver has run out of buffers, is copied so it can be requeued. Since
+    the FrameRing keeps its frames alive, in this mode it only holds
+    buffers - 2 frames: with the latest frame waiting in `frame_queue`,
+    the ring and capture_frame() never hold more than buffers - 1, and the
+    driver always has a buffer to fill. Zero-copy therefore needs at least
+    3 buffers, and consumers that need a deeper history must copy.
+    """
+
+    def __init__(self, device_id='/dev/video0', controls=OV2311Defaults, width=None, height=None,
+                 pixel_format='MJPG', fps=None, buffers=4, zero_copy=False, max_hold=0.1):
+        if zero_copy and buffers < 3:
+            raise ValueError(f"Zero-copy capture needs at least 3 buffers, not {buffers}")
         if type(device_id) == int:
             self.device_path = f"/dev/video{device_id}"
         else:
             self.device_path = device_id
         self.device = v4l2py.Device(self.device_path)
-        self.video = v4l2py.VideoCapture(self.device)
-        self.iter_video = iter(self.video)
+        self.buffers = buffers
+        self.video = v4l2py.VideoCapture(self.device, size=buffers)
         self.control_values = controls
 
         self.device.open()
@@ -70,20 +116,90 @@ class V4L2CameraController(AbstractCameraController):
             self.set_control(control_name, value)
 
         self.frame_queue = queue.Queue(maxsize=1)
+        # Every frame captured, for recorders and other consumers that can't miss frames
+        self.zero_copy = zero_copy
+        self.max_hold = max_hold
+        self.frame_ring = FrameRing(buffers - 2) if zero_copy else FrameRing()
+        self.released = queue.SimpleQueue()
+        self.leases = {}  # dequeued buffers by index, oldest first
+        self.copies = 0
         self.running = False
+        self.width = 0
+        self.height = 0
+        self.stride = 0
+        self.pixel_format = None
+        self.fps = None
+        if width and height:
+            self.set_format(width, height, pixel_format)
+        if fps:
+            self.set_fps(fps)
+        self._read_format()
         self.reader_fps = FrameRateMonitor("V4L2CameraController:reader", 1)
+        self.capture_monitor = CaptureMonitor("V4L2CameraController")
 
     def _start_reader(self):
         self.running = True
-        self.thread = threading.Thread(target=self._read_frames)
+        self.thread = threading.Thread(target=self._read_mapped_frames if self.zero_copy else self._read_frames)
         self.thread.start()
 
     def _read_frames(self):
         while self.running:
-            frame = next(self.iter_video)
+            raw = next(self.iter_video)
+            frame = V4L2CapturedImage(raw, buffer_metadata(raw.buff), self.width, self.height, self.stride)
+            self.reader_fps.update()
+            self.capture_monitor.update(frame.metadata)
+            self.frame_ring.put(frame)
+            if not self.frame_queue.full():
+                self.frame_queue.put(frame)
+
+    def _requeue(self, index):
+        if self.leases.pop(index, None) is None:
+            return
+        self.device.enqueue_buffer(BufferType.VIDEO_CAPTURE, Memory.MMAP, 0, index)
+
+    def _requeue_released(self, timeout=None):
+        """Requeue the buffers consumers have dropped, waiting up to `timeout` for the first."""
+        try:
+            index = self.released.get(timeout=timeout) if timeout else self.released.get_nowait()
+            while True:
+                self._requeue(index)
+                index = self.released.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _read_mapped_frames(self):
+        maps = self.video.buffer.buffers  # the driver's mmap buffers, by index
+        while self.running:
+            try:
+                self._requeue_released()
+                if len(self.leases) >= self.buffers:
+                    # The driver has no buffer left to fill: wait for the oldest to be
+                    # released, and copy it out if it's held past max_hold
+                    oldest = next(iter(self.leases.values()))
+                    self._requeue_released(max(0.001, oldest.time + self.max_hold - time.monotonic()))
+                    if oldest.index in self.leases:
+                        oldest.detach()
+                        self._requeue(oldest.index)
+                        self.copies += 1
+                if not select.select((self.device,), (), (), 0.1)[0]:
+                    continue
+                buf = self.device.dequeue_buffer(BufferType.VIDEO_CAPTURE, Memory.MMAP)
+                metadata = buffer_metadata(buf)
+                view = np.frombuffer(maps[buf.index], dtype=np.uint8, count=buf.bytesused)
+                view.flags.writeable = False
+                frame = V4L2MappedImage(view, metadata, self.pixel_format, self.width, self.height, self.stride)
+                frame.lease = V4L2BufferLease(buf.index, view, frame, self.released)
+                self.leases[buf.index] = frame.lease
+                del view
+            except Exception as e:
+                logging.exception("V4L2CameraController._read_mapped_frames()")
+                continue
             self.reader_fps.update()
+            self.capture_monitor.update(metadata)
+            self.frame_ring.put(frame)
             if not self.frame_queue.full():
                 self.frame_queue.put(frame)
+            del frame
 
     def _time_video_iter(self, N=100):
         tic = time.time()
@@ -103,24 +219,73 @@ class V4L2CameraController(AbstractCameraController):
             return None
         else:
             frame = self.frame_queue.get()
-            cap = V4L2CapturedImage(frame)
-            return cap
+            return frame
+
 
+    def _read_format(self):
+        # Store the format the driver actually settled on
+        try:
+            fmt = self.video.get_format()
+            self.width, self.height = fmt.width, fmt.height
+            self.stride = fmt.bytes_per_line
+            self.pixel_format = fmt.pixel_format.name
+        except Exception as e:
+            logging.warning(f"V4L2CameraController: can't read the capture format, assuming packed lines: {e}")
+            self.stride = 0
+        try:
+            self.fps = float(self.video.get_fps())
+        except Exception as e:
+            self.fps = None
+        logging.info(f"V4L2CameraController: {self.width}x{self.height} {self.pixel_format} "
+                     f"(stride {self.stride}) at {self.fps} fps, {self.buffers} buffers")
+
+    def _reconfigure(self, configure):
+        # The format can't change while buffers are allocated, so stop streaming around it
+        running = self.running
+        if running:
+            self.close()
+        try:
+            configure()
+        finally:
+            self._read_format()
+            if running:
+                self.open()
 
-    def set_format(self, width, height, pixel_format):
-        subprocess.call([
-            'v4l2-ctl',
-            '--set-fmt-video=width={width},height={height},pixelformat={pixel_format}'.format(
-                width=width, height=height, pixel_format=pixel_format)
-        ])
+    def set_format(self, width, height, pixel_format='MJPG'):
+        self._reconfigure(lambda: self.video.set_format(width, height, pixel_format))
+        if (self.width, self.height) != (width, height):
+            logging.warning(f"V4L2CameraController: asked for {width}x{height}, the driver chose {self.width}x{self.height}")
+
+    def set_fps(self, fps):
+        self._reconfigure(lambda: self.video.set_fps(fps))
+
+    def set_buffers(self, buffers):
+        # Consumers follow the existing ring, so it can't be resized to match fewer buffers
+        if self.zero_copy and buffers < self.frame_ring.capacity + 2:
+            raise ValueError(f"Zero-copy capture with a {self.frame_ring.capacity} frame ring "
+                             f"needs at least {self.frame_ring.capacity + 2} buffers, not {buffers}")
+        def configure():
+            self.buffers = buffers
+            self.video = v4l2py.VideoCapture(self.device, size=buffers)
+        self._reconfigure(configure)
 
     def open(self):
         self.video.open()
+        self.iter_video = iter(self.video)
         self._start_reader()
 
     def close(self):
         self._stop_reader()
-        self.video.close()
+        # Frames still holding mmap buffers get copies before the buffers are unmapped
+        for lease in list(self.leases.values()):
+            lease.detach()
+        self.leases.clear()
+        while not self.released.empty():
+            self.released.get_nowait()
+        try:
+            self.video.close()
+        except BufferError as e:
+            logging.warning(f"V4L2CameraController: views of the mmap buffers are still in use: {e}")
 
     def read_frame(self):
         return next(iter(self.video))
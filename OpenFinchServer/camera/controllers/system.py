@@ -2,16 +2,28 @@ import time
 import threading
 import logging
 import os
+import dataclasses
 import pigpio
 
 from camera.utils.capture import CaptureController
 from gpio.sequencer import start_pig, TriggerConfig
 from gpio.sequencer import Sequencer
+from gpio.timing import TimingRecorder
+from gpio.capture import GPIOCapture
+from camera.utils.recorder import FrameRecorder
+from camera.utils.archive import ArchiveWriter
+from camera.utils.events import EventRecorder
+from camera.utils.accumulator import FrameAccumulator
+from camera.utils.pixelstats import PixelStatistics
+from camera.utils.pipeline import FramePipeline
+from camera.utils.calibration import CalibrationStore, CalibrationStage, capture_calibration, CALIBRATION_KINDS
+from gpio.channel import CommandChannel, PipelinedConnection
 from utils.frame_rate_monitor import FrameRateMonitor
 from camera.captures.abstract import AbstractCameraController
 
 class SystemController:
-    def __init__(self, camera_controller: AbstractCameraController):
+    def __init__(self, camera_controller: AbstractCameraController, record_timing=True,
+                 pigpio_host="localhost", pigpio_port=8888, calibration_path="calibration"):
         self.camera_controller = camera_controller
         # Initialize the configuration first
         self.config = TriggerConfig()
@@ -27,14 +39,80 @@ class SystemController:
         self.fps_logger = FrameRateMonitor("SystemController", 1)
 
         # Now initialize the rest of the components that depend on the config
-        self.pig = start_pig()
+        self.pig = start_pig(pigpio_host, pigpio_port)
         self.vidcap = CaptureController(camera_controller=self.camera_controller)
         self.vidcap.open()
         self.sequencer = Sequencer(pig=self.pig, config=self.config)
 
+        # Wave updates run on their own thread and connection, so callers on
+        # the asyncio loop never wait for pigpio round trips
+        self.wave_channel = CommandChannel("WaveChannel")
+        try:
+            self.wave_conn = PipelinedConnection(pigpio_host, pigpio_port)
+        except Exception as e:
+            logging.exception("SystemController opening pipelined pigpio connection")
+            self.wave_conn = None
+
+        self.gpio_capture = None
+        self.recorder = None
+        self.archive = None
+        self.event_recorder = None
+        self.accumulator = None
+        self.pixel_stats = None
+        self.pipeline = None
+        self.calibrations = CalibrationStore(calibration_path)
+        self.calibration_stage = None
+        # Cached so per-frame work never queries the camera configuration
+        self.sensor_roi = None
+
+        # Measured trigger/LED edges, joined to each frame's metadata
+        self.timing = None
+        if record_timing:
+            try:
+                self.start_timing()
+            except Exception as e:
+                logging.exception("SystemController starting TimingRecorder")
+
+    def start_timing(self):
+        if self.timing is not None:
+            return
+        timing = TimingRecorder(self.pig, self.config)
+        timing.start()
+        self.timing = timing
+        # Join timing where frames enter the ring, so recorders and the pipeline store it too
+        self.camera_controller.frame_ring.annotate = self._annotate_frame
+
     def set_capture_mode(self, mode):
         self.camera_controller.set_capture_mode(mode)
 
+    def set_roi(self, roi=None):
+        """
+        Crop the sensor to roi = (x, y, width, height), or restore the full
+        sensor with None. The accumulator and pixel statistics start over at
+        the new frame size by themselves; recordings and archives have one
+        frame size in their header, so they are stopped. Returns the new
+        geometry and the names of what was stopped. Raises ValueError,
+        before stopping anything, if the camera can't crop its sensor.
+        """
+        if not self.get_geometry().get('roi_supported'):
+            raise ValueError(f"{type(self.camera_controller).__name__} doesn't support a sensor ROI")
+        stopped = []
+        for name, recorder, stop in (('recording', self.recorder, self.stop_recording),
+                                     ('archive', self.archive, self.stop_archive),
+                                     ('event_recording', self.event_recorder, self.stop_event_recording)):
+            if recorder is not None:
+                logging.warning(f"SystemController stopping {name} for a change of sensor ROI")
+                stop()
+                stopped.append(name)
+        geometry = self.camera_controller.set_roi(roi)
+        self.sensor_roi = geometry.get('roi')
+        if self.calibration_stage is not None:
+            self.calibration_stage.roi = self.sensor_roi
+        return geometry, stopped
+
+    def get_geometry(self):
+        return self.camera_controller.get_geometry()
+
     def __del__(self):
         self.shutdown()
 
@@ -47,12 +125,63 @@ class SystemController:
     def get_reader_fps(self):
         return self.vidcap.get_reader_fps()
 
+    def get_capture_stats(self):
+        monitor = self.vidcap.get_capture_monitor()
+        return monitor.stats() if monitor is not None else None
+
+    def frame_delivered(self, frame):
+        monitor = self.vidcap.get_capture_monitor()
+        if monitor is not None:
+            monitor.delivered(frame.metadata)
+
     def shutdown(self):
         try:
             self.display.close()
         except Exception as e:
             # logging.debug(f"CameraController shutting down display: {e}")
             pass
+        try:
+            self.stop_gpio_capture()
+        except Exception as e:
+            pass
+        try:
+            self.stop_recording()
+        except Exception as e:
+            pass
+        try:
+            self.stop_archive()
+        except Exception as e:
+            pass
+        try:
+            self.stop_event_recording()
+        except Exception as e:
+            pass
+        try:
+            self.stop_accumulator()
+        except Exception as e:
+            pass
+        try:
+            self.stop_pixel_stats()
+        except Exception as e:
+            pass
+        try:
+            self.stop_pipeline()
+        except Exception as e:
+            pass
+        try:
+            self.camera_controller.frame_ring.annotate = None
+            self.timing.stop()
+        except Exception as e:
+            pass
+        try:
+            self.wave_channel.close()
+            self.wave_conn.close()
+        except Exception as e:
+            pass
+        try:
+            self.sequencer.close()
+        except Exception as e:
+            pass
         try:
             self.vidcap.close()
         except Exception as e:
@@ -70,15 +199,23 @@ class SystemController:
             # logging.debug(f"CameraController shutting down wave: {e}")
             pass
 
+    def _annotate_frame(self, frame):
+        self.timing.annotate(frame.metadata)
+
     def capture_frame(self, timeout=1):
+        return self._capture_frame(timeout)
+
+    def _capture_frame(self, timeout=1):
         self.fps_logger.update()
+        # With a pipeline running, consumers get its processed frames
+        source = self.pipeline if self.pipeline is not None else self.vidcap
         if timeout <= 0:
-            return self.vidcap.capture_frame()
+            return source.capture_frame()
         else:
             result = [None]
 
             def target():
-                result[0] = self.vidcap.capture_frame()
+                result[0] = source.capture_frame()
 
             thread = threading.Thread(target=target)
             try:
@@ -93,8 +230,175 @@ class SystemController:
             else:
                 return result[0]
 
+    def capture_burst(self, n, after_seq=None, roi=None, timeout=2.0):
+        return self.vidcap.capture_burst(n, after_seq, roi, timeout)
+
+    def start_gpio_capture(self, filename, format='vcd'):
+        self.stop_gpio_capture()
+        cf = self.config
+        signals = {
+            cf.TRIG_IN: 'TRIG_IN',
+            cf.STROBE_IN: 'STROBE_IN',
+            cf.TRIG_OUT: 'TRIG_OUT',
+            cf.RED_OUT: 'RED_OUT',
+            cf.GRN_OUT: 'GRN_OUT',
+            cf.BLU_OUT: 'BLU_OUT',
+        }
+        self.gpio_capture = GPIOCapture(self.pig, signals, filename, format=format)
+        self.gpio_capture.start()
+
+    def stop_gpio_capture(self):
+        if self.gpio_capture is not None:
+            self.gpio_capture.stop()
+            self.gpio_capture = None
+
+    def start_recording(self, path, max_frames=10000, slot_size=None):
+        self.stop_recording()
+        self.recorder = FrameRecorder(self.camera_controller.frame_ring, path,
+                                      max_frames=max_frames, slot_size=slot_size)
+        self.recorder.start()
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.stop()
+            self.recorder = None
+
+    def start_archive(self, path, codec='zlib', level=None, chunk_frames=16, workers=None):
+        self.stop_archive()
+        self.archive = ArchiveWriter(self.camera_controller.frame_ring, path, codec=codec, level=level,
+                                     chunk_frames=chunk_frames, workers=workers)
+        self.archive.start()
+
+    def stop_archive(self):
+        if self.archive is not None:
+            self.archive.stop()
+            self.archive = None
+
+    def start_event_recording(self, path, predicate, statistic=None, pre_seconds=2.0, post_seconds=2.0,
+                              max_bytes=256 << 20):
+        self.stop_event_recording()
+        self.event_recorder = EventRecorder(self.camera_controller.frame_ring, path, predicate, statistic=statistic,
+                                            pre_seconds=pre_seconds, post_seconds=post_seconds, max_bytes=max_bytes)
+        self.event_recorder.start()
+
+    def stop_event_recording(self):
+        if self.event_recorder is not None:
+            self.event_recorder.stop()
+            self.event_recorder = None
+
+    def start_accumulator(self, n=16, mode='mean', alpha=0.1, roi=None):
+        self.stop_accumulator()
+        self.accumulator = FrameAccumulator(self.analysis_ring(), n=n, mode=mode, alpha=alpha, roi=roi)
+        self.accumulator.start()
+
+    def stop_accumulator(self):
+        if self.accumulator is not None:
+            self.accumulator.stop()
+            self.accumulator = None
+
+    def start_pixel_stats(self, window=None, minmax=False, roi=None):
+        self.stop_pixel_stats()
+        self.pixel_stats = PixelStatistics(self.analysis_ring(), window=window, minmax=minmax, roi=roi)
+        self.pixel_stats.start()
+
+    def stop_pixel_stats(self):
+        if self.pixel_stats is not None:
+            self.pixel_stats.stop()
+            self.pixel_stats = None
+
+    def analysis_ring(self):
+        """The ring analysis follows: the pipeline's output if one is running, otherwise the camera's."""
+        return self.pipeline.frame_ring if self.pipeline is not None else self.camera_controller.frame_ring
+
+    def start_pipeline(self, stages=(), workers=None, max_in_flight=None):
+        """Run frames through `stages`, a list of (name, stage) pairs, before they reach consumers."""
+        self.stop_pipeline()
+        pipeline = FramePipeline(self.camera_controller.frame_ring, workers=workers, max_in_flight=max_in_flight)
+        for name, stage in stages:
+            pipeline.add_stage(name, stage)
+        pipeline.start()
+        self.pipeline = pipeline
+        self._follow_analysis_ring()
+
+    def stop_pipeline(self):
+        if self.pipeline is not None:
+            self.pipeline.stop()
+            self.pipeline = None
+            self.calibration_stage = None
+            self._follow_analysis_ring()
+
+    def capture_calibration(self, kind, n=32, timeout=2.0):
+        """
+        Average the next `n` camera frames into a dark or flat calibration
+        for the current exposure, gain and sensor ROI, and store it.
+        """
+        if kind not in CALIBRATION_KINDS:
+            raise ValueError(f"Invalid calibration kind '{kind}'. Choose one of {CALIBRATION_KINDS}.")
+        image, exposure_time, analogue_gain = capture_calibration(self.camera_controller.frame_ring, n, timeout)
+        return self.calibrations.save(kind, image, exposure_time, analogue_gain, self.sensor_roi, n)
+
+    def enable_calibration(self, dark=True, flat=True):
+        """Correct frames with the nearest stored calibrations, as the first pipeline stage."""
+        if self.pipeline is None:
+            self.start_pipeline()
+        self.pipeline.remove_stage('calibration')
+        self.calibration_stage = CalibrationStage(self.calibrations, self.sensor_roi, dark=dark, flat=flat)
+        self.pipeline.add_stage('calibration', self.calibration_stage, index=0)
+
+    def disable_calibration(self):
+        if self.pipeline is not None:
+            self.pipeline.remove_stage('calibration')
+        self.calibration_stage = None
+
+    def _follow_analysis_ring(self):
+        # Move running analysis to the current analysis ring, with the same settings
+        if self.accumulator is not None:
+            a = self.accumulator
+            self.start_accumulator(n=a.n, mode=a.mode, alpha=a.alpha, roi=a.roi)
+        if self.pixel_stats is not None:
+            p = self.pixel_stats
+            self.start_pixel_stats(window=p.window, minmax=p.minmax, roi=p.roi)
+
     def update_wave(self):
-        self.sequencer.update_wave()
+        # Snapshot the config so the wave matches the settings at the time of
+        # the request; superseded requests are coalesced by the channel
+        config = dataclasses.replace(self.config)
+        future = self.wave_channel.submit('update_wave', self._update_wave, config)
+        future.add_done_callback(self._log_wave_error)
+        return future
+
+    def _update_wave(self, config):
+        if self.wave_conn is not None:
+            self.sequencer.update_wave_pipelined(self.wave_conn, config)
+        else:
+            self.sequencer.update_wave(config)
+
+    def set_multiplex(self, enabled):
+        """
+        Switch to (or from) multiplexed sub-frame illumination, where each
+        triggered frame is lit in a single colour field. Runs on the wave
+        channel so it is ordered with wave updates.
+
+        Frames are assigned to fields by their measured LED delays, so this
+        starts the TimingRecorder if it isn't running, and raises
+        RuntimeError if it can't.
+        """
+        if enabled and self.timing is None:
+            try:
+                self.start_timing()
+            except Exception as e:
+                raise RuntimeError(f"Multiplexed illumination needs GPIO timing, which couldn't be started: {e}")
+        future = self.wave_channel.submit('multiplex', self.sequencer.set_multiplex, enabled)
+        future.add_done_callback(self._log_wave_error)
+        return future
+
+    @property
+    def multiplex(self):
+        return self.sequencer.multiplex
+
+    def _log_wave_error(self, future):
+        if future.exception() is not None:
+            logging.error(f"SystemController.update_wave() failed: {future.exception()}")
 
     def set_cam_triggered(self):
         # XXX move this into the camera controller
@@ -0,0 +1,194 @@
+import logging
+import threading
+import numpy as np
+
+from camera.utils.ring import FrameRingFollower
+
+ACCUMULATOR_MODES = ('sum', 'mean', 'ema')
+
+class FrameAccumulator(FrameRingFollower):
+    """
+    Follows a FrameRing and accumulates frame luma in place, in a
+    preallocated buffer: the 'sum' (uint32) or 'mean' (float32) of each
+    block of `n` frames, or an exponential moving average ('ema', float32)
+    with weight `alpha` for the newest frame. `roi` = (x, y, width, height)
+    accumulates only that region.
+
+    Every `n` frames the result is published: `latest` holds a copy with a
+    dict describing it, and `published` counts the results. snapshot()
+    returns the accumulation in progress instead.
+    """
+
+    def __init__(self, frame_ring, n=16, mode='mean', alpha=0.1, roi=None):
+        if mode not in ACCUMULATOR_MODES:
+            raise ValueError(f"Invalid accumulator mode '{mode}'. Choose one of {ACCUMULATOR_MODES}.")
+        if n <= 0:
+            raise ValueError(f"Accumulator block must be positive, not {n}")
+        super().__init__(frame_ring)
+        self.n = n
+        self.mode = mode
+        self.alpha = alpha
+        self.roi = roi
+        self.buffer = None
+        self.count = 0
+        self.first_seq = None
+        self.last_seq = None
+        self.latest = None
+        self.published = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        super().start()
+        logging.info(f"FrameAccumulator: {self.mode} of {self.n} frames")
+
+    def stop(self):
+        if super().stop():
+            logging.info(f"FrameAccumulator published {self.published} results, dropped {self.dropped} frames")
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+            self.first_seq = None
+            if self.buffer is not None:
+                self.buffer[...] = 0
+
+    def add(self, img, seq=None):
+        """Accumulate one frame; returns the published (image, info) when it completes a block."""
+        if self.roi is not None:
+            x, y, w, h = self.roi
+            img = img[y:y + h, x:x + w]
+        with self.lock:
+            if self.geometry_changed(img):
+                self.buffer = np.zeros(img.shape, dtype=np.uint32 if self.mode == 'sum' else np.float32)
+                self.count = 0
+                self.first_seq = None
+            if self.mode == 'ema':
+                if self.count == 0:
+                    self.buffer[...] = img
+                else:
+                    # ema + alpha * (img - ema), without temporaries
+                    np.subtract(self.buffer, img, out=self.buffer)
+                    self.buffer *= 1 - self.alpha
+                    self.buffer += img
+            else:
+                self.buffer += img
+            self.count += 1
+            if self.first_seq is None:
+                self.first_seq = seq
+            self.last_seq = seq
+            if self.count % self.n:
+                return None
+            self.latest = self._result()
+            self.published += 1
+            if self.mode != 'ema':
+                self.count = 0
+                self.first_seq = None
+                self.buffer[...] = 0
+            return self.latest
+
+    def _result(self):
+        if self.mode == 'mean':
+            image = self.buffer / np.float32(self.count)
+        else:
+            image = self.buffer.copy()
+        info = {
+            'mode': self.mode,
+            'frames': self.count,
+            'first_seq': self.first_seq,
+            'last_seq': self.last_seq,
+            'alpha': self.alpha if self.mode == 'ema' else None,
+        }
+        return image, info
+
+    def snapshot(self):
+        """The accumulation in progress as (image, info), or None before the first frame."""
+        with self.lock:
+            if self.buffer is None or self.count == 0:
+                return None
+            return self._result()
+
+    def process(self, seq, frame):
+        self.add(frame.to_grayscale(), seq)
+
+import unittest
+
+class TestFrameAccumulator(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.frames = rng.integers(0, 256, (10, 6, 8), dtype=np.uint8)
+
+    def test_sum_and_mean(self):
+        for mode, expected in (('sum', self.frames[:4].sum(axis=0, dtype=np.uint32)),
+                               ('mean', self.frames[:4].mean(axis=0))):
+            acc = FrameAccumulator(None, n=4, mode=mode)
+            results = [acc.add(img, seq) for seq, img in enumerate(self.frames[:5])]
+            self.assertEqual([r is not None for r in results], [False, False, False, True, False])
+            image, info = acc.latest
+            np.testing.assert_allclose(image, expected, rtol=1e-6)
+            self.assertEqual(image.dtype, np.uint32 if mode == 'sum' else np.float32)
+            self.assertEqual((info['frames'], info['first_seq'], info['last_seq']), (4, 0, 3))
+            # The next block starts from zero
+            image, info = acc.snapshot()
+            np.testing.assert_allclose(image, self.frames[4].astype(image.dtype))
+            self.assertEqual((info['frames'], info['first_seq']), (1, 4))
+            self.assertEqual(acc.published, 1)
+
+    def test_ema(self):
+        alpha = 0.25
+        acc = FrameAccumulator(None, n=3, mode='ema', alpha=alpha)
+        expected = self.frames[0].astype(np.float64)
+        acc.add(self.frames[0], 0)
+        for seq in range(1, 9):
+            expected = expected + alpha * (self.frames[seq] - expected)
+            acc.add(self.frames[seq], seq)
+        self.assertEqual(acc.published, 3)
+        np.testing.assert_allclose(acc.latest[0], expected, rtol=1e-5)
+        # The average runs on across blocks rather than restarting
+        self.assertEqual((acc.latest[1]['frames'], acc.latest[1]['first_seq'], acc.latest[1]['alpha']), (9, 0, alpha))
+        # Published results are copies, not the buffer the average is kept in
+        self.assertIsNot(acc.latest[0], acc.buffer)
+
+    def test_roi(self):
+        acc = FrameAccumulator(None, n=2, mode='sum', roi=(2, 1, 3, 4))
+        acc.add(self.frames[0])
+        image, info = acc.add(self.frames[1])
+        np.testing.assert_array_equal(image, self.frames[:2, 1:5, 2:5].sum(axis=0, dtype=np.uint32))
+
+    def test_geometry_change(self):
+        acc = FrameAccumulator(None, n=3, mode='mean')
+        acc.add(self.frames[0], 0)
+        acc.add(self.frames[1], 1)
+        # A different shape discards the partial block and starts again
+        smaller = self.frames[2:6, :4, :4]
+        for seq, img in enumerate(smaller[:3], 2):
+            result = acc.add(img, seq)
+        image, info = result
+        np.testing.assert_allclose(image, smaller[:3].mean(axis=0), rtol=1e-6)
+        self.assertEqual((image.shape, info['frames'], info['first_seq']), ((4, 4), 3, 2))
+
+    def test_follow_ring(self):
+        import time
+        from camera.captures.image import CapturedImage
+        from camera.utils.ring import FrameRing
+        ring = FrameRing()
+        acc = FrameAccumulator(ring, n=5, mode='sum')
+        acc.start()
+        for img in self.frames:
+            ring.put(CapturedImage(img.tobytes(), {}, 'raw', 8, 6))
+        deadline = time.monotonic() + 5
+        while acc.published < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        acc.stop()
+        self.assertEqual(acc.published, 2)
+        np.testing.assert_array_equal(acc.latest[0], self.frames[5:].sum(axis=0, dtype=np.uint32))
+        self.assertEqual((acc.latest[1]['first_seq'], acc.latest[1]['last_seq']), (5, 9))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            FrameAccumulator(None, mode='median')
+        with self.assertRaises(ValueError):
+            FrameAccumulator(None, n=0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,308 @@
+import os
+import json
+import lzma
+import zlib
+import time
+import struct
+import logging
+import collections
+import concurrent.futures
+import numpy as np
+
+from camera.utils.recorder import _json_default
+from camera.utils.ring import FrameRingFollower
+
+# An archive is three files sharing a base path:
+#   <path>.archive  header followed by independently compressed chunks of frames
+#   <path>.chunks   one CHUNK_DTYPE record per chunk
+#   <path>.index    one ARCHIVE_INDEX_DTYPE record per frame
+# A decompressed chunk holds its frames' bytes followed by their metadata as
+# JSON lines; the index locates both within the chunk.
+ARCHIVE_MAGIC = b'OFARC002'
+# magic, codec, frame format, width, height, stride (0 if tightly packed), frames per chunk
+ARCHIVE_HEADER = struct.Struct('<8s8s16sIIII')
+
+CHUNK_DTYPE = np.dtype([
+    ('first_frame', '<u8'),  # index of the chunk's first frame
+    ('frames', '<u4'),
+    ('offset', '<u8'),       # byte offset of the compressed chunk in .archive
+    ('size', '<u8'),         # compressed size
+    ('raw_size', '<u8'),     # decompressed size
+])
+
+ARCHIVE_INDEX_DTYPE = np.dtype([
+    ('sequence', '<u8'),         # frame ring sequence number
+    ('timestamp', '<i8'),        # SensorTimestamp in ns
+    ('chunk', '<u4'),
+    ('offset', '<u4'),           # byte offset of the frame in the decompressed chunk
+    ('size', '<u4'),
+    ('metadata_offset', '<u4'),  # byte offset of the frame's metadata in the decompressed chunk
+    ('metadata_size', '<u4'),
+])
+
+# zlib and lzma release the GIL while they work, so a thread pool compresses in parallel
+codecs = {
+    'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress, 6),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 1),
+}
+
+class ArchiveWriter(FrameRingFollower):
+    """
+    Archives every frame that passes through a FrameRing, compressed.
+
+    Frames are grouped in chunks of `chunk_frames`, and each chunk is
+    compressed independently on a pool of `workers` threads, so any frame
+    can be read back by decompressing one chunk. Chunks are written in order
+    as they complete. At most `max_pending` chunks may be in flight; beyond
+    that the writer stops reading the ring, and since it reads with
+    backpressure the camera reader waits rather than frames being dropped
+    silently (frames still lost after the ring's max_stall are counted in
+    `dropped`).
+    """
+
+    backpressure = True
+
+    def __init__(self, frame_ring, path, codec='zlib', level=None, chunk_frames=16, workers=None,
+                 max_pending=None, report_interval=10.0):
+        if codec not in codecs:
+            raise ValueError(f"Invalid codec '{codec}'. Choose one of {list(codecs)}.")
+        super().__init__(frame_ring)
+        self.path = path
+        self.codec = codec
+        self.compress, _, default_level = codecs[codec]
+        self.level = default_level if level is None else level
+        self.chunk_frames = chunk_frames
+        self.workers = workers or os.cpu_count()
+        self.max_pending = max_pending or 2 * self.workers
+        self.report_interval = report_interval
+        self.frames = 0
+        self.chunks = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.start_time = None
+
+    def stats(self):
+        elapsed = time.monotonic() - self.start_time if self.start_time else 0
+        return {
+            'frames': self.frames,
+            'chunks': self.chunks,
+            'input_MBps': self.bytes_in / elapsed / 1e6 if elapsed else 0,
+            'output_MBps': self.bytes_out / elapsed / 1e6 if elapsed else 0,
+            'ratio': self.bytes_in / self.bytes_out if self.bytes_out else 0,
+            'dropped': self.dropped,
+            'stall_time': self.input_ring.stall_time,
+        }
+
+    def start(self):
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="ArchiveWriter")
+        self.start_time = time.monotonic()
+        super().start()
+        logging.info(f"ArchiveWriter archiving to {self.path} ({self.codec} level {self.level}, {self.workers} workers)")
+
+    def stop(self):
+        if not super().stop():
+            return
+        self.pool.shutdown()
+        self.log_stats()
+
+    def log_stats(self):
+        s = self.stats()
+        logging.info(f"ArchiveWriter {self.path}: {s['frames']} frames in {s['chunks']} chunks, "
+                     f"{s['input_MBps']:.1f} MB/s in, {s['output_MBps']:.1f} MB/s out, ratio {s['ratio']:.2f}, "
+                     f"dropped {s['dropped']}, producer stalled {s['stall_time']:.2f}s")
+
+    def _compress_chunk(self, frames):
+        # Runs on the pool: lay out the chunk and compress it
+        parts = []
+        metadata = []
+        records = np.zeros(len(frames), dtype=ARCHIVE_INDEX_DTYPE)
+        offset = 0
+        for i, (seq, frame) in enumerate(frames):
+            data = memoryview(frame.to_bytes()).cast('B')
+            parts.append(data)
+            records[i]['sequence'] = seq
+            records[i]['timestamp'] = frame.metadata.get('SensorTimestamp', 0)
+            records[i]['offset'] = offset
+            records[i]['size'] = len(data)
+            offset += len(data)
+        for i, (seq, frame) in enumerate(frames):
+            line = json.dumps(frame.metadata, default=_json_default).encode() + b'\n'
+            metadata.append(line)
+            records[i]['metadata_offset'] = offset
+            records[i]['metadata_size'] = len(line)
+            offset += len(line)
+        raw = b''.join(parts + metadata)
+        return records, self.compress(raw, self.level), len(raw)
+
+    def _write_chunk(self, future):
+        records, compressed, raw_size = future.result()
+        chunk = np.zeros(1, dtype=CHUNK_DTYPE)
+        chunk['first_frame'] = self.frames
+        chunk['frames'] = len(records)
+        chunk['offset'] = self.archive_file.tell()
+        chunk['size'] = len(compressed)
+        chunk['raw_size'] = raw_size
+        records['chunk'] = self.chunks
+        self.archive_file.write(compressed)
+        self.chunks_file.write(chunk.tobytes())
+        self.index_file.write(records.tobytes())
+        self.frames += len(records)
+        self.chunks += 1
+        self.bytes_in += raw_size
+        self.bytes_out += len(compressed)
+
+    def _open(self, frame):
+        self.archive_file = open(self.path + '.archive', 'wb')
+        self.archive_file.write(ARCHIVE_HEADER.pack(
+            ARCHIVE_MAGIC, self.codec.encode(), frame.format.encode(),
+            getattr(frame, 'width', 0), getattr(frame, 'height', 0), getattr(frame, 'stride', 0),
+            self.chunk_frames))
+        self.chunks_file = open(self.path + '.chunks', 'wb')
+        self.index_file = open(self.path + '.index', 'wb')
+
+    def _close(self):
+        for f in (self.archive_file, self.chunks_file, self.index_file):
+            f.close()
+
+    def run(self):
+        pending = collections.deque()
+        frames = []
+        opened = False
+        last_report = time.monotonic()
+        try:
+            while self.running or frames:
+                item = self.reader.get(timeout=0.1) if self.running else None
+                if item is not None:
+                    if not opened:
+                        self._open(item[1])
+                        opened = True
+                    frames.append(item)
+                # Flush a partial chunk at the end
+                if len(frames) >= self.chunk_frames or (frames and not self.running):
+                    pending.append(self.pool.submit(self._compress_chunk, frames))
+                    frames = []
+                # Write completed chunks in order; wait for the oldest if too many are in flight
+                while pending and (pending[0].done() or len(pending) >= self.max_pending):
+                    self._write_chunk(pending.popleft())
+                if time.monotonic() - last_report > self.report_interval:
+                    self.log_stats()
+                    last_report = time.monotonic()
+            while pending:
+                self._write_chunk(pending.popleft())
+        except Exception as e:
+            logging.exception("ArchiveWriter.run()")
+            self.running = False
+        finally:
+            if opened:
+                self._close()
+
+class ArchiveReader:
+    """Random access to an archive made by ArchiveWriter, one chunk decompressed at a time."""
+
+    def __init__(self, path):
+        self.path = path
+        self.archive_file = open(path + '.archive', 'rb')
+        header = self.archive_file.read(ARCHIVE_HEADER.size)
+        if header[:len(ARCHIVE_MAGIC)] != ARCHIVE_MAGIC or len(header) < ARCHIVE_HEADER.size:
+            self.archive_file.close()
+            raise ValueError(f"{path}.archive is not an OpenFinch archive of version {ARCHIVE_MAGIC.decode()}")
+        magic, codec, format, self.width, self.height, self.stride, self.chunk_frames = ARCHIVE_HEADER.unpack(header)
+        self.codec = codec.rstrip(b'\0').decode()
+        self.format = format.rstrip(b'\0').decode()
+        self.decompress = codecs[self.codec][1]
+        self.chunks = np.fromfile(path + '.chunks', dtype=CHUNK_DTYPE)
+        self.index = np.fromfile(path + '.index', dtype=ARCHIVE_INDEX_DTYPE)
+        self.cached_chunk = (None, None)
+
+    def close(self):
+        self.archive_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def chunk(self, c):
+        if self.cached_chunk[0] != c:
+            record = self.chunks[c]
+            self.archive_file.seek(int(record['offset']))
+            self.cached_chunk = (c, self.decompress(self.archive_file.read(int(record['size']))))
+        return self.cached_chunk[1]
+
+    def frame(self, i):
+        record = self.index[i]
+        data = self.chunk(int(record['chunk']))
+        offset = int(record['offset'])
+        return data[offset:offset + int(record['size'])]
+
+    def metadata(self, i):
+        record = self.index[i]
+        data = self.chunk(int(record['chunk']))
+        offset = int(record['metadata_offset'])
+        return json.loads(data[offset:offset + int(record['metadata_size'])])
+
+import unittest
+import tempfile
+
+class TestArchive(unittest.TestCase):
+
+    def round_trip(self, codec):
+        from camera.captures.image import CapturedImage
+        from camera.utils.ring import FrameRing
+        ring = FrameRing(capacity=4)
+        rng = np.random.default_rng(0)
+        # Compressible frames of varying size, and a partial last chunk
+        frames = [CapturedImage(np.repeat(rng.integers(0, 256, 100 + 10 * i, dtype=np.uint8), 4).tobytes(),
+                                {'SensorTimestamp': 1000 * i, 'Lux': np.float32(1.5)}, 'jpeg')
+                  for i in range(37)]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'archive')
+            writer = ArchiveWriter(ring, path, codec=codec, chunk_frames=8, workers=3, max_pending=2)
+            writer.start()
+            for frame in frames:
+                ring.put(frame)
+            deadline = time.monotonic() + 5
+            while ring.head - writer.reader.next > 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            writer.stop()
+            self.assertEqual((writer.frames, writer.chunks, writer.dropped), (37, 5, 0))
+            self.assertGreater(writer.stats()['ratio'], 1)
+            with ArchiveReader(path) as reader:
+                self.assertEqual((reader.codec, reader.format, reader.stride, reader.chunk_frames), (codec, 'jpeg', 0, 8))
+                self.assertEqual(len(reader), len(frames))
+                self.assertEqual(list(reader.index['sequence']), list(range(len(frames))))
+                self.assertEqual(list(reader.chunks['frames']), [8, 8, 8, 8, 5])
+                for i in (36, 0, 17, 8, 9):
+                    self.assertEqual(reader.frame(i), frames[i].frame)
+                    self.assertEqual(reader.metadata(i), {'SensorTimestamp': 1000 * i, 'Lux': 1.5})
+
+    def test_zlib(self):
+        self.round_trip('zlib')
+
+    def test_lzma(self):
+        self.round_trip('lzma')
+
+    def test_stride(self):
+        from camera.captures.image import CapturedImage
+        from camera.utils.ring import FrameRing
+        ring = FrameRing(capacity=4)
+        frame = CapturedImage(bytes(range(48)), {}, 'yuv420', 6, 4, 8)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'archive')
+            writer = ArchiveWriter(ring, path, workers=1)
+            writer.start()
+            ring.put(frame)
+            deadline = time.monotonic() + 5
+            while ring.head - writer.reader.next > 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            writer.stop()
+            with ArchiveReader(path) as reader:
+                self.assertEqual((reader.width, reader.height, reader.stride), (6, 4, 8))
+                self.assertEqual(reader.frame(0), frame.frame)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import numpy as np
+
+BIN_MODES = ('mean', 'sum')
+
+def bin_image(img, factor, mode='mean', roi=None):
+    """
+    Bin a 2D image by `factor` in both directions, after cropping it to
+    roi = (x, y, width, height) if given. Edge rows and columns that don't
+    fill a whole bin are dropped. The image is split into bins with a
+    reshape, which is a view even of strided images like YUYV luma, and
+    reduced in one pass.
+
+    'sum' is exact (uint16, or uint32 for factors above 16); 'mean' is
+    rounded back to the input's 8 bit range.
+    """
+    if mode not in BIN_MODES:
+        raise ValueError(f"Invalid binning mode '{mode}'. Choose one of {BIN_MODES}.")
+    if factor < 1:
+        raise ValueError(f"Binning factor must be positive, not {factor}")
+    if roi is not None:
+        x, y, w, h = roi
+        img = img[y:y + h, x:x + w]
+    if factor == 1:
+        return img
+    height, width = img.shape[0] // factor, img.shape[1] // factor
+    bins = img[:height * factor, :width * factor].reshape(height, factor, width, factor)
+    sums = bins.sum(axis=(1, 3), dtype=np.uint16 if factor <= 16 else np.uint32)
+    if mode == 'sum':
+        return sums
+    n = factor * factor
+    sums += n // 2
+    sums //= n
+    return sums.astype(np.uint8)
+
+def parse_binning(data):
+    """
+    (factor, mode, roi) from a request like {'factor': 4, 'mode': 'mean',
+    'roi': [x, y, w, h]}, or None for no binning.
+    """
+    if not data:
+        return None
+    factor = int(data.get('factor', 1))
+    mode = data.get('mode', 'mean')
+    roi = tuple(int(v) for v in data['roi']) if data.get('roi') else None
+    if mode not in BIN_MODES:
+        raise ValueError(f"Invalid binning mode '{mode}'. Choose one of {BIN_MODES}.")
+    if factor < 1:
+        raise ValueError(f"Binning factor must be positive, not {factor}")
+    if factor == 1 and roi is None:
+        return None
+    return factor, mode, roi
+
+import unittest
+
+class TestBinning(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.img = rng.integers(0, 256, (30, 43), dtype=np.uint8)
+
+    def test_shape_drops_partial_bins(self):
+        for factor in (1, 2, 3, 4, 7):
+            self.assertEqual(bin_image(self.img, factor).shape, (30 // factor, 43 // factor))
+        sums = bin_image(self.img, 4, 'sum')
+        self.assertEqual(sums.dtype, np.uint16)
+        expected = self.img[:28, :40].astype(np.int64).reshape(7, 4, 10, 4).sum(axis=(1, 3))
+        self.assertTrue(np.array_equal(sums, expected))
+
+    def test_mean_rounds(self):
+        img = np.array([[0, 1], [1, 1]], dtype=np.uint8)
+        self.assertEqual(bin_image(img, 2)[0, 0], 1)
+        mean = bin_image(self.img, 3)
+        self.assertEqual(mean.dtype, np.uint8)
+        expected = self.img[:30, :42].reshape(10, 3, 14, 3).mean(axis=(1, 3))
+        self.assertTrue(np.abs(mean - expected).max() <= 0.5)
+
+    def test_large_factor_sums_exactly(self):
+        img = np.full((40, 40), 255, dtype=np.uint8)
+        sums = bin_image(img, 20, 'sum')
+        self.assertEqual(sums.dtype, np.uint32)
+        self.assertTrue((sums == 400 * 255).all())
+
+    def test_roi_and_strided_input(self):
+        # YUYV luma is a strided view, every other byte of each line
+        yuyv = np.zeros((30, 86), dtype=np.uint8)
+        yuyv[:, ::2] = self.img
+        binned = bin_image(yuyv[:, ::2], 2, 'sum', roi=(5, 4, 20, 10))
+        expected = self.img[4:14, 5:25].astype(np.int64).reshape(5, 2, 10, 2).sum(axis=(1, 3))
+        self.assertTrue(np.array_equal(binned, expected))
+
+    def test_parse_binning(self):
+        self.assertIsNone(parse_binning({}))
+        self.assertIsNone(parse_binning({'factor': 1}))
+        self.assertEqual(parse_binning({'factor': '4', 'roi': ['0', '2', '8', '8']}), (4, 'mean', (0, 2, 8, 8)))
+        for data in ({'factor': 0}, {'factor': 2, 'mode': 'median'}):
+            with self.assertRaises(ValueError):
+                parse_binning(data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+import io
+import numpy as np
+
+BURST_DTYPE = np.dtype([
+    ('sequence', '<i8'),          # frame ring sequence number
+    ('sensor_timestamp', '<i8'),  # ns
+    ('sensor_sequence', '<i8'),   # driver frame counter, -1 if the backend has none
+    ('exposure_time', '<i4'),     # µs
+    ('analogue_gain', '<f4'),
+])
+
+class Burst:
+    """
+    N consecutive frames stacked in one (n, height, width) luma array, with
+    a BURST_DTYPE row of metadata per frame. `gaps` lists (sequence,
+    missing) for each run of ring frames the burst lost because it fell
+    more than the ring's capacity behind.
+    """
+
+    def __init__(self, frames, table, gaps):
+        self.frames = frames
+        self.table = table
+        self.gaps = gaps
+
+    def __len__(self):
+        return len(self.frames)
+
+    def sensor_gaps(self):
+        """(sensor_sequence, missing) for frames the driver dropped within the burst."""
+        seqs = self.table['sensor_sequence']
+        steps = np.diff(seqs)
+        return [(int(seqs[i] + 1), int(steps[i] - 1)) for i in np.flatnonzero(steps > 1) if seqs[i] >= 0]
+
+    def summary(self):
+        return {
+            'frames': len(self),
+            'shape': list(self.frames.shape),
+            'first_seq': int(self.table['sequence'][0]) if len(self) else None,
+            'last_seq': int(self.table['sequence'][-1]) if len(self) else None,
+            'gaps': self.gaps,
+            'sensor_gaps': self.sensor_gaps(),
+        }
+
+    def to_npz(self):
+        """The burst as an uncompressed .npz with arrays 'frames', 'metadata' and 'gaps'."""
+        buf = io.BytesIO()
+        np.savez(buf, frames=self.frames, metadata=self.table,
+                 gaps=np.array(self.gaps, dtype=np.int64).reshape(-1, 2))
+        return buf.getvalue()
+
+def read_burst(frame_ring, n, after_seq=None, roi=None, timeout=2.0):
+    """
+    Copy the luma of `n` consecutive frames from `frame_ring` into one
+    preallocated array, starting with the frame after sequence `after_seq`
+    (default: the next frame captured). `roi` = (x, y, width, height) crops
+    every frame. Stops early, with fewer frames, if no frame arrives for
+    `timeout` seconds.
+    """
+    if n <= 0:
+        raise ValueError(f"Burst length must be positive, not {n}")
+    reader = frame_ring.reader(None if after_seq is None else max(0, after_seq + 1))
+    frames = None
+    table = np.zeros(n, dtype=BURST_DTYPE)
+    gaps = []
+    expected = reader.next
+    count = 0
+    while count < n:
+        item = reader.get(timeout)
+        if item is None:
+            break
+        seq, frame = item
+        if seq != expected:
+            gaps.append((expected, seq - expected))
+        expected = seq + 1
+
+        img = frame.to_grayscale()
+        if roi is not None:
+            x, y, w, h = roi
+            img = img[y:y + h, x:x + w]
+        if frames is None:
+            frames = np.empty((n,) + img.shape, dtype=img.dtype)
+        elif img.shape != frames.shape[1:]:
+            raise ValueError(f"Frame {seq} is {img.shape}, the burst started with {frames.shape[1:]}")
+        frames[count] = img
+
+        metadata = frame.metadata
+        table[count] = (seq, metadata.get('SensorTimestamp', 0), metadata.get('SensorSequence', -1),
+                        metadata.get('ExposureTime', 0), metadata.get('AnalogueGain', np.nan))
+        count += 1
+    if frames is None:
+        frames = np.empty((0, 0, 0), dtype=np.uint8)
+    return Burst(frames[:count], table[:count], gaps)
+
+import unittest
+
+class TestBurst(unittest.TestCase):
+
+    def setUp(self):
+        from camera.utils.ring import FrameRing
+        self.ring = FrameRing(capacity=4)
+
+    def frame(self, i, width=8, height=6, sensor_sequence=None):
+        from camera.captures.image import CapturedImage
+        pixels = (np.arange(width * height, dtype=np.uint8).reshape((height, width)) + i).tobytes()
+        return CapturedImage(pixels, {'SensorTimestamp': 1000 * i, 'ExposureTime': 100,
+                                      'SensorSequence': i if sensor_sequence is None else sensor_sequence},
+                             'raw', width, height)
+
+    def put(self, *frames):
+        for frame in frames:
+            self.ring.put(frame)
+
+    def test_consecutive(self):
+        self.put(*(self.frame(i) for i in range(4)))
+        burst = read_burst(self.ring, 3, after_seq=0, timeout=0.01)
+        self.assertEqual(list(burst.table['sequence']), [1, 2, 3])
+        self.assertEqual(burst.frames.shape, (3, 6, 8))
+        np.testing.assert_array_equal(burst.frames[0], np.frombuffer(self.frame(1).frame, np.uint8).reshape((6, 8)))
+        self.assertEqual((burst.gaps, burst.sensor_gaps()), ([], []))
+        # Stops early when frames stop coming
+        self.assertEqual(len(read_burst(self.ring, 8, after_seq=2, timeout=0.01)), 1)
+        with self.assertRaises(ValueError):
+            read_burst(self.ring, 0)
+
+    def test_sensor_gaps(self):
+        # The driver dropped sensor frames 12, 13 and 16 although the ring got every frame it delivered
+        self.put(*(self.frame(i, sensor_sequence=s) for i, s in enumerate((10, 11, 14, 15))))
+        burst = read_burst(self.ring, 4, after_seq=-1, timeout=0.01)
+        self.assertEqual(burst.gaps, [])
+        self.assertEqual(burst.sensor_gaps(), [(12, 2)])
+        self.assertEqual(burst.summary()['sensor_gaps'], [(12, 2)])
+        # Backends without a frame counter report -1, which is not a gap
+        self.setUp()
+        self.put(*(self.frame(i, sensor_sequence=-1) for i in range(2)), self.frame(2, sensor_sequence=5))
+        self.assertEqual(read_burst(self.ring, 3, after_seq=-1, timeout=0.01).sensor_gaps(), [])
+
+    def test_after_seq_older_than_ring(self):
+        self.put(*(self.frame(i) for i in range(10)))
+        # Frames 1..5 were overwritten before the burst started
+        burst = read_burst(self.ring, 3, after_seq=0, timeout=0.01)
+        self.assertEqual(burst.gaps, [(1, 5)])
+        self.assertEqual(list(burst.table['sequence']), [6, 7, 8])
+        self.assertEqual(list(burst.table['sensor_timestamp']), [6000, 7000, 8000])
+
+    def test_overrun(self):
+        # The producer fills the whole ring while the burst is copying its first frame
+        from camera.captures.image import CapturedImage
+        test = self
+        class Slow(CapturedImage):
+            __slots__ = ()
+            def to_grayscale(self, reduce=1):
+                if self.metadata['SensorSequence'] == 0:
+                    test.put(*(test.frame(i) for i in range(2, 8)))
+                return super().to_grayscale(reduce)
+        first = self.frame(0)
+        self.put(Slow(first.frame, first.metadata, 'raw', 8, 6), self.frame(1))
+        burst = read_burst(self.ring, 4, after_seq=-1, timeout=0.01)
+        self.assertEqual(list(burst.table['sequence']), [0, 4, 5, 6])
+        self.assertEqual(burst.gaps, [(1, 3)])
+        self.assertEqual(burst.summary()['gaps'], [(1, 3)])
+
+    def test_roi(self):
+        self.put(*(self.frame(i) for i in range(2)))
+        burst = read_burst(self.ring, 2, after_seq=-1, roi=(2, 1, 3, 4), timeout=0.01)
+        self.assertEqual(burst.frames.shape, (2, 4, 3))
+        full = np.frombuffer(self.frame(1).frame, np.uint8).reshape((6, 8))
+        np.testing.assert_array_equal(burst.frames[1], full[1:5, 2:5])
+
+    def test_shape_change(self):
+        self.put(self.frame(0), self.frame(1, width=4))
+        with self.assertRaises(ValueError):
+            read_burst(self.ring, 2, after_seq=-1, timeout=0.01)
+
+    def test_npz(self):
+        self.put(*(self.frame(i) for i in range(10)))
+        data = np.load(io.BytesIO(read_burst(self.ring, 2, after_seq=0, timeout=0.01).to_npz()))
+        self.assertEqual(data['frames'].shape, (2, 6, 8))
+        self.assertEqual(data['gaps'].tolist(), [[1, 5]])
+        self.assertEqual(list(data['metadata']['sequence']), [6, 7])
+
+if __name__ == '__main__':
+    unittest.main()
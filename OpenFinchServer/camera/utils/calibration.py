@@ -0,0 +1,217 @@
+import os
+import json
+import math
+import time
+import logging
+import threading
+import numpy as np
+
+from camera.utils.accumulator import FrameAccumulator
+
+CALIBRATION_KINDS = ('dark', 'flat')
+
+class CalibrationStore:
+    """
+    Dark and flat frames, each the mean of N frames, kept as float32 .npy
+    files in the directory `path` and keyed by exposure time, analogue gain
+    and sensor ROI. `calibrations.json` indexes them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = []
+        self.images = {}  # file name -> loaded image
+        index_path = os.path.join(path, 'calibrations.json')
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+
+    def entries(self, kind=None):
+        with self.lock:
+            return [dict(entry) for entry in self.index if kind is None or entry['kind'] == kind]
+
+    def save(self, kind, image, exposure_time, analogue_gain, roi=None, frames=0):
+        if kind not in CALIBRATION_KINDS:
+            raise ValueError(f"Invalid calibration kind '{kind}'. Choose one of {CALIBRATION_KINDS}.")
+        roi = list(roi) if roi is not None else None
+        name = (f"{kind}_{int(exposure_time)}us_{analogue_gain:.2f}x_"
+                f"{'-'.join(map(str, roi)) if roi else 'full'}.npy")
+        entry = {
+            'kind': kind,
+            'file': name,
+            'exposure_time': int(exposure_time),
+            'analogue_gain': float(analogue_gain),
+            'roi': roi,
+            'shape': list(image.shape),
+            'frames': frames,
+            'created': time.time(),
+        }
+        image = image.astype(np.float32, copy=False)
+        os.makedirs(self.path, exist_ok=True)
+        np.save(os.path.join(self.path, name), image)
+        with self.lock:
+            # A new calibration with the same key replaces the old one
+            self.index = [e for e in self.index if e['file'] != name] + [entry]
+            self.images[name] = image
+            tmp = os.path.join(self.path, 'calibrations.json.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(self.index, f, indent=1)
+            os.replace(tmp, os.path.join(self.path, 'calibrations.json'))
+        logging.info(f"CalibrationStore saved {name} ({frames} frames)")
+        return entry
+
+    def load(self, entry):
+        with self.lock:
+            image = self.images.get(entry['file'])
+            if image is None:
+                image = self.images[entry['file']] = np.load(os.path.join(self.path, entry['file']))
+            return image
+
+    def nearest(self, kind, exposure_time, analogue_gain, roi=None, shape=None):
+        """
+        The entry of `kind` for this ROI and frame shape whose exposure time
+        and gain are closest on a log scale, or None if there is none.
+        """
+        roi = list(roi) if roi is not None else None
+        def distance(entry):
+            return (abs(math.log(max(entry['exposure_time'], 1) / max(exposure_time, 1))) +
+                    abs(math.log(max(entry['analogue_gain'], 1e-3) / max(analogue_gain, 1e-3))))
+        candidates = [entry for entry in self.entries(kind)
+                      if entry['roi'] == roi and (shape is None or tuple(entry['shape']) == tuple(shape))]
+        return min(candidates, key=distance) if candidates else None
+
+def capture_calibration(frame_ring, n, timeout=2.0):
+    """
+    The float32 mean luma of the next `n` frames in `frame_ring`, with the
+    exposure time and analogue gain of the first one. Raises ValueError if
+    the controls change during the capture or frames stop arriving.
+    """
+    accumulator = FrameAccumulator(frame_ring, n=n, mode='mean')
+    reader = frame_ring.reader()
+    controls = None
+    while True:
+        item = reader.get(timeout)
+        if item is None:
+            raise ValueError(f"Calibration got {accumulator.count} of {n} frames")
+        seq, frame = item
+        metadata = frame.metadata
+        frame_controls = (metadata.get('ExposureTime', 0), metadata.get('AnalogueGain', 1.0))
+        if controls is None:
+            controls = frame_controls
+        elif frame_controls != controls:
+            raise ValueError(f"Controls changed from {controls} to {frame_controls} during calibration")
+        result = accumulator.add(frame.to_grayscale(), seq)
+        if result is not None:
+            image, info = result
+            return image, controls[0], controls[1]
+
+class CalibrationStage:
+    """
+    A FramePipeline stage that subtracts the nearest dark frame and divides
+    by the nearest flat field, in place. The correction for the frame's
+    exposure time, gain and the sensor `roi` is looked up and prepared once,
+    and again only when those change; each worker thread reuses one float32
+    scratch buffer. The owner updates `roi` when the sensor crop changes.
+    """
+
+    def __init__(self, store, roi=None, dark=True, flat=True):
+        self.store = store
+        self.roi = roi
+        self.dark = dark
+        self.flat = flat
+        self.key = None
+        self.correction = (None, None, None)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _prepare(self, exposure_time, analogue_gain, roi, shape):
+        # (dark, gain map, description) for these settings
+        dark = gain = None
+        used = {}
+        if self.dark:
+            entry = self.store.nearest('dark', exposure_time, analogue_gain, roi, shape)
+            if entry is not None:
+                dark = self.store.load(entry)
+                used['dark'] = entry['file']
+        if self.flat:
+            entry = self.store.nearest('flat', exposure_time, analogue_gain, roi, shape)
+            if entry is not None:
+                flat = self.store.load(entry).copy()
+                # The flat's own dark level, so the gain map measures illumination only
+                flat_dark = self.store.nearest('dark', entry['exposure_time'], entry['analogue_gain'], roi, shape)
+                if flat_dark is not None:
+                    flat -= self.store.load(flat_dark)
+                np.maximum(flat, 1.0, out=flat)
+                gain = np.float32(flat.mean()) / flat
+                used['flat'] = entry['file']
+        logging.info(f"CalibrationStage for {exposure_time}us, {analogue_gain:.2f}x, roi {roi}: {used or 'none'}")
+        return dark, gain, used
+
+    def calibrations(self):
+        """The files applied to the latest frame."""
+        return self.correction[2]
+
+    def __call__(self, img, metadata):
+        key = (metadata.get('ExposureTime', 0), metadata.get('AnalogueGain', 1.0), self.roi, img.shape)
+        with self.lock:
+            if key != self.key:
+                self.correction = self._prepare(*key)
+                self.key = key
+            dark, gain, used = self.correction
+        if dark is None and gain is None:
+            return img
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None or buffer.shape != img.shape:
+            buffer = self.local.buffer = np.empty(img.shape, dtype=np.float32)
+        buffer[...] = img
+        if dark is not None:
+            buffer -= dark
+        if gain is not None:
+            buffer *= gain
+        buffer += 0.5
+        np.clip(buffer, 0, 255, out=buffer)
+        np.copyto(img, buffer, casting='unsafe')
+        return img
+
+import unittest
+import tempfile
+
+class TestCalibrationStage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = CalibrationStore(self.tmp.name)
+        self.metadata = {'ExposureTime': 1000, 'AnalogueGain': 2.0}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_dark_and_flat(self):
+        rng = np.random.default_rng(0)
+        dark = rng.uniform(5, 15, (32, 48)).astype(np.float32)
+        illumination = rng.uniform(0.5, 1.5, (32, 48)).astype(np.float32)
+        flat_dark = np.full((32, 48), 10, np.float32)
+        self.store.save('dark', dark, 1000, 2.0)
+        self.store.save('dark', flat_dark, 20000, 1.0)
+        self.store.save('flat', flat_dark + 100 * illumination, 20000, 1.0)
+        scene = rng.uniform(20, 120, (32, 48)).astype(np.float32)
+        img = np.round(scene * illumination + dark).astype(np.uint8)
+        stage = CalibrationStage(self.store)
+        out = stage(img.copy(), self.metadata)
+        gain = illumination.mean() / illumination
+        expected = np.clip((img - dark) * gain + 0.5, 0, 255).astype(np.uint8)
+        self.assertTrue(np.array_equal(out, expected))
+        self.assertEqual(set(stage.calibrations()), {'dark', 'flat'})
+
+    def test_roi_and_shape_select_calibration(self):
+        self.store.save('dark', np.full((8, 8), 4, np.float32), 1000, 2.0, roi=(0, 0, 8, 8))
+        img = np.full((8, 8), 10, np.uint8)
+        stage = CalibrationStage(self.store)
+        self.assertTrue((stage(img.copy(), self.metadata) == 10).all())
+        stage.roi = (0, 0, 8, 8)
+        self.assertTrue((stage(img.copy(), self.metadata) == 6).all())
+        self.assertTrue((stage(np.full((4, 4), 10, np.uint8), self.metadata) == 10).all())
+
+if __name__ == '__main__':
+    unittest.main()
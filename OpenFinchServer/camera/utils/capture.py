@@ -1,21 +1,7 @@
-import cv2
-import numpy as np
-from screeninfo import get_monitors
-import v4l2py
-from picamera2 import Picamera2, Preview, Metadata
-import libcamera
-from libcamera import controls
-import time
-import os
-import io
 import logging
-import subprocess
-import threading
-import queue
 from utils.frame_rate_monitor import FrameRateMonitor
-from camera.captures.v4l2 import V4L2CapturedImage, V4L2CameraController
-from camera.captures.picamera2 import Picamera2CapturedImage, Picamera2Controller
 from camera.captures.abstract import AbstractCameraController
+from camera.utils.burst import read_burst
 
 class CaptureController:
     # def __init__(self, device_id=0, capture_raw=False, controls={}):
@@ -42,6 +28,10 @@ class CaptureController:
     def get_reader_fps(self):
         return self.camera_controller.reader_fps.get_fps()
 
+    def get_capture_monitor(self):
+        # Backends replaying recorded frames have no live capture to monitor
+        return getattr(self.camera_controller, 'capture_monitor', None)
+
     def capture_frame(self, blocking=True):
         frame = self.camera_controller.capture_frame(blocking=blocking)
         if frame is not None:
@@ -60,6 +50,10 @@ class CaptureController:
         frame = self.capture_frame(blocking=blocking)
         return frame.to_grayscale()
 
+    def capture_burst(self, n, after_seq=None, roi=None, timeout=2.0):
+        """N consecutive frames from the camera's FrameRing as one Burst, see read_burst()."""
+        return read_burst(self.camera_controller.frame_ring, n, after_seq, roi, timeout)
+
     def open(self):
         self.camera_controller.open()
 
@@ -0,0 +1,193 @@
+import time
+import logging
+import collections
+import concurrent.futures
+import numpy as np
+
+from camera.utils.recorder import write_recording
+from camera.utils.ring import FrameRingFollower
+
+def _frame_time(frame):
+    return frame.metadata.get('SensorTimestamp', time.clock_gettime_ns(time.CLOCK_BOOTTIME))
+
+# Statistics computed per frame and handed to the trigger predicate
+
+def roi_sum(roi=None):
+    """Sum of the grayscale image over roi = (x, y, width, height), or the whole frame."""
+    def statistic(frame):
+        img = frame.to_grayscale()
+        if roi is not None:
+            x, y, w, h = roi
+            img = img[y:y + h, x:x + w]
+        return {'roi_sum': int(img.sum(dtype=np.int64))}
+    return statistic
+
+def saturation_count(level=255):
+    def statistic(frame):
+        return {'saturation_count': int(np.count_nonzero(frame.to_grayscale() >= level))}
+    return statistic
+
+# Trigger predicates: called as predicate(metadata, stats, previous_stats)
+
+def above(key, threshold):
+    """Fires when metadata or statistic `key` exceeds `threshold`."""
+    def predicate(metadata, stats, previous):
+        value = stats.get(key, metadata.get(key))
+        return value is not None and value > threshold
+    return predicate
+
+def jump(key, threshold):
+    """Fires when statistic or metadata `key` rises by more than `threshold` from one frame to the next."""
+    def predicate(metadata, stats, previous):
+        value = stats.get(key, metadata.get(key))
+        if value is None or previous is None or key not in previous:
+            return False
+        return value - previous[key] > threshold
+    return predicate
+
+class EventRecorder(FrameRingFollower):
+    """
+    Keeps the last `pre_seconds` of frames from a FrameRing in memory
+    (never more than `max_bytes`), and when `predicate` fires writes them,
+    together with the following `post_seconds` of frames, to a recording
+    <path>_<n> that RecordingReader and ReplayCameraController can open.
+
+    `statistic(frame)` optionally computes a dict of per-frame values (e.g.
+    roi_sum()) that is passed to the predicate along with the frame
+    metadata and the previous frame's values. Recordings are written on a
+    background thread; triggers while an event is still collecting its
+    post-trigger frames are counted in `ignored`. An event that would
+    exceed `max_bytes` is cut short.
+    """
+
+    def __init__(self, frame_ring, path, predicate, statistic=None, pre_seconds=2.0, post_seconds=2.0,
+                 max_bytes=256 << 20, max_pending=2):
+        super().__init__(frame_ring)
+        self.path = path
+        self.predicate = predicate
+        self.statistic = statistic
+        self.pre_ns = int(pre_seconds * 1e9)
+        self.post_ns = int(post_seconds * 1e9)
+        self.max_bytes = max_bytes
+        self.max_pending = max_pending
+        self.buffer = collections.deque()  # (seq, frame, nbytes)
+        self.buffered_bytes = 0
+        self.events = 0
+        self.ignored = 0
+        self.discarded = 0
+        self.pending = []
+        self.previous = None  # the previous frame's statistics
+        self.trigger = None  # (seq, time) of the event collecting post-trigger frames
+
+    def start(self):
+        self.pool = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="EventWriter")
+        super().start()
+        logging.info(f"EventRecorder watching for events, writing to {self.path}_*")
+
+    def stop(self):
+        if not super().stop():
+            return
+        self.pool.shutdown()
+        logging.info(f"EventRecorder recorded {self.events} events, ignored {self.ignored} triggers, "
+                     f"discarded {self.discarded} events, dropped {self.dropped} frames")
+
+    def _buffer(self, seq, frame):
+        nbytes = memoryview(frame.to_bytes()).nbytes
+        self.buffer.append((seq, frame, nbytes))
+        self.buffered_bytes += nbytes
+        oldest = _frame_time(frame) - self.pre_ns
+        while self.buffer and (self.buffered_bytes > self.max_bytes or _frame_time(self.buffer[0][1]) < oldest):
+            _, _, n = self.buffer.popleft()
+            self.buffered_bytes -= n
+
+    def _flush_event(self, trigger_seq):
+        self.pending = [f for f in self.pending if not f.done()]
+        if len(self.pending) >= self.max_pending:
+            # The disk can't keep up; don't let queued events grow memory without bound
+            logging.warning(f"EventRecorder discarding event at frame {trigger_seq}, {len(self.pending)} still being written")
+            self.discarded += 1
+            return
+        frames = [(seq, frame) for seq, frame, _ in self.buffer]
+        path = f"{self.path}_{self.events:04d}"
+        self.events += 1
+        self.pending.append(self.pool.submit(self._write_event, path, frames, trigger_seq))
+
+    def _write_event(self, path, frames, trigger_seq):
+        try:
+            write_recording(path, frames)
+            logging.info(f"EventRecorder wrote {len(frames)} frames around frame {trigger_seq} to {path}")
+        except Exception as e:
+            logging.exception(f"EventRecorder writing {path}")
+
+    def process(self, seq, frame):
+        try:
+            stats = self.statistic(frame) if self.statistic is not None else {}
+            fired = self.predicate(frame.metadata, stats, self.previous)
+            self.previous = stats
+        except Exception as e:
+            logging.exception("EventRecorder predicate")
+            fired = False
+
+        if self.trigger is None:
+            # Keep the pre-trigger window only
+            self._buffer(seq, frame)
+            if fired:
+                self.trigger = (seq, _frame_time(frame))
+                logging.info(f"EventRecorder triggered at frame {seq}")
+        else:
+            # Collecting the post-trigger window: nothing is evicted, but
+            # the event is cut short rather than exceed max_bytes
+            nbytes = memoryview(frame.to_bytes()).nbytes
+            self.buffer.append((seq, frame, nbytes))
+            self.buffered_bytes += nbytes
+            if fired:
+                self.ignored += 1
+            if _frame_time(frame) - self.trigger[1] >= self.post_ns or self.buffered_bytes >= self.max_bytes:
+                self._flush_event(self.trigger[0])
+                self.buffer.clear()
+                self.buffered_bytes = 0
+                self.trigger = None
+
+import os
+import unittest
+import tempfile
+
+class TestEventRecorder(unittest.TestCase):
+
+    def record(self, flashes, n=40, **kwargs):
+        """The sequence numbers of each event recorded from `n` frames 10 ms apart."""
+        from camera.captures.image import CapturedImage
+        from camera.utils.ring import FrameRing
+        from camera.utils.recorder import RecordingReader
+        ring = FrameRing(capacity=n)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'event')
+            recorder = EventRecorder(ring, path, above('Flash', 0), **kwargs)
+            recorder.start()
+            for i in range(n):
+                ring.put(CapturedImage(bytes(100), {'SensorTimestamp': i * 10_000_000, 'Flash': int(i in flashes)}, 'raw', 10, 10))
+            deadline = time.monotonic() + 5
+            while recorder.reader.pending() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            recorder.stop()
+            self.recorder = recorder
+            events = []
+            for e in range(recorder.events):
+                with RecordingReader(f"{path}_{e:04d}") as reader:
+                    events.append(list(reader.index['sequence']))
+            return events
+
+    def test_pre_and_post_trigger_window(self):
+        events = self.record({20, 22, 38}, pre_seconds=0.05, post_seconds=0.03)
+        # 50 ms before frame 20 to 30 ms after it; frame 22 fires during the
+        # post-trigger window and is ignored; frame 38 has no time to finish
+        self.assertEqual(events, [list(range(15, 24))])
+        self.assertEqual(self.recorder.ignored, 1)
+
+    def test_pre_trigger_window_is_bounded_by_bytes(self):
+        # Three 100 byte frames fit before the trigger, and the event is cut short at the fourth
+        events = self.record({20}, pre_seconds=0.05, post_seconds=0.05, max_bytes=350)
+        self.assertEqual(events, [[18, 19, 20, 21]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import io
+import logging
+import threading
+import numpy as np
+from numpy.lib.recfunctions import repack_fields
+
+from camera.utils.ring import FrameRingFollower
+
+HISTORY_DTYPE = np.dtype([
+    ('frame_number', '<i8'),        # frame ring sequence number
+    ('sensor_timestamp', '<i8'),    # ns
+    ('exposure_time', '<i4'),       # µs
+    ('analogue_gain', '<f4'),
+    ('led_time', '<i4'),            # µs, TriggerConfig.LED_TIME when the frame was captured
+    ('illumination_mode', '<u2'),   # TriggerConfig.ILLUMINATION_MODE as an int (e.g. 0o421)
+    ('led_delay', '<f4'),           # measured delay of the first LED pulse after the trigger, µs
+    ('mean', '<f4'),                # mean luma
+    ('saturated', '<f4'),           # fraction of pixels at or above the saturation level
+])
+
+class MetadataHistory(FrameRingFollower):
+    """
+    Fixed-capacity columnar history of per-frame metadata. Appending writes
+    one row of preallocated NumPy columns; once full the oldest rows are
+    overwritten.
+
+    start() follows a FrameRing so that every captured frame gets a row,
+    not only those a client happened to be sent. Frame statistics are
+    computed from luma decoded at 1/`stats_reduce` resolution, which for
+    JPEG is much cheaper than a full decode.
+    """
+
+    def __init__(self, capacity=1 << 17, stats_reduce=4, saturation_level=255):
+        super().__init__(None)
+        self.capacity = capacity
+        self.rows = np.zeros(capacity, dtype=HISTORY_DTYPE)
+        self.head = 0  # total rows appended
+        self.lock = threading.Lock()
+        self.stats_reduce = stats_reduce
+        self.saturation_level = saturation_level
+        self.config = None
+
+    def __len__(self):
+        return min(self.head, self.capacity)
+
+    def start(self, frame_ring, config=None):
+        """Append a row for every frame put in `frame_ring`, with LED settings from `config`."""
+        self.input_ring = frame_ring
+        self.config = config
+        super().start()
+
+    def stop(self):
+        if super().stop():
+            logging.info(f"MetadataHistory recorded {self.head} frames, dropped {self.dropped}")
+
+    def frame_stats(self, frame):
+        img = frame.to_grayscale(self.stats_reduce)
+        return {
+            'mean': float(img.mean()),
+            'saturated': np.count_nonzero(img >= self.saturation_level) / img.size,
+        }
+
+    def process(self, seq, frame):
+        self.append(seq, frame.metadata, self.config, self.frame_stats(frame))
+
+    def append(self, frame_number, metadata, config=None, stats={}):
+        delays = metadata.get('LedDelays')
+        led_delay = min((t for times in delays.values() for t in times), default=np.nan) if delays else np.nan
+        try:
+            mode = int(config.ILLUMINATION_MODE, 8) if config is not None else 0
+        except ValueError:
+            mode = 0
+        row = (
+            frame_number,
+            metadata.get('SensorTimestamp', 0),
+            metadata.get('ExposureTime', 0),
+            metadata.get('AnalogueGain', np.nan),
+            config.LED_TIME if config is not None else 0,
+            mode,
+            led_delay,
+            stats.get('mean', np.nan),
+            stats.get('saturated', np.nan),
+        )
+        with self.lock:
+            self.rows[self.head % self.capacity] = row
+            self.head += 1
+
+    def ordered(self):
+        """All rows, oldest first."""
+        with self.lock:
+            if self.head <= self.capacity:
+                return self.rows[:self.head].copy()
+            start = self.head % self.capacity
+            return np.concatenate((self.rows[start:], self.rows[:start]))
+
+    def query(self, columns=None, start=None, stop=None, by='frame_number'):
+        """
+        Rows with start <= `by` < stop, restricted to `columns`. `by` is
+        'frame_number' or 'sensor_timestamp'.
+        """
+        if by not in ('frame_number', 'sensor_timestamp'):
+            raise ValueError(f"Can't select rows by '{by}'")
+        rows = self.ordered()
+        # Both keys increase with the row order, so the range is a slice
+        keys = rows[by]
+        lo = 0 if start is None else np.searchsorted(keys, start, 'left')
+        hi = len(rows) if stop is None else np.searchsorted(keys, stop, 'left')
+        rows = rows[lo:hi]
+        if columns:
+            unknown = [c for c in columns if c not in HISTORY_DTYPE.names]
+            if unknown:
+                raise ValueError(f"Unknown history columns {unknown}")
+            rows = repack_fields(rows[list(columns)])
+        return rows
+
+    def query_npy(self, *args, **kwargs):
+        """query() serialized in .npy format."""
+        buf = io.BytesIO()
+        np.save(buf, self.query(*args, **kwargs), allow_pickle=False)
+        return buf.getvalue()
+
+import unittest
+
+class TestMetadataHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.history = MetadataHistory(capacity=8)
+        # Sequence numbers 100.. with 1 ms between frames; 12 rows wrap the 8 row buffer
+        for i in range(12):
+            self.history.append(100 + i, {'SensorTimestamp': 1_000_000 * i, 'ExposureTime': 10 * i},
+                                stats={'mean': float(i)})
+
+    def test_wrap_around(self):
+        self.assertEqual(len(self.history), 8)
+        rows = self.history.query()
+        self.assertEqual(list(rows['frame_number']), list(range(104, 112)))
+        self.assertEqual(list(rows['mean']), [float(i) for i in range(4, 12)])
+        # Ranges reaching past either end are clipped to what is still held
+        self.assertEqual(list(self.history.query(start=102, stop=106)['frame_number']), [104, 105])
+        self.assertEqual(list(self.history.query(start=110, stop=200)['frame_number']), [110, 111])
+        self.assertEqual(len(self.history.query(start=0, stop=104)), 0)
+
+    def test_by_sensor_timestamp(self):
+        rows = self.history.query(start=5_500_000, stop=8_000_000, by='sensor_timestamp')
+        self.assertEqual(list(rows['frame_number']), [106, 107])
+        with self.assertRaises(ValueError):
+            self.history.query(by='exposure_time')
+
+    def test_columns(self):
+        rows = self.history.query(['frame_number', 'exposure_time'], start=110)
+        self.assertEqual(rows.dtype.names, ('frame_number', 'exposure_time'))
+        self.assertEqual(rows.tolist(), [(110, 100), (111, 110)])
+        with self.assertRaises(ValueError):
+            self.history.query(['frame_number', 'bogus'])
+        blob = self.history.query_npy(['mean'], start=111)
+        np.testing.assert_array_equal(np.load(io.BytesIO(blob))['mean'], [11.0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import time
+import logging
+import collections
+
+# Frame metadata keys shared by all camera backends. Picamera2 passes
+# libcamera's metadata through, which already uses these names for what it
+# has; the other backends fill in the same keys. All timestamps are in
+# nanoseconds of CLOCK_BOOTTIME, libcamera's SensorTimestamp clock.
+SENSOR_TIMESTAMP = 'SensorTimestamp'    # when the sensor captured the frame (V4L2: the buffer timestamp)
+SENSOR_SEQUENCE = 'SensorSequence'      # driver frame counter; a gap means the driver dropped frames
+DEQUEUE_TIMESTAMP = 'DequeueTimestamp'  # when the backend's reader thread received the frame
+
+def boottime_ns():
+    return time.clock_gettime_ns(time.CLOCK_BOOTTIME)
+
+def monotonic_to_boottime(ns):
+    """Convert a CLOCK_MONOTONIC time, as V4L2 drivers timestamp buffers, to CLOCK_BOOTTIME."""
+    return ns + boottime_ns() - time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+
+def buffer_metadata(buf):
+    """Shared-schema metadata from a dequeued v4l2_buffer."""
+    dequeued = boottime_ns()
+    timestamp = buf.timestamp.secs * 1_000_000_000 + buf.timestamp.usecs * 1000
+    return {
+        SENSOR_TIMESTAMP: monotonic_to_boottime(timestamp),
+        SENSOR_SEQUENCE: buf.sequence,
+        DEQUEUE_TIMESTAMP: dequeued,
+    }
+
+class CaptureMonitor:
+    """
+    Per-backend capture statistics from frame metadata: latency from
+    capture to the reader dequeuing the frame, latency from capture to
+    delivery to clients, and frames the driver dropped, found as gaps in
+    SensorSequence.
+    """
+
+    def __init__(self, label, period=10.0, window=256):
+        self.label = label
+        self.period = period
+        self.frames = 0
+        self.dropped = 0
+        self.last_sequence = None
+        self.dequeue_latency = collections.deque(maxlen=window)
+        self.delivery_latency = collections.deque(maxlen=window)
+        self.last_report = time.monotonic()
+        self.reported_drops = 0
+
+    def update(self, metadata):
+        """Called by the reader for every frame it dequeues."""
+        self.frames += 1
+        sequence = metadata.get(SENSOR_SEQUENCE)
+        if sequence is not None:
+            if self.last_sequence is not None and sequence > self.last_sequence + 1:
+                self.dropped += sequence - self.last_sequence - 1
+            # A lower sequence means the stream was restarted
+            self.last_sequence = sequence
+        if SENSOR_TIMESTAMP in metadata and DEQUEUE_TIMESTAMP in metadata:
+            self.dequeue_latency.append(metadata[DEQUEUE_TIMESTAMP] - metadata[SENSOR_TIMESTAMP])
+        if self.dropped > self.reported_drops and time.monotonic() - self.last_report > self.period:
+            logging.warning(f"{self.label}: driver dropped {self.dropped - self.reported_drops} frames "
+                            f"({self.dropped} since start)")
+            self.reported_drops = self.dropped
+            self.last_report = time.monotonic()
+
+    def delivered(self, metadata):
+        """Called when the frame is handed to clients."""
+        if SENSOR_TIMESTAMP in metadata:
+            self.delivery_latency.append(boottime_ns() - metadata[SENSOR_TIMESTAMP])
+
+    def stats(self):
+        def summary(latencies):
+            if not latencies:
+                return None
+            values = list(latencies)
+            return {'mean_ms': sum(values) / len(values) / 1e6, 'max_ms': max(values) / 1e6}
+        return {
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'dequeue_latency': summary(self.dequeue_latency),
+            'delivery_latency': summary(self.delivery_latency),
+        }
@@ -0,0 +1,227 @@
+import logging
+import threading
+from PIL import Image
+
+from camera.utils.ring import FrameRingFollower
+from camera.utils.metadata import SENSOR_SEQUENCE
+
+# Colour fields in the order the SLM shows them (and the multiplex script triggers them)
+FIELDS = ('blue', 'green', 'red')
+
+def field_starts(config):
+    return {
+        'blue': config.BLU_START,
+        'green': config.GRN_START,
+        'red': config.RED_START,
+    }
+
+def frame_field(metadata, config, tolerance=500):
+    """
+    Identify which colour field illuminated a frame from its measured LED
+    delays (see TimingRecorder.annotate). Returns None if the frame has no
+    LED edges or they don't line up with any field.
+    """
+    delays = metadata.get('LedDelays')
+    if not delays:
+        return None
+    times = [t for led_times in delays.values() for t in led_times]
+    if not times:
+        return None
+    first = min(times)
+    for field, start in field_starts(config).items():
+        if abs(first - (config.LED_TIME + start)) <= tolerance:
+            return field
+    return None
+
+def expected_fields(config):
+    """The fields that have at least one LED assigned in ILLUMINATION_MODE."""
+    mode = config.ILLUMINATION_MODE
+    # ILLUMINATION_MODE digits are R, G, B fields
+    digits = {'red': mode[0], 'green': mode[1], 'blue': mode[2]}
+    return [field for field in FIELDS if digits[field] != '0']
+
+class SubframeDemultiplexer(FrameRingFollower):
+    """
+    Groups frames captured in multiplexed illumination mode back into one
+    measurement per SLM pattern: a dict mapping each colour field to the
+    frame that was lit during it.
+
+    Once started it follows `frame_ring`, so it sees every frame the
+    camera captured rather than only those delivered to clients. Frames
+    arrive in field order (B, G, R), and a set is emitted once every
+    expected field has been seen in consecutive frames. A set broken by an
+    unidentified or out of order frame, or by a gap in the ring sequence
+    or in SensorSequence, is discarded rather than mixing patterns.
+    Completed sets are published in `latest`, and `completed` counts them.
+    """
+
+    def __init__(self, frame_ring, config):
+        super().__init__(frame_ring)
+        self.config = config
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last = None  # (ring seq, SensorSequence) of the last frame added
+        self.completed = 0
+        self.discarded = 0
+        self.latest = None
+
+    def stop(self):
+        if super().stop():
+            logging.info(f"SubframeDemultiplexer completed {self.completed} sets, discarded {self.discarded}, "
+                         f"dropped {self.dropped} frames")
+
+    def _discard(self):
+        if self.pending:
+            self.discarded += 1
+        self.pending = {}
+
+    def reset(self):
+        with self.lock:
+            self._discard()
+            self.last = None
+
+    def _follows(self, seq, sequence):
+        # Whether the frame comes right after the last one, as far as we can tell
+        if self.last is None:
+            return True
+        last_seq, last_sequence = self.last
+        if seq is not None and last_seq is not None and seq != last_seq + 1:
+            return False
+        if sequence is not None and last_sequence is not None and sequence != last_sequence + 1:
+            return False
+        return True
+
+    def add(self, frame, seq=None):
+        """Add the frame with ring sequence number `seq`; returns the set it completes, if any."""
+        fields = expected_fields(self.config)
+        field = frame_field(frame.metadata, self.config)
+        sequence = frame.metadata.get(SENSOR_SEQUENCE)
+        with self.lock:
+            if not self._follows(seq, sequence):
+                # Frames are missing in between, so the set in progress is incomplete
+                self._discard()
+            self.last = (seq, sequence)
+            if field not in fields:
+                logging.debug(f"SubframeDemultiplexer: couldn't identify field of frame")
+                self._discard()
+                return None
+            if field in self.pending or any(FIELDS.index(f) > FIELDS.index(field) for f in self.pending):
+                # Out of order, so the previous set is missing a frame
+                self._discard()
+            self.pending[field] = frame
+            if not all(f in self.pending for f in fields):
+                return None
+            result = self.pending
+            self.pending = {}
+            self.completed += 1
+            self.latest = result
+            return result
+
+    def process(self, seq, frame):
+        self.add(frame, seq)
+
+def pack_field_patterns(blue=None, green=None, red=None):
+    """
+    Pack up to three 8 bit SLM patterns into the channels of one RGB image,
+    so each is shown in its own colour field. Missing patterns are black.
+
+    Note that the framebuffer is RGB565, so the red and blue patterns keep 5
+    bits and the green one 6.
+    """
+    patterns = {'red': red, 'green': green, 'blue': blue}
+    size = None
+    for img in patterns.values():
+        if img is not None:
+            size = img.size
+            break
+    if size is None:
+        raise ValueError("pack_field_patterns needs at least one pattern")
+    channels = []
+    for name in ('red', 'green', 'blue'):
+        img = patterns[name]
+        if img is None:
+            channels.append(Image.new('L', size))
+        elif img.size != size:
+            raise ValueError(f"{name} pattern is {img.size}, expected {size}")
+        else:
+            channels.append(img.convert('L'))
+    return Image.merge('RGB', channels)
+
+import time
+import unittest
+
+class TestSubframeDemultiplexer(unittest.TestCase):
+
+    def setUp(self):
+        from gpio.sequencer import TriggerConfig
+        self.config = TriggerConfig(ILLUMINATION_MODE='421')
+        self.starts = field_starts(self.config)
+
+    def frame(self, field, sequence=None):
+        from camera.captures.image import CapturedImage
+        metadata = {}
+        if field is not None:
+            metadata['LedDelays'] = {'red': [self.config.LED_TIME + self.starts[field] + 3]}
+        if sequence is not None:
+            metadata['SensorSequence'] = sequence
+        return CapturedImage(b'', metadata, field or 'none')
+
+    def test_complete_set(self):
+        demux = SubframeDemultiplexer(None, self.config)
+        self.assertIsNone(demux.add(self.frame('blue'), 0))
+        self.assertIsNone(demux.add(self.frame('green'), 1))
+        subframes = demux.add(self.frame('red'), 2)
+        self.assertEqual({field: frame.format for field, frame in subframes.items()},
+                         {'blue': 'blue', 'green': 'green', 'red': 'red'})
+        self.assertEqual((demux.completed, demux.discarded), (1, 0))
+        self.assertIs(demux.latest, subframes)
+
+    def test_ring_gap_discards_set(self):
+        # Blue from one cycle followed by green and red of the next isn't a set
+        demux = SubframeDemultiplexer(None, self.config)
+        demux.add(self.frame('blue'), 0)
+        self.assertIsNone(demux.add(self.frame('green'), 4))
+        self.assertIsNone(demux.add(self.frame('red'), 5))
+        self.assertEqual((demux.completed, demux.discarded), (0, 1))
+        for seq, field in enumerate(('blue', 'green', 'red'), 6):
+            subframes = demux.add(self.frame(field), seq)
+        self.assertEqual(list(subframes), ['blue', 'green', 'red'])
+
+    def test_sensor_sequence_gap_discards_set(self):
+        # The ring saw every frame, but the driver dropped some
+        demux = SubframeDemultiplexer(None, self.config)
+        demux.add(self.frame('blue', 10), 0)
+        self.assertIsNone(demux.add(self.frame('green', 14), 1))
+        self.assertIsNone(demux.add(self.frame('red', 15), 2))
+        self.assertEqual((demux.completed, demux.discarded), (0, 1))
+
+    def test_out_of_order_and_unidentified(self):
+        demux = SubframeDemultiplexer(None, self.config)
+        demux.add(self.frame('blue'), 0)
+        demux.add(self.frame('red'), 1)
+        self.assertIsNone(demux.add(self.frame('green'), 2))
+        demux.add(self.frame(None), 3)
+        self.assertEqual((demux.completed, demux.discarded), (0, 2))
+        demux.add(self.frame('blue'), 4)
+        demux.reset()
+        self.assertEqual(demux.discarded, 3)
+        # After a reset the next frame starts afresh whatever its sequence number
+        demux.add(self.frame('blue'), 9)
+        demux.add(self.frame('green'), 10)
+        self.assertIsNotNone(demux.add(self.frame('red'), 11))
+
+    def test_follows_ring(self):
+        from camera.utils.ring import FrameRing
+        ring = FrameRing()
+        demux = SubframeDemultiplexer(ring, self.config)
+        demux.start()
+        for i in range(9):
+            ring.put(self.frame(FIELDS[i % 3], i))
+        deadline = time.monotonic() + 1
+        while demux.completed < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        demux.stop()
+        self.assertEqual((demux.completed, demux.discarded, demux.dropped), (3, 0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+import os
+import time
+import queue
+import logging
+import threading
+import collections
+import concurrent.futures
+import cv2
+import numpy as np
+
+from camera.captures.image import CapturedImage
+from camera.utils.ring import FrameRing, FrameRingFollower
+from camera.utils.binning import bin_image
+
+class ProcessedImage(CapturedImage):
+    """The 8 bit luma a FramePipeline produced from a captured frame, as a 2D array."""
+
+    __slots__ = ()
+
+    def __init__(self, array, metadata=None):
+        height, width = array.shape
+        super().__init__(array, metadata, 'raw', width, height, array.strides[0])
+
+    def _pixels(self):
+        return self.frame.reshape(-1)
+
+    def to_bytes(self):
+        return self.frame.data
+
+# Stages the server can build by name; each factory returns a stage(img, metadata) -> img
+stage_factories = {
+    'binning': lambda factor=2: lambda img, metadata: bin_image(img, int(factor), 'mean'),
+    'gaussian_blur': lambda sigma=1.0: lambda img, metadata: cv2.GaussianBlur(img, (0, 0), float(sigma)),
+    'median_blur': lambda ksize=3: lambda img, metadata: cv2.medianBlur(img, int(ksize)),
+}
+
+def make_stage(name, **params):
+    if name not in stage_factories:
+        raise ValueError(f"Unknown pipeline stage '{name}'. Choose one of {list(stage_factories)}.")
+    return stage_factories[name](**params)
+
+class FramePipeline(FrameRingFollower):
+    """
+    Follows a FrameRing and runs every frame's luma through a list of
+    stages on a pool of `workers` threads; NumPy and OpenCV release the
+    GIL, so stages of different frames run in parallel.
+
+    A stage is a callable stage(img, metadata) returning the processed
+    image, which may be `img` itself modified in place: each frame's luma
+    is copied once into a writable array before the first stage. The last
+    stage's output is clipped to 8 bits if needed.
+
+    At most `max_in_flight` frames are processed at once; beyond that the
+    pipeline stops reading and falls behind in the ring, and frames it
+    loses are counted in `dropped`. Results are published in capture
+    order, as ProcessedImages, to the pipeline's own `frame_ring` and, like
+    a camera backend, to `frame_queue` for capture_frame().
+    """
+
+    def __init__(self, frame_ring, workers=None, max_in_flight=None):
+        super().__init__(frame_ring)
+        self.workers = workers or os.cpu_count()
+        self.max_in_flight = max_in_flight or 2 * self.workers
+        self.frame_ring = FrameRing()
+        self.frame_queue = queue.Queue(maxsize=1)
+        # (name, stage) pairs, replaced as a whole so each frame sees one consistent list
+        self.stages = ()
+        self.timing = {}
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.errors = 0
+
+    def add_stage(self, name, stage, index=None):
+        with self.lock:
+            stages = list(self.stages)
+            if any(n == name for n, _ in stages):
+                raise ValueError(f"Pipeline already has a stage '{name}'")
+            stages.insert(len(stages) if index is None else index, (name, stage))
+            self.stages = tuple(stages)
+            self.timing[name] = [0, 0.0, 0.0]  # frames, total and max seconds
+
+    def remove_stage(self, name):
+        with self.lock:
+            self.stages = tuple((n, s) for n, s in self.stages if n != name)
+            self.timing.pop(name, None)
+
+    def stage_names(self):
+        return [name for name, _ in self.stages]
+
+    def stats(self):
+        with self.lock:
+            stages = {name: {'frames': frames,
+                             'mean_ms': 1e3 * total / frames if frames else 0,
+                             'max_ms': 1e3 * longest}
+                      for name, (frames, total, longest) in self.timing.items()}
+        return {
+            'stages': stages,
+            'processed': self.processed,
+            'errors': self.errors,
+            'dropped': self.dropped,
+            'workers': self.workers,
+        }
+
+    def start(self):
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="FramePipeline")
+        super().start()
+        logging.info(f"FramePipeline {self.stage_names()} on {self.workers} workers")
+
+    def stop(self):
+        if not super().stop():
+            return
+        self.pool.shutdown()
+        logging.info(f"FramePipeline processed {self.processed} frames, dropped {self.dropped}, {self.errors} errors")
+
+    def capture_frame(self, blocking=True):
+        if not blocking and self.frame_queue.empty():
+            return None
+        return self.frame_queue.get()
+
+    def _process(self, frame, stages):
+        # Runs on the pool
+        img = np.array(frame.to_grayscale())
+        for name, stage in stages:
+            tic = time.perf_counter()
+            img = stage(img, frame.metadata)
+            elapsed = time.perf_counter() - tic
+            with self.lock:
+                timing = self.timing.get(name)
+                if timing is not None:
+                    timing[0] += 1
+                    timing[1] += elapsed
+                    timing[2] = max(timing[2], elapsed)
+        if img.dtype != np.uint8:
+            img = np.clip(img, 0, 255, out=img if img.dtype.kind == 'f' else None).astype(np.uint8)
+        return ProcessedImage(np.ascontiguousarray(img), dict(frame.metadata))
+
+    def _publish(self, future):
+        try:
+            frame = future.result()
+        except Exception as e:
+            self.errors += 1
+            logging.exception("FramePipeline stage")
+            return
+        self.processed += 1
+        self.frame_ring.put(frame)
+        if not self.frame_queue.full():
+            self.frame_queue.put(frame)
+
+    def run(self):
+        pending = collections.deque()
+        try:
+            while self.running:
+                # Wait for the oldest frame while too many are in flight
+                while pending and (pending[0].done() or len(pending) >= self.max_in_flight):
+                    self._publish(pending.popleft())
+                item = self.reader.get(timeout=0.01 if pending else 0.1)
+                if item is not None:
+                    seq, frame = item
+                    pending.append(self.pool.submit(self._process, frame, self.stages))
+            while pending:
+                self._publish(pending.popleft())
+        except Exception as e:
+            logging.exception("FramePipeline.run()")
+            self.running = False
+
+import unittest
+
+class TestFramePipeline(unittest.TestCase):
+
+    def run_frames(self, pipeline, n):
+        ring = pipeline.input_ring
+        output = pipeline.frame_ring.reader()
+        pipeline.start()
+        for i in range(n):
+            ring.put(CapturedImage(np.full(64, i, dtype=np.uint8).tobytes(), {'Index': i}, 'raw', 8, 8))
+        results = []
+        deadline = time.monotonic() + 5
+        while len(results) < n - pipeline.errors and time.monotonic() < deadline:
+            item = output.get(timeout=0.1)
+            if item is not None:
+                results.append(item[1])
+        pipeline.stop()
+        return results
+
+    def test_output_in_capture_order(self):
+        pipeline = FramePipeline(FrameRing(), workers=4)
+        # Earlier frames take longer, so they finish after later ones
+        pipeline.add_stage('slow', lambda img, metadata: (time.sleep(0.02 * (3 - metadata['Index'] % 4)), img + 1)[1])
+        pipeline.add_stage('binning', make_stage('binning', factor=2))
+        results = self.run_frames(pipeline, 24)
+        self.assertEqual([frame.metadata['Index'] for frame in results], list(range(24)))
+        for i, frame in enumerate(results):
+            self.assertEqual(frame.to_grayscale().shape, (4, 4))
+            self.assertTrue((frame.to_grayscale() == i + 1).all())
+        stats = pipeline.stats()
+        self.assertEqual((stats['processed'], stats['errors'], stats['dropped']), (24, 0, 0))
+        self.assertEqual(stats['stages']['slow']['frames'], 24)
+
+    def test_errors_skip_frames(self):
+        def stage(img, metadata):
+            if metadata['Index'] == 3:
+                raise ValueError("bad frame")
+            return img.astype(np.float32) * 2
+        pipeline = FramePipeline(FrameRing(), workers=2)
+        pipeline.add_stage('double', stage)
+        with self.assertLogs(level='ERROR'):
+            results = self.run_frames(pipeline, 8)
+        self.assertEqual([frame.metadata['Index'] for frame in results], [0, 1, 2, 4, 5, 6, 7])
+        # Float output is clipped back to 8 bits
+        self.assertEqual([int(frame.to_grayscale()[0, 0]) for frame in results], [0, 2, 4, 8, 10, 12, 14])
+        self.assertEqual(pipeline.errors, 1)
+
+    def test_stage_names(self):
+        pipeline = FramePipeline(FrameRing(), workers=1)
+        pipeline.add_stage('a', make_stage('median_blur'))
+        pipeline.add_stage('b', make_stage('gaussian_blur'), index=0)
+        self.assertEqual(pipeline.stage_names(), ['b', 'a'])
+        with self.assertRaises(ValueError):
+            pipeline.add_stage('a', make_stage('median_blur'))
+        with self.assertRaises(ValueError):
+            make_stage('sharpen')
+        pipeline.remove_stage('b')
+        self.assertEqual(pipeline.stage_names(), ['a'])
+
+if __name__ == '__main__':
+    unittest.main()
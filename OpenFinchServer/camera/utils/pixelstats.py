@@ -0,0 +1,161 @@
+import logging
+import threading
+import numpy as np
+
+from camera.utils.ring import FrameRingFollower
+
+PIXEL_MAPS = ('mean', 'variance', 'std', 'min', 'max', 'count')
+
+class PixelStatistics(FrameRingFollower):
+    """
+    Follows a FrameRing and keeps per-pixel running mean and variance of
+    frame luma with Welford's algorithm, vectorised over preallocated
+    float32 buffers; with minmax=True also the per-pixel min and max.
+    `roi` = (x, y, width, height) restricts the maps to that region.
+
+    With window=None the statistics cover every frame since start or
+    reset(). Otherwise they cover consecutive windows of `window` frames:
+    when a window completes, its maps become the published ones and a new
+    window starts.
+    """
+
+    def __init__(self, frame_ring, window=None, minmax=False, roi=None):
+        if window is not None and window < 2:
+            raise ValueError(f"Statistics window must be at least 2 frames, not {window}")
+        super().__init__(frame_ring)
+        self.window = window
+        self.minmax = minmax
+        self.roi = roi
+        self.count = 0
+        self.published = None  # maps of the last completed window
+        self.windows = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        super().start()
+        logging.info(f"PixelStatistics over {'windows of ' + str(self.window) if self.window else 'all'} frames")
+
+    def stop(self):
+        if super().stop():
+            logging.info(f"PixelStatistics covered {self.count} frames, dropped {self.dropped}")
+
+    def _allocate(self, shape):
+        self.mean = np.zeros(shape, dtype=np.float32)
+        self.m2 = np.zeros(shape, dtype=np.float32)
+        self.delta = np.empty(shape, dtype=np.float32)
+        self.delta2 = np.empty(shape, dtype=np.float32)
+        if self.minmax:
+            self.min = np.empty(shape, dtype=np.uint8)
+            self.max = np.empty(shape, dtype=np.uint8)
+        self.count = 0
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+            if self.shape is not None:
+                self.mean[...] = 0
+                self.m2[...] = 0
+
+    def add(self, img):
+        if self.roi is not None:
+            x, y, w, h = self.roi
+            img = img[y:y + h, x:x + w]
+        with self.lock:
+            if self.geometry_changed(img):
+                self._allocate(img.shape)
+            self.count += 1
+            # delta = x - mean; mean += delta / n; m2 += delta * (x - mean)
+            np.subtract(img, self.mean, out=self.delta)
+            np.multiply(self.delta, np.float32(1.0 / self.count), out=self.delta2)
+            self.mean += self.delta2
+            np.subtract(img, self.mean, out=self.delta2)
+            np.multiply(self.delta, self.delta2, out=self.delta)
+            self.m2 += self.delta
+            if self.minmax:
+                if self.count == 1:
+                    self.min[...] = img
+                    self.max[...] = img
+                else:
+                    np.minimum(self.min, img, out=self.min)
+                    np.maximum(self.max, img, out=self.max)
+            if self.window is not None and self.count >= self.window:
+                self.published = self._maps()
+                self.windows += 1
+                self.count = 0
+                self.mean[...] = 0
+                self.m2[...] = 0
+
+    def _maps(self):
+        variance = self.m2 / np.float32(max(self.count - 1, 1))
+        maps = {'mean': self.mean.copy(), 'variance': variance, 'count': self.count}
+        if self.minmax:
+            maps['min'] = self.min.copy()
+            maps['max'] = self.max.copy()
+        return maps
+
+    def map(self, name):
+        """
+        One of PIXEL_MAPS: of the last completed window if `window` is set,
+        otherwise of every frame so far. None if there is no data yet.
+        """
+        if name not in PIXEL_MAPS:
+            raise ValueError(f"Unknown pixel map '{name}'. Choose one of {PIXEL_MAPS}.")
+        if name in ('min', 'max') and not self.minmax:
+            raise ValueError(f"Pixel map '{name}' needs minmax=True")
+        with self.lock:
+            if self.window is not None:
+                maps = self.published
+            else:
+                maps = self._maps() if self.count else None
+        if maps is None:
+            return None
+        if name == 'std':
+            return np.sqrt(maps['variance'])
+        if name == 'count':
+            return np.array(maps['count'])
+        return maps[name]
+
+    def process(self, seq, frame):
+        self.add(frame.to_grayscale())
+
+import unittest
+
+class TestPixelStatistics(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.frames = rng.integers(0, 256, (50, 24, 32), dtype=np.uint8)
+
+    def test_matches_numpy(self):
+        stats = PixelStatistics(None, minmax=True, roi=(4, 2, 16, 20))
+        for img in self.frames:
+            stats.add(img)
+        frames = self.frames[:, 2:22, 4:20].astype(np.float64)
+        np.testing.assert_allclose(stats.map('mean'), frames.mean(axis=0), atol=1e-3)
+        np.testing.assert_allclose(stats.map('variance'), frames.var(axis=0, ddof=1), rtol=1e-4, atol=1e-2)
+        np.testing.assert_allclose(stats.map('std'), frames.std(axis=0, ddof=1), rtol=1e-4)
+        self.assertTrue(np.array_equal(stats.map('min'), frames.min(axis=0)))
+        self.assertTrue(np.array_equal(stats.map('max'), frames.max(axis=0)))
+        self.assertEqual(int(stats.map('count')), 50)
+
+    def test_windows(self):
+        stats = PixelStatistics(None, window=20)
+        for img in self.frames:
+            stats.add(img)
+        # The maps are of the second complete window; ten frames of the third are pending
+        self.assertEqual((stats.windows, stats.count), (2, 10))
+        frames = self.frames[20:40].astype(np.float64)
+        np.testing.assert_allclose(stats.map('mean'), frames.mean(axis=0), atol=1e-3)
+        np.testing.assert_allclose(stats.map('variance'), frames.var(axis=0, ddof=1), rtol=1e-4, atol=1e-2)
+        with self.assertRaises(ValueError):
+            stats.map('min')
+
+    def test_geometry_change_starts_over(self):
+        stats = PixelStatistics(None)
+        stats.add(self.frames[0])
+        stats.add(self.frames[1, :12, :16])
+        self.assertEqual(int(stats.map('count')), 1)
+        self.assertTrue(np.array_equal(stats.map('mean'), self.frames[1, :12, :16]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,319 @@
+import os
+import json
+import mmap
+import time
+import struct
+import logging
+import numpy as np
+
+from camera.utils.ring import FrameRingFollower
+
+# A recording is three files sharing a base path:
+#   <path>.frames  preallocated container of fixed-size frame slots
+#   <path>.index   header followed by one INDEX_DTYPE record per frame
+#   <path>.meta    append-only log of per-frame metadata, one JSON object per line
+INDEX_MAGIC = b'OFREC002'
+# magic, slot size, number of slots, frame format, width, height, stride
+# (bytes per line of the first plane, 0 if tightly packed)
+INDEX_HEADER = struct.Struct('<8sQQ16sIII')
+
+INDEX_DTYPE = np.dtype([
+    ('sequence', '<u8'),         # frame ring sequence number
+    ('timestamp', '<i8'),        # SensorTimestamp in ns
+    ('offset', '<u8'),           # byte offset of the frame's slot in .frames
+    ('size', '<u4'),             # bytes used in the slot
+    ('metadata_offset', '<u8'),  # byte offset of the frame's line in .meta
+    ('metadata_size', '<u4'),
+])
+
+def _json_default(obj):
+    # numpy scalars and arrays in libcamera metadata
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return str(obj)
+
+def _page_align(n):
+    return (n + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+
+class RecordingFile:
+    """
+    Writes frames to a recording: each frame's bytes are copied into the
+    next slot of a memory-mapped container preallocated for `max_frames`
+    slots of `slot_size` bytes (by default the first frame's size plus
+    `slot_margin`, to leave room for variable size JPEGs). The files are
+    created when the first frame is appended.
+    """
+
+    def __init__(self, path, max_frames, slot_size=None, slot_margin=1.25):
+        self.path = path
+        self.max_frames = max_frames
+        self.slot_size = slot_size
+        self.slot_margin = slot_margin
+        self.opened = False
+        self.count = 0
+        self.oversize = 0
+        self.bytes_written = 0
+        self.record = np.zeros(1, dtype=INDEX_DTYPE)
+
+    @property
+    def full(self):
+        return self.count >= self.max_frames
+
+    def _open(self, first_frame, first_frame_size):
+        if self.slot_size is None:
+            self.slot_size = _page_align(int(first_frame_size * self.slot_margin))
+        size = self.slot_size * self.max_frames
+        self.frames_file = open(self.path + '.frames', 'w+b')
+        try:
+            # Reserve the blocks now so the writer never waits on allocation
+            os.posix_fallocate(self.frames_file.fileno(), 0, size)
+        except (AttributeError, OSError):
+            self.frames_file.truncate(size)
+        self.frames_map = mmap.mmap(self.frames_file.fileno(), size)
+        self.index_file = open(self.path + '.index', 'wb')
+        self.index_file.write(INDEX_HEADER.pack(
+            INDEX_MAGIC, self.slot_size, self.max_frames, first_frame.format.encode(),
+            getattr(first_frame, 'width', 0), getattr(first_frame, 'height', 0),
+            getattr(first_frame, 'stride', 0)))
+        self.meta_file = open(self.path + '.meta', 'wb')
+        self.meta_offset = 0
+        self.opened = True
+
+    def append(self, seq, frame):
+        """Append a frame; returns False if it doesn't fit a slot or the container is full."""
+        data = memoryview(frame.to_bytes()).cast('B')
+        if not self.opened:
+            self._open(frame, len(data))
+        if len(data) > self.slot_size:
+            self.oversize += 1
+            return False
+        if self.full:
+            return False
+
+        offset = self.count * self.slot_size
+        self.frames_map[offset:offset + len(data)] = data
+
+        metadata = json.dumps(frame.metadata, default=_json_default).encode() + b'\n'
+        self.meta_file.write(metadata)
+
+        record = self.record
+        record['sequence'] = seq
+        record['timestamp'] = frame.metadata.get('SensorTimestamp', time.clock_gettime_ns(time.CLOCK_BOOTTIME))
+        record['offset'] = offset
+        record['size'] = len(data)
+        record['metadata_offset'] = self.meta_offset
+        record['metadata_size'] = len(metadata)
+        self.index_file.write(record.tobytes())
+
+        self.meta_offset += len(metadata)
+        self.count += 1
+        self.bytes_written += len(data)
+        return True
+
+    def flush(self):
+        # Make the index and metadata visible to readers of a live recording
+        if self.opened:
+            self.index_file.flush()
+            self.meta_file.flush()
+
+    def close(self):
+        if not self.opened:
+            return
+        self.opened = False
+        self.frames_map.flush()
+        self.frames_map.close()
+        self.frames_file.close()
+        self.index_file.close()
+        self.meta_file.close()
+
+def write_recording(path, frames, slot_size=None):
+    """Write a list of (seq, frame) to a recording at `path`."""
+    recording = RecordingFile(path, max(len(frames), 1), slot_size=slot_size)
+    try:
+        for seq, frame in frames:
+            recording.append(seq, frame)
+    finally:
+        recording.close()
+    return recording
+
+class FrameRecorder(FrameRingFollower):
+    """
+    Records every frame that passes through a FrameRing, unencoded, for
+    later analysis or replay.
+
+    A writer thread appends each frame to a RecordingFile. Frames that
+    don't fit a slot are counted in `oversize`; the recorder stops when
+    the container is full or a write fails.
+    """
+
+    def __init__(self, frame_ring, path, max_frames=10000, slot_size=None, slot_margin=1.25,
+                 flush_interval=1.0):
+        super().__init__(frame_ring)
+        self.path = path
+        self.recording = RecordingFile(path, max_frames, slot_size=slot_size, slot_margin=slot_margin)
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+
+    @property
+    def count(self):
+        return self.recording.count
+
+    @property
+    def oversize(self):
+        return self.recording.oversize
+
+    @property
+    def bytes_written(self):
+        return self.recording.bytes_written
+
+    def start(self):
+        super().start()
+        logging.info(f"FrameRecorder recording to {self.path}")
+
+    def stop(self):
+        if super().stop():
+            logging.info(f"FrameRecorder wrote {self.count} frames ({self.bytes_written / 1e6:.1f} MB) to {self.path}, "
+                         f"dropped {self.dropped}, oversize {self.oversize}")
+
+    def process(self, seq, frame):
+        try:
+            self.recording.append(seq, frame)
+        except Exception as e:
+            self.running = False
+            raise
+        if self.recording.full:
+            logging.warning(f"FrameRecorder container {self.path}.frames is full")
+            self.running = False
+        elif time.monotonic() - self.last_flush > self.flush_interval:
+            self.recording.flush()
+            self.last_flush = time.monotonic()
+
+    def finish(self):
+        self.recording.close()
+
+class RecordingReader:
+    """
+    Random access to a recording made by FrameRecorder. Frames are returned
+    as zero-copy views of the memory-mapped container; call refresh() to
+    pick up frames appended since the recording was opened.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.index', 'rb') as f:
+            header = f.read(INDEX_HEADER.size)
+        if header[:len(INDEX_MAGIC)] != INDEX_MAGIC or len(header) < INDEX_HEADER.size:
+            raise ValueError(f"{path}.index is not an OpenFinch recording index of version {INDEX_MAGIC.decode()}")
+        magic, self.slot_size, self.max_frames, format, self.width, self.height, self.stride = INDEX_HEADER.unpack(header)
+        self.format = format.rstrip(b'\0').decode()
+        self.frames_file = open(path + '.frames', 'rb')
+        self.frames_map = mmap.mmap(self.frames_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.meta_file = open(path + '.meta', 'rb')
+        self.refresh()
+
+    def refresh(self):
+        size = os.path.getsize(self.path + '.index') - INDEX_HEADER.size
+        count = size // INDEX_DTYPE.itemsize
+        self.index = np.fromfile(self.path + '.index', dtype=INDEX_DTYPE, count=count, offset=INDEX_HEADER.size)
+
+    def close(self):
+        self.frames_map.close()
+        self.frames_file.close()
+        self.meta_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def frame(self, i):
+        """The bytes of frame `i`, as a memoryview into the container."""
+        record = self.index[i]
+        offset = int(record['offset'])
+        return memoryview(self.frames_map)[offset:offset + int(record['size'])]
+
+    def metadata(self, i):
+        record = self.index[i]
+        self.meta_file.seek(int(record['metadata_offset']))
+        return json.loads(self.meta_file.read(int(record['metadata_size'])))
+
+    def timestamps(self):
+        return self.index['timestamp']
+
+import unittest
+import tempfile
+
+class TestRecording(unittest.TestCase):
+
+    def setUp(self):
+        from camera.captures.image import CapturedImage
+        from camera.utils.ring import FrameRing
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'recording')
+        self.ring = FrameRing()
+        rng = np.random.default_rng(0)
+        self.frames = [CapturedImage(rng.integers(0, 256, 48 * 32, dtype=np.uint8).tobytes(),
+                                     {'SensorTimestamp': 1000 * i, 'ExposureTime': np.int64(5000)},
+                                     'raw', 48, 32)
+                       for i in range(20)]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        recorder = FrameRecorder(self.ring, self.path, max_frames=len(self.frames))
+        recorder.start()
+        for frame in self.frames:
+            self.ring.put(frame)
+        deadline = time.monotonic() + 5
+        while recorder.count < len(self.frames) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        recorder.stop()
+        self.assertEqual((recorder.count, recorder.dropped, recorder.oversize), (len(self.frames), 0, 0))
+        with RecordingReader(self.path) as reader:
+            self.assertEqual((reader.format, reader.width, reader.height, reader.stride), ('raw', 48, 32, 0))
+            self.assertEqual(len(reader), len(self.frames))
+            self.assertEqual(list(reader.index['sequence']), list(range(len(self.frames))))
+            self.assertEqual(list(reader.timestamps()), [1000 * i for i in range(len(self.frames))])
+            for i, frame in enumerate(self.frames):
+                self.assertEqual(bytes(reader.frame(i)), frame.frame)
+                self.assertEqual(reader.metadata(i), {'SensorTimestamp': 1000 * i, 'ExposureTime': 5000})
+
+    def test_oversize_and_full(self):
+        small = type(self.frames[0])(b'\x01' * 16, {}, 'raw', 4, 4)
+        recording = write_recording(self.path, [(0, small), (1, self.frames[0]), (2, small)], slot_size=64)
+        self.assertEqual((recording.count, recording.oversize), (2, 1))
+        with RecordingReader(self.path) as reader:
+            self.assertEqual(list(reader.index['sequence']), [0, 2])
+            self.assertEqual(bytes(reader.frame(1)), small.frame)
+        recording = RecordingFile(self.path, 2, slot_size=64)
+        self.assertTrue(recording.append(0, small) and recording.append(1, small))
+        self.assertTrue(recording.full)
+        self.assertFalse(recording.append(2, small))
+        recording.close()
+
+    def test_stride(self):
+        from camera.captures.image import CapturedImage
+        # 6x4 yuv420 with lines padded to 8 bytes: Y then U and V at half the stride
+        frame = CapturedImage(bytes(range(48)), {}, 'yuv420', 6, 4, 8)
+        write_recording(self.path, [(0, frame)])
+        with RecordingReader(self.path) as reader:
+            self.assertEqual((reader.width, reader.height, reader.stride), (6, 4, 8))
+            self.assertEqual(bytes(reader.frame(0)), frame.frame)
+            # As ReplayCameraController rebuilds it
+            replayed = CapturedImage(bytes(reader.frame(0)), reader.metadata(0), 'yuv420',
+                                     reader.width, reader.height, reader.stride)
+            np.testing.assert_array_equal(replayed.to_grayscale(), frame.to_grayscale())
+
+    def test_rejects_other_versions(self):
+        with open(self.path + '.index', 'wb') as f:
+            f.write(b'OFREC001' + bytes(64))
+        with self.assertRaises(ValueError):
+            RecordingReader(self.path)
+
+if __name__ == '__main__':
+    unittest.main()
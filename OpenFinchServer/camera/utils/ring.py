@@ -0,0 +1,258 @@
+import time
+import logging
+import threading
+
+class FrameRing:
+    """
+    Fixed-size ring of the most recent captured frames, filled by a camera
+    backend's reader thread at sensor rate.
+
+    By default the producer never waits: each put() overwrites the oldest
+    frame. Any number of consumers follow the ring through their own
+    FrameRingReader, and a reader that falls more than `capacity` frames
+    behind skips ahead and counts the frames it lost in `missed`.
+
+    A reader opened with backpressure=True instead makes put() wait, up to
+    `max_stall` seconds, until it has room; the time the producer spent
+    waiting is accumulated in `stall_time`.
+
+    If set, `annotate(frame)` is called on the producer's thread before each
+    frame is stored, so every consumer sees the metadata it adds.
+    """
+
+    def __init__(self, capacity=64, max_stall=1.0):
+        self.capacity = capacity
+        self.max_stall = max_stall
+        self.frames = [None] * capacity
+        self.head = 0  # total frames put, i.e. the sequence number of the next frame
+        self.cond = threading.Condition()
+        self.blocking_readers = set()
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.annotate = None
+
+    def _has_room(self):
+        return all(self.head - reader.next < self.capacity for reader in self.blocking_readers)
+
+    def put(self, frame):
+        if self.annotate is not None:
+            try:
+                self.annotate(frame)
+            except Exception as e:
+                logging.exception("FrameRing.annotate()")
+        with self.cond:
+            if not self._has_room():
+                self.stalls += 1
+                tic = time.monotonic()
+                self.cond.wait_for(self._has_room, self.max_stall)
+                self.stall_time += time.monotonic() - tic
+            seq = self.head
+            evicted = self.frames[seq % self.capacity]
+            self.frames[seq % self.capacity] = frame
+            self.head += 1
+            self.cond.notify_all()
+        # Drop the evicted frame's cached decodes; readers still holding it decode again if they need to
+        if evicted is not None and hasattr(evicted, 'release'):
+            evicted.release()
+        return seq
+
+    def get(self, seq):
+        """The frame with sequence number `seq`, or None if it was overwritten or not captured yet."""
+        with self.cond:
+            if seq < 0 or seq >= self.head or seq < self.head - self.capacity:
+                return None
+            return self.frames[seq % self.capacity]
+
+    def latest(self):
+        with self.cond:
+            if self.head == 0:
+                return None
+            return self.head - 1, self.frames[(self.head - 1) % self.capacity]
+
+    def reader(self, start=None, backpressure=False):
+        """A reader that starts at sequence `start` (default: the next frame put)."""
+        reader = FrameRingReader(self, self.head if start is None else start, backpressure)
+        if backpressure:
+            with self.cond:
+                self.blocking_readers.add(reader)
+        return reader
+
+class FrameRingReader:
+    def __init__(self, ring, start, backpressure=False):
+        self.ring = ring
+        self.next = start
+        self.backpressure = backpressure
+        self.missed = 0
+
+    def close(self):
+        with self.ring.cond:
+            self.ring.blocking_readers.discard(self)
+            self.ring.cond.notify_all()
+
+    def pending(self):
+        return self.ring.head - self.next
+
+    def get(self, timeout=None):
+        """
+        Return the next (seq, frame), waiting up to `timeout` seconds for it
+        to be captured; None on timeout.
+        """
+        ring = self.ring
+        with ring.cond:
+            if not ring.cond.wait_for(lambda: ring.head > self.next, timeout):
+                return None
+            oldest = ring.head - ring.capacity
+            if self.next < oldest:
+                self.missed += oldest - self.next
+                self.next = oldest
+            seq = self.next
+            self.next += 1
+            if self.backpressure:
+                # The producer may be waiting for room
+                ring.cond.notify_all()
+            return seq, ring.frames[seq % ring.capacity]
+
+class FrameRingFollower:
+    """
+    Base for consumers that follow a FrameRing on their own thread.
+
+    start() opens a reader on `input_ring` (with backpressure if the class
+    sets it) and runs run() on a thread named after the class; stop()
+    joins it and returns whether it was running. The default run() calls
+    process(seq, frame) for every frame, logging its exceptions, and
+    finish() once stopped. Frames lost because the follower fell behind
+    are counted in `dropped`.
+    """
+
+    backpressure = False
+    # Also a class attribute so __del__ works if a subclass's __init__ raised early
+    running = False
+
+    def __init__(self, input_ring):
+        self.input_ring = input_ring
+        self.shape = None
+        self.running = False
+        self.reader = None
+
+    def __del__(self):
+        self.stop()
+
+    @property
+    def dropped(self):
+        return self.reader.missed if self.reader is not None else 0
+
+    def start(self):
+        self.reader = self.input_ring.reader(backpressure=self.backpressure)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=type(self).__name__)
+        self.thread.start()
+
+    def stop(self):
+        if not self.running:
+            return False
+        self.running = False
+        self.thread.join()
+        if self.backpressure:
+            self.reader.close()
+        return True
+
+    def geometry_changed(self, img):
+        """True for the first image and whenever the shape changes: the caller starts over."""
+        if img.shape == self.shape:
+            return False
+        self.shape = img.shape
+        return True
+
+    def process(self, seq, frame):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+    def run(self):
+        try:
+            while self.running:
+                item = self.reader.get(timeout=0.1)
+                if item is None:
+                    continue
+                try:
+                    self.process(*item)
+                except Exception as e:
+                    logging.exception(f"{type(self).__name__}.process()")
+        finally:
+            self.finish()
+
+import unittest
+
+class TestFrameRing(unittest.TestCase):
+
+    def test_missed_frames(self):
+        ring = FrameRing(capacity=4)
+        reader = ring.reader()
+        for i in range(10):
+            ring.put(i)
+        # Frames 0-5 were overwritten; the reader skips to the oldest kept
+        self.assertEqual(reader.pending(), 10)
+        self.assertEqual([reader.get(0) for _ in range(4)], [(6, 6), (7, 7), (8, 8), (9, 9)])
+        self.assertEqual(reader.missed, 6)
+        self.assertIsNone(reader.get(0))
+        self.assertEqual((ring.get(5), ring.get(6), ring.latest()), (None, 6, (9, 9)))
+
+    def test_backpressure(self):
+        ring = FrameRing(capacity=2, max_stall=5.0)
+        reader = ring.reader(backpressure=True)
+        ring.put(0)
+        ring.put(1)
+        # The ring is full for this reader, so the producer waits until it reads
+        producer = threading.Thread(target=ring.put, args=(2,))
+        producer.start()
+        time.sleep(0.05)
+        self.assertEqual((ring.head, ring.stalls), (2, 1))
+        self.assertEqual(reader.get(0), (0, 0))
+        producer.join(1)
+        self.assertEqual(ring.head, 3)
+        self.assertGreater(ring.stall_time, 0.04)
+        self.assertEqual([reader.get(0) for _ in range(2)], [(1, 1), (2, 2)])
+        self.assertEqual(reader.missed, 0)
+
+    def test_backpressure_gives_up(self):
+        ring = FrameRing(capacity=2, max_stall=0.02)
+        reader = ring.reader(backpressure=True)
+        for i in range(4):
+            ring.put(i)
+        # Each put past capacity waited max_stall and then overwrote
+        self.assertEqual(ring.stalls, 2)
+        self.assertEqual(reader.get(0), (2, 2))
+        self.assertEqual(reader.missed, 2)
+        reader.close()
+        ring.put(4)
+        self.assertEqual(ring.stalls, 2)
+
+    def test_follower(self):
+        class Collect(FrameRingFollower):
+            def __init__(self, ring):
+                super().__init__(ring)
+                self.seen = []
+                self.finished = False
+            def process(self, seq, frame):
+                if frame == 'bad':
+                    raise ValueError(frame)
+                self.seen.append(seq)
+            def finish(self):
+                self.finished = True
+        ring = FrameRing(capacity=4)
+        follower = Collect(ring)
+        self.assertFalse(follower.stop())
+        follower.start()
+        self.assertEqual(follower.thread.name, 'Collect')
+        with self.assertLogs(level='ERROR'):
+            for frame in (0, 'bad', 2):
+                ring.put(frame)
+            deadline = time.monotonic() + 1
+            while follower.reader.pending() and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertTrue(follower.stop())
+        self.assertEqual((follower.seen, follower.dropped, follower.finished), ([0, 2], 0, True))
+
+if __name__ == '__main__':
+    unittest.main()
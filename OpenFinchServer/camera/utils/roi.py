@@ -0,0 +1,18 @@
+def check_roi(roi, sensor_size):
+    """
+    roi = (x, y, width, height) as ints aligned to even pixels, as YUV420
+    streams need, after checking that it lies within `sensor_size`.
+    """
+    x, y, width, height = (int(v) & ~1 for v in roi)
+    sensor_width, sensor_height = sensor_size
+    if width <= 0 or height <= 0:
+        raise ValueError(f"ROI {list(roi)} is empty")
+    if x < 0 or y < 0 or x + width > sensor_width or y + height > sensor_height:
+        raise ValueError(f"ROI {list(roi)} is outside the {sensor_width}x{sensor_height} sensor")
+    return x, y, width, height
+
+def fit_size(size, bound):
+    """`size` scaled down, keeping its aspect ratio, to fit within `bound`; even dimensions."""
+    width, height = size
+    scale = min(1.0, bound[0] / width, bound[1] / height)
+    return max(2, int(width * scale) & ~1), max(2, int(height * scale) & ~1)
@@ -26,8 +26,6 @@ class FloatControl(Control):
     def __init__(self, name, id, type, range, default, value):
         super().__init__(name, id, type, range, default, value)
 
-import v4l2py
-from libcamera import ControlType
 import logging
 
 
@@ -79,3 +77,12 @@ class BoundedQueue(asyncio.Queue):
             # Drop the oldest item from the queue
             await self.get()
         await super().put(item)
+
+import io
+import numpy as np
+
+def npy_bytes(array):
+    """An array serialized in .npy format, for sending to clients."""
+    buf = io.BytesIO()
+    np.save(buf, array, allow_pickle=False)
+    return buf.getvalue()
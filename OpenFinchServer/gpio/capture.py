@@ -0,0 +1,232 @@
+import os
+import time
+import socket
+import struct
+import logging
+import threading
+import numpy as np
+
+from gpio.vcd import VCDWriter
+
+_PI_CMD_NOIB = 99
+
+# pigpio notification report, as sent on the wire ('HHII')
+NOTIFY_DTYPE = np.dtype([
+    ('seq', '<u2'),
+    ('flags', '<u2'),
+    ('tick', '<u4'),
+    ('level', '<u4'),
+])
+
+# Header of the compact binary capture format: magic, monitored bits, initial levels, initial tick
+RAW_MAGIC = b'OFGPIO01'
+RAW_HEADER = struct.Struct('<8sIII')
+
+class NotificationRing:
+    """
+    Single-producer single-consumer ring of pigpio notification reports.
+    When the consumer falls behind the oldest reports are overwritten and
+    counted in `dropped`.
+    """
+
+    def __init__(self, capacity=1 << 16):
+        self.capacity = capacity
+        self.records = np.zeros(capacity, dtype=NOTIFY_DTYPE)
+        self.head = 0  # total records written
+        self.tail = 0  # total records read
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def write(self, records):
+        n = len(records)
+        if n > self.capacity:
+            records = records[-self.capacity:]
+            n = self.capacity
+        with self.lock:
+            start = self.head % self.capacity
+            first = min(n, self.capacity - start)
+            self.records[start:start + first] = records[:first]
+            self.records[:n - first] = records[first:]
+            self.head += n
+            if self.head - self.tail > self.capacity:
+                self.dropped += self.head - self.tail - self.capacity
+                self.tail = self.head - self.capacity
+
+    def read(self):
+        """Remove and return all pending records, oldest first."""
+        with self.lock:
+            n = self.head - self.tail
+            start = self.tail % self.capacity
+            if start + n <= self.capacity:
+                out = self.records[start:start + n].copy()
+            else:
+                out = np.concatenate((self.records[start:], self.records[:start + n - self.capacity]))
+            self.tail = self.head
+            return out
+
+class GPIOCapture:
+    """
+    Logic-analyzer style capture of real GPIO edges.
+
+    A reader thread receives pigpio notification reports on a dedicated
+    socket into a fixed-size NotificationRing; a writer thread drains the
+    ring every `flush_interval` seconds and appends the changes to a VCD
+    file (format='vcd') or to a compact binary file (format='raw') that can
+    be converted later with `raw_to_vcd`. Memory use is bounded by the ring
+    capacity however long the capture runs.
+    """
+
+    def __init__(self, pig, gpios, filename, format='vcd', capacity=1 << 16, flush_interval=0.5):
+        if format not in ('vcd', 'raw'):
+            raise ValueError("Invalid format. Choose either 'vcd' or 'raw'.")
+        self.pig = pig
+        # gpios may be a list of GPIO numbers or a dict mapping GPIO to signal name
+        if isinstance(gpios, dict):
+            self.signals = dict(gpios)
+        else:
+            self.signals = {gpio: f"gpio{gpio}" for gpio in gpios}
+        self.bits = 0
+        for gpio in self.signals:
+            self.bits |= (1 << gpio)
+        self.filename = filename
+        self.format = format
+        self.ring = NotificationRing(capacity)
+        self.flush_interval = flush_interval
+        self.running = False
+        self.handle = -1
+        self.sock = None
+        self.records_written = 0
+
+    def __del__(self):
+        self.stop()
+
+    def _open_notifications(self):
+        # Equivalent of pigpio's notify_open(), but over a socket so it also
+        # works against a remote pigpiod
+        self.sock = socket.create_connection((self.pig._host, self.pig._port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(struct.pack('IIII', _PI_CMD_NOIB, 0, 0, 0))
+        _, handle = struct.unpack('12si', self._recv_exact(16))
+        if handle < 0:
+            raise ValueError(f"Couldn't open pigpio notification handle ({handle})")
+        return handle
+
+    def _recv_exact(self, n):
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError("pigpio notification socket closed")
+            buf.extend(chunk)
+        return bytes(buf)
+
+    def start(self):
+        self.handle = self._open_notifications()
+        self.initial_levels = self.pig.read_bank_1()
+        self.initial_tick = self.pig.get_current_tick()
+        self.running = True
+        self.reader_thread = threading.Thread(target=self._read_reports, daemon=True)
+        self.writer_thread = threading.Thread(target=self._write_reports)
+        self.reader_thread.start()
+        self.writer_thread.start()
+        self.pig.notify_begin(self.handle, self.bits)
+        logging.info(f"GPIOCapture recording {list(self.signals.values())} to {self.filename}")
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        try:
+            self.pig.notify_close(self.handle)
+        except Exception as e:
+            logging.exception("GPIOCapture.stop()")
+        self.writer_thread.join()
+        try:
+            self.sock.close()
+        except Exception as e:
+            pass
+        if self.ring.dropped:
+            logging.warning(f"GPIOCapture dropped {self.ring.dropped} reports")
+
+    def _read_reports(self):
+        size = NOTIFY_DTYPE.itemsize
+        buf = b''
+        while self.running:
+            try:
+                data = self.sock.recv(size * 1024)
+            except OSError:
+                break
+            if not data:
+                break
+            buf += data
+            n = len(buf) // size
+            if n:
+                self.ring.write(np.frombuffer(buf, dtype=NOTIFY_DTYPE, count=n))
+                buf = buf[n * size:]
+
+    def _write_reports(self):
+        if self.format == 'vcd':
+            out = open(self.filename, 'w')
+            sink = _VCDSink(out, self.signals, self.initial_levels, self.initial_tick)
+        else:
+            out = open(self.filename, 'wb')
+            out.write(RAW_HEADER.pack(RAW_MAGIC, self.bits, self.initial_levels, self.initial_tick))
+            sink = None
+        try:
+            while True:
+                running = self.running
+                records = self.ring.read()
+                if len(records):
+                    if sink is not None:
+                        sink.write(records)
+                    else:
+                        out.write(records.tobytes())
+                    self.records_written += len(records)
+                    out.flush()
+                if not running:
+                    break
+                time.sleep(self.flush_interval)
+        finally:
+            out.close()
+
+class _VCDSink:
+    """Converts notification reports to VCD, unwrapping the 32 bit tick."""
+
+    def __init__(self, file, signals, initial_levels, initial_tick):
+        self.vcd = VCDWriter(file, signals)
+        self.vcd.write_header(initial_levels)
+        self.last_tick = initial_tick
+        self.time = 0
+
+    def write(self, records):
+        # Only plain level reports; keep-alive, watchdog and event reports carry flags
+        records = records[records['flags'] == 0]
+        if len(records) == 0:
+            return
+        ticks = records['tick'].astype(np.int64)
+        deltas = np.diff(ticks, prepend=self.last_tick) % (1 << 32)
+        times = self.time + np.cumsum(deltas)
+        levels = records['level'] & self.vcd.mask
+        # Skip reports where none of the monitored GPIOs changed
+        prev = np.concatenate(([self.vcd.last_levels], levels[:-1]))
+        for t, level in zip(times[levels != prev], levels[levels != prev]):
+            self.vcd.write(int(t), int(level))
+        self.last_tick = int(ticks[-1])
+        self.time = int(times[-1])
+
+def raw_to_vcd(raw_filename, vcd_filename, signals=None, chunk=1 << 16):
+    """Convert a capture written with format='raw' to VCD, streaming in chunks."""
+    with open(raw_filename, 'rb') as raw:
+        magic, bits, initial_levels, initial_tick = RAW_HEADER.unpack(raw.read(RAW_HEADER.size))
+        if magic != RAW_MAGIC:
+            raise ValueError(f"{raw_filename} is not an OpenFinch GPIO capture")
+        if signals is None:
+            signals = {gpio: f"gpio{gpio}" for gpio in range(32) if (bits >> gpio) & 1}
+        with open(vcd_filename, 'w') as out:
+            sink = _VCDSink(out, signals, initial_levels, initial_tick)
+            while True:
+                data = raw.read(chunk * NOTIFY_DTYPE.itemsize)
+                n = len(data) // NOTIFY_DTYPE.itemsize
+                if n == 0:
+                    break
+                sink.write(np.frombuffer(data, dtype=NOTIFY_DTYPE, count=n))
@@ -0,0 +1,209 @@
+import socket
+import struct
+import asyncio
+import logging
+import threading
+import concurrent.futures
+
+# pigpio socket command numbers used by the pipelined wave update
+_PI_CMD_WVAG = 28
+_PI_CMD_WVCRE = 49
+_PI_CMD_WVDEL = 50
+_PI_CMD_WVNEW = 53
+_PI_CMD_PROCU = 117
+
+class PipelinedConnection:
+    """
+    A pigpio socket connection that sends a batch of commands in a single
+    write and then reads the replies in order. pigpiod executes the
+    commands on a socket sequentially, so a batch costs one round trip
+    instead of one per command.
+
+    Only commands whose reply has no extension can be batched (i.e. not
+    script_status and friends).
+    """
+
+    def __init__(self, host="localhost", port=8888):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.sock.close()
+
+    def _recv_exact(self, n):
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError("pigpio connection closed")
+            buf.extend(chunk)
+        return buf
+
+    def execute(self, commands):
+        """
+        Run a batch of (cmd, p1, p2, ext) tuples and return their results
+        as signed ints; negative values are pigpio error codes.
+        """
+        out = bytearray()
+        for cmd, p1, p2, ext in commands:
+            out += struct.pack('IIII', cmd, p1, p2, len(ext))
+            out += ext
+        with self.lock:
+            self.sock.sendall(out)
+            replies = self._recv_exact(16 * len(commands))
+        return [res for _, _, _, res in struct.iter_unpack('IIIi', replies)]
+
+    @staticmethod
+    def wave_commands(pulses):
+        """Commands that build one wave from (set, clr, delay) pulses; the last result is its id."""
+        ext = b''.join(struct.pack('III', on, off, delay) for on, off, delay in pulses)
+        return [
+            (_PI_CMD_WVNEW, 0, 0, b''),
+            (_PI_CMD_WVAG, 0, 0, ext),
+            (_PI_CMD_WVCRE, 0, 0, b''),
+        ]
+
+    @staticmethod
+    def update_script_command(script_id, params):
+        return (_PI_CMD_PROCU, script_id, 0, b''.join(struct.pack('I', p) for p in params))
+
+    @staticmethod
+    def wave_delete_command(wave_id):
+        return (_PI_CMD_WVDEL, wave_id, 0, b'')
+
+class CommandChannel:
+    """
+    Runs pigpio work on a dedicated worker thread so it never blocks the
+    asyncio loop.
+
+    Jobs are submitted under a key and coalesced: if a job with the same key
+    is still waiting when a new one arrives, only the newest runs, and every
+    caller that was waiting on the key gets its result.
+    """
+
+    def __init__(self, name="CommandChannel"):
+        self.name = name
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.running = True
+        self.superseded = 0
+        self.thread = threading.Thread(target=self._worker, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, key, fn, *args):
+        future = concurrent.futures.Future()
+        with self.cond:
+            if key in self.pending:
+                _, _, futures = self.pending.pop(key)
+                self.superseded += 1
+            else:
+                futures = []
+            futures.append(future)
+            self.pending[key] = (fn, args, futures)
+            self.cond.notify()
+        return future
+
+    async def run(self, key, fn, *args):
+        return await asyncio.wrap_future(self.submit(key, fn, *args))
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while self.running and not self.pending:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                key = next(iter(self.pending))
+                fn, args, futures = self.pending.pop(key)
+            try:
+                result = fn(*args)
+                for future in futures:
+                    future.set_result(result)
+            except Exception as e:
+                logging.exception(f"{self.name} job {key}")
+                for future in futures:
+                    future.set_exception(e)
+
+
+import unittest
+
+class TestWaveUpdates(unittest.TestCase):
+    def setUp(self):
+        from gpio.emulator import PiGPIOEmulator, PiGPIOEmulatorServer, SquareWave
+        from gpio.sequencer import Sequencer, TriggerConfig, start_pig
+        self.config = TriggerConfig()
+        # A camera strobe every 5 ms, so the trigger script keeps cycling
+        self.emulator = PiGPIOEmulator(inputs={self.config.TRIG_IN: SquareWave(5000, 100)})
+        self.server = PiGPIOEmulatorServer(self.emulator, 'localhost', 0).start()
+        port = self.server.server_address[1]
+        self.pig = start_pig('localhost', port)
+        self.sequencer = Sequencer(self.pig, self.config)
+        self.conn = PipelinedConnection('localhost', port)
+
+    def tearDown(self):
+        self.sequencer.close()
+        self.conn.close()
+        self.pig.stop()
+        self.server.stop()
+
+    def held_wave(self):
+        _, params = self.pig.script_status(self.sequencer.script.id)
+        return params[9]
+
+    def test_coalescing(self):
+        channel = CommandChannel("TestChannel")
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def job(value):
+            started.set()
+            release.wait()
+            calls.append(value)
+            return value
+        first = channel.submit('update', job, 0)
+        started.wait()
+        futures = [channel.submit('update', job, i) for i in range(1, 5)]
+        release.set()
+        self.assertEqual(first.result(timeout=1), 0)
+        self.assertEqual([future.result(timeout=1) for future in futures], [4] * 4)
+        self.assertEqual(calls, [0, 4])
+        self.assertEqual(channel.superseded, 3)
+        channel.close()
+
+    def test_pipelined_update(self):
+        import dataclasses
+        config = dataclasses.replace(self.config, LED_TIME=500)
+        self.sequencer.update_wave_pipelined(self.conn, config)
+        ids = [wave.id for wave in self.sequencer.waves]
+        _, params = self.pig.script_status(self.sequencer.script.id)
+        self.assertEqual(list(params[:len(ids)]), ids)
+        for id in ids:
+            self.assertIn(id, self.emulator.waves)
+
+    def test_held_wave_is_never_deleted(self):
+        import time
+        import dataclasses
+        for i in range(30):
+            self.sequencer.update_wave_pipelined(self.conn, dataclasses.replace(self.config, LED_TIME=100 + i))
+            # The wave the script holds survives the update
+            self.assertIn(self.held_wave(), self.emulator.waves)
+            # Old waves are deleted eventually rather than piling up
+            self.assertLessEqual(len(self.emulator.waves), 3 * len(self.sequencer.waves))
+            time.sleep(0.002)
+        self.sequencer.update_wave(dataclasses.replace(self.config, LED_TIME=100))
+        # After a few strobes the script has moved on to the current waves
+        time.sleep(0.05)
+        self.assertIn(self.held_wave(), [wave.id for wave in self.sequencer.waves])
+        # Every wave left in pigpiod is current or retired; nothing leaked
+        live = self.sequencer.waves + self.sequencer.retired
+        self.assertEqual(sorted(self.emulator.waves), sorted(wave.id for wave in live))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,874 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for pigpiod, for exercising and benchmarking gpio/ off the Pi.
+
+It speaks the pigpio socket protocol for the commands this project uses
+(GPIO modes and levels, script store/run/update/stop/delete/status, wave
+add/create/delete/transmit and notifications) and runs scripts, waves and
+simulated input signals against a shared virtual clock.
+
+    python -m gpio.emulator --port 8888 --speed 1.0 --latency 50
+"""
+import time
+import select
+import socket
+import struct
+import logging
+import argparse
+import threading
+import socketserver
+from collections import Counter
+
+from gpio.sequencer import TriggerConfig
+
+# pigpio socket command numbers
+_PI_CMD_MODES = 0
+_PI_CMD_MODEG = 1
+_PI_CMD_READ = 3
+_PI_CMD_WRITE = 4
+_PI_CMD_BR1 = 10
+_PI_CMD_TICK = 16
+_PI_CMD_HWVER = 17
+_PI_CMD_NO = 18
+_PI_CMD_NB = 19
+_PI_CMD_NP = 20
+_PI_CMD_NC = 21
+_PI_CMD_PIGPV = 26
+_PI_CMD_WVCLR = 27
+_PI_CMD_WVAG = 28
+_PI_CMD_WVBSY = 32
+_PI_CMD_WVHLT = 33
+_PI_CMD_PROC = 38
+_PI_CMD_PROCD = 39
+_PI_CMD_PROCR = 40
+_PI_CMD_PROCS = 41
+_PI_CMD_PROCP = 45
+_PI_CMD_WVCRE = 49
+_PI_CMD_WVDEL = 50
+_PI_CMD_WVTX = 51
+_PI_CMD_WVTXR = 52
+_PI_CMD_WVNEW = 53
+_PI_CMD_NOIB = 99
+_PI_CMD_PADS = 102
+_PI_CMD_PROCU = 117
+
+# pigpio error codes
+PI_BAD_GPIO = -3
+PI_BAD_MODE = -4
+PI_BAD_LEVEL = -5
+PI_NO_HANDLE = -24
+PI_BAD_HANDLE = -25
+PI_TOO_MANY_PULSES = -36
+PI_BAD_SCRIPT = -47
+PI_BAD_SCRIPT_ID = -48
+PI_BAD_SCRIPT_CMD = -55
+PI_BAD_VAR_NUM = -56
+PI_NO_SCRIPT_ROOM = -57
+PI_TOO_MANY_PARAM = -61
+PI_BAD_TAG = -63
+PI_BAD_MICS_DELAY = -64
+PI_BAD_WAVE_ID = -66
+PI_TOO_MANY_CBS = -67
+PI_EMPTY_WAVEFORM = -69
+PI_NO_WAVEFORM_ID = -70
+PI_UNKNOWN_COMMAND = -88
+
+PI_SCRIPT_INITING = 0
+PI_SCRIPT_HALTED = 1
+PI_SCRIPT_RUNNING = 2
+PI_SCRIPT_WAITING = 3
+PI_SCRIPT_FAILED = 4
+
+class VirtualClock:
+    """
+    Microsecond clock shared by everything in the emulator. `speed` scales
+    emulated time against wall time (2.0 runs twice as fast), and
+    `start_tick` lets tests start close to the 32 bit wrap.
+    """
+
+    def __init__(self, speed=1.0, start_tick=0):
+        self.speed = speed
+        self.start_tick = start_tick
+        self.origin = time.monotonic()
+
+    def now(self):
+        """Emulated microseconds since start, as an unbounded integer."""
+        return self.start_tick + int((time.monotonic() - self.origin) * self.speed * 1e6)
+
+    def tick(self):
+        return self.now() & 0xFFFFFFFF
+
+    def sleep(self, micros):
+        time.sleep(micros / 1e6 / self.speed)
+
+class SquareWave:
+    """Periodic input signal, high for `high` µs out of every `period` µs."""
+
+    def __init__(self, period, high, phase=0):
+        self.period = period
+        self.high = high
+        self.phase = phase
+
+    def level(self, t):
+        return 1 if (t - self.phase) % self.period < self.high else 0
+
+    def edges(self, t0, t1):
+        """Yield (time, level) for every edge in (t0, t1]."""
+        k = (t0 - self.phase) // self.period
+        while True:
+            start = self.phase + k * self.period
+            if start > t1:
+                return
+            if t0 < start:
+                yield start, 1
+            if t0 < start + self.high <= t1:
+                yield start + self.high, 0
+            k += 1
+
+def sequential_field_inputs(config=None, period=8333):
+    """Simulated SLM field sync inputs for the B, G, R sequential colour fields."""
+    cf = config if config is not None else TriggerConfig()
+    return {
+        cf.BLU_IN: SquareWave(period, cf.GRN_START - cf.BLU_START, cf.BLU_START),
+        cf.GRN_IN: SquareWave(period, cf.RED_START - cf.GRN_START, cf.GRN_START),
+        cf.RED_IN: SquareWave(period, period - cf.RED_START, cf.RED_START),
+    }
+
+class EmulatedWave:
+    def __init__(self, pulses):
+        self.pulses = pulses
+        # start time of each pulse relative to the start of the wave
+        self.offsets = []
+        t = 0
+        for _, _, delay in pulses:
+            self.offsets.append(t)
+            t += delay
+        self.duration = t
+        self.cbs = 2 * len(pulses)
+
+class ScriptError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+# Number of operands of each supported script command
+_SCRIPT_ARGS = {
+    'add': 1, 'and': 1, 'call': 1, 'cmp': 1, 'dcr': 1, 'dcra': 0, 'div': 1,
+    'halt': 0, 'inr': 1, 'inra': 0, 'jm': 1, 'jmp': 1, 'jnz': 1, 'jp': 1,
+    'jz': 1, 'ld': 2, 'lda': 1, 'mlt': 1, 'mod': 1, 'or': 1, 'popa': 0,
+    'pusha': 0, 'ret': 0, 'rla': 1, 'rra': 1, 'sta': 1, 'sub': 1, 'tag': 1,
+    'x': 2, 'xa': 1, 'xor': 1,
+    # pigpio commands
+    'm': 2, 'modes': 2, 'r': 1, 'read': 1, 'w': 2, 'write': 2, 'mics': 1,
+    'mils': 1, 'pads': 2, 'tick': 0, 'wvbsy': 0, 'wvhlt': 0, 'wvtx': 1,
+    'wvtxr': 1, 'wvclr': 0,
+}
+
+class EmulatedScript:
+    """A parsed pigpio script, interpreted on its own thread."""
+
+    def __init__(self, emulator, text):
+        self.emulator = emulator
+        self.program, self.tags = self.parse(text)
+        self.params = [0] * 10
+        self.vars = [0] * 150
+        self.status = PI_SCRIPT_HALTED
+        self.generation = 0
+
+    @staticmethod
+    def parse(text):
+        tokens = ' '.join(line.split('#')[0] for line in text.lower().split('\n')).split()
+        program = []
+        tags = {}
+        i = 0
+        while i < len(tokens):
+            cmd = tokens[i]
+            if cmd not in _SCRIPT_ARGS:
+                raise ScriptError(PI_BAD_SCRIPT_CMD)
+            n = _SCRIPT_ARGS[cmd]
+            args = tokens[i + 1:i + 1 + n]
+            if len(args) < n:
+                raise ScriptError(PI_BAD_SCRIPT)
+            if cmd == 'tag':
+                tags[int(args[0])] = len(program)
+            else:
+                program.append((cmd, args))
+            i += 1 + n
+        for cmd, args in program:
+            if cmd in ('call', 'jm', 'jmp', 'jnz', 'jp', 'jz') and int(args[0]) not in tags:
+                raise ScriptError(PI_BAD_TAG)
+        return program, tags
+
+    def get(self, arg):
+        if arg[0] == 'p':
+            return self.params[int(arg[1:])]
+        elif arg[0] == 'v':
+            return self.vars[int(arg[1:])]
+        return int(arg)
+
+    def put(self, arg, value):
+        value = ((value + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+        if arg[0] == 'p':
+            self.params[int(arg[1:])] = value
+        elif arg[0] == 'v':
+            self.vars[int(arg[1:])] = value
+        else:
+            raise ScriptError(PI_BAD_VAR_NUM)
+
+    def start(self, params):
+        self.stop()
+        for i, p in enumerate(params):
+            self.params[i] = p
+        self.status = PI_SCRIPT_RUNNING
+        threading.Thread(target=self._run, args=(self.generation,), daemon=True).start()
+
+    def stop(self):
+        # The interpreter thread notices the new generation before its next
+        # command; joining here could deadlock against the emulator lock
+        self.generation += 1
+        if self.status == PI_SCRIPT_RUNNING:
+            self.status = PI_SCRIPT_HALTED
+
+    def _run(self, generation):
+        try:
+            self._interpret(generation)
+            if generation == self.generation:
+                self.status = PI_SCRIPT_HALTED
+        except Exception as e:
+            logging.exception("EmulatedScript")
+            self.status = PI_SCRIPT_FAILED
+
+    def _interpret(self, generation):
+        em = self.emulator
+        A = 0
+        F = 0
+        pc = 0
+        stack = []
+        while generation == self.generation and pc < len(self.program):
+            cmd, args = self.program[pc]
+            pc += 1
+            em.count('script:' + cmd)
+            if cmd == 'lda':
+                A = self.get(args[0])
+            elif cmd == 'sta':
+                self.put(args[0], A)
+            elif cmd == 'ld':
+                self.put(args[0], self.get(args[1]))
+            elif cmd in ('add', 'sub', 'and', 'or', 'xor', 'mlt', 'div', 'mod', 'rla', 'rra'):
+                x = self.get(args[0])
+                A = {
+                    'add': lambda: A + x, 'sub': lambda: A - x, 'and': lambda: A & x,
+                    'or': lambda: A | x, 'xor': lambda: A ^ x, 'mlt': lambda: A * x,
+                    'div': lambda: int(A / x), 'mod': lambda: A % x,
+                    'rla': lambda: A << x, 'rra': lambda: A >> x,
+                }[cmd]()
+                F = A
+            elif cmd == 'cmp':
+                F = A - self.get(args[0])
+            elif cmd in ('inr', 'dcr'):
+                F = self.get(args[0]) + (1 if cmd == 'inr' else -1)
+                self.put(args[0], F)
+            elif cmd in ('inra', 'dcra'):
+                A += 1 if cmd == 'inra' else -1
+                F = A
+            elif cmd == 'x':
+                a, b = self.get(args[0]), self.get(args[1])
+                self.put(args[0], b)
+                self.put(args[1], a)
+            elif cmd == 'xa':
+                a = self.get(args[0])
+                self.put(args[0], A)
+                A = a
+            elif cmd == 'pusha':
+                stack.append(A)
+            elif cmd == 'popa':
+                A = stack.pop()
+            elif cmd == 'jmp':
+                pc = self.tags[int(args[0])]
+            elif cmd in ('jz', 'jnz', 'jp', 'jm'):
+                taken = {'jz': F == 0, 'jnz': F != 0, 'jp': F >= 0, 'jm': F < 0}[cmd]
+                if taken:
+                    pc = self.tags[int(args[0])]
+            elif cmd == 'call':
+                stack.append(pc)
+                pc = self.tags[int(args[0])]
+            elif cmd == 'ret':
+                if not stack:
+                    break
+                pc = stack.pop()
+            elif cmd == 'halt':
+                break
+            elif cmd == 'mics':
+                em.clock.sleep(self.get(args[0]))
+            elif cmd == 'mils':
+                em.clock.sleep(1000 * self.get(args[0]))
+            else:
+                # Remaining commands map onto pigpio socket commands; their
+                # result goes into both A and F
+                A = F = em.script_command(cmd, [self.get(a) for a in args])
+
+class PiGPIOEmulator:
+    """
+    Emulated pigpiod state: GPIO modes and levels, waves, scripts and
+    notification handles, all driven by one VirtualClock.
+
+    Resource limits default to pigpio's and can be lowered to exercise
+    out-of-resource paths; `latency` adds a simulated delay (µs of wall
+    time) to every round trip.
+    """
+
+    def __init__(self, clock=None, inputs=None, latency=0, max_scripts=32,
+                 max_waves=250, max_pulses=12000, max_cbs=25016):
+        self.clock = clock if clock is not None else VirtualClock()
+        self.inputs = inputs if inputs is not None else {}
+        self.latency = latency
+        self.max_scripts = max_scripts
+        self.max_waves = max_waves
+        self.max_pulses = max_pulses
+        self.max_cbs = max_cbs
+
+        self.lock = threading.RLock()
+        self.modes = [0] * 54
+        self.outputs = 0
+        self.scripts = {}
+        self.waves = {}
+        self.pending_pulses = []
+        self.output_log = []
+        self.counts = Counter()
+
+        # Transmitting wave: id, start time, next pulse index, repeat flag
+        self.tx_wave = None
+        self.tx_start = 0
+        self.tx_index = 0
+        self.tx_repeat = False
+
+        # Notification handles: handle -> [socket, send lock, bits, seq]
+        self.notifiers = {}
+        self.notify_time = self.clock.now()
+        self.notify_levels = self.levels_at(self.notify_time)
+        self.running = True
+        self.notify_thread = threading.Thread(target=self._notify_loop, daemon=True)
+        self.notify_thread.start()
+
+    def shutdown(self):
+        self.running = False
+        for script in list(self.scripts.values()):
+            script.stop()
+
+    def count(self, name):
+        self.counts[name] += 1
+
+    # ---- levels -------------------------------------------------------
+
+    def _tx_events(self, until):
+        """Pop output events of the transmitting wave up to time `until`."""
+        events = []
+        wave = self.tx_wave
+        while wave is not None:
+            if self.tx_index == len(wave.pulses):
+                if self.tx_repeat and wave.duration > 0:
+                    self.tx_start += wave.duration
+                    self.tx_index = 0
+                else:
+                    break
+            t = self.tx_start + wave.offsets[self.tx_index]
+            if t > until:
+                break
+            on, off, _ = wave.pulses[self.tx_index]
+            events.append((t, on, off))
+            self.tx_index += 1
+        return events
+
+    def _apply_outputs(self, until):
+        # Applied events are kept until the notification thread reports them
+        for t, on, off in self._tx_events(until):
+            self.outputs = (self.outputs | on) & ~off
+            self.output_log.append((t, on, off))
+
+    def levels_at(self, t):
+        levels = self.outputs
+        for gpio, signal in self.inputs.items():
+            levels &= ~(1 << gpio)
+            levels |= signal.level(t) << gpio
+        return levels
+
+    def levels(self):
+        with self.lock:
+            now = self.clock.now()
+            self._apply_outputs(now)
+            return self.levels_at(now)
+
+    def wave_busy(self):
+        with self.lock:
+            if self.tx_wave is None:
+                return 0
+            if self.tx_repeat:
+                return 1
+            return 1 if self.clock.now() < self.tx_start + self.tx_wave.duration else 0
+
+    # ---- notifications ------------------------------------------------
+
+    def _notify_loop(self):
+        report = struct.Struct('HHII')
+        while self.running:
+            time.sleep(0.001)
+            with self.lock:
+                t0, t1 = self.notify_time, self.clock.now()
+                # Merge input edges and wave output events in time order
+                events = [(t, 0, gpio, level) for gpio, signal in self.inputs.items()
+                          for t, level in signal.edges(t0, t1)]
+                self._apply_outputs(t1)
+                events += [(t, 1, on, off) for t, on, off in self.output_log]
+                self.output_log = []
+                events.sort()
+                reports = []
+                levels = self.notify_levels
+                for t, kind, a, b in events:
+                    if kind == 0:
+                        levels = (levels & ~(1 << a)) | (b << a)
+                    else:
+                        levels = (levels | a) & ~b
+                    changed = levels ^ self.notify_levels
+                    if changed:
+                        reports.append((t, levels, changed))
+                        self.notify_levels = levels
+                self.notify_time = t1
+                notifiers = list(self.notifiers.values())
+            for sock, send_lock, bits, seq in notifiers:
+                data = bytearray()
+                for t, levels, changed in reports:
+                    if changed & bits[0]:
+                        data += report.pack(seq[0] & 0xFFFF, 0, t & 0xFFFFFFFF, levels)
+                        seq[0] += 1
+                if data:
+                    try:
+                        with send_lock:
+                            sock.sendall(data)
+                    except OSError:
+                        pass
+
+    # ---- commands -----------------------------------------------------
+
+    def script_command(self, cmd, args):
+        if cmd in ('r', 'read'):
+            return (self.levels() >> args[0]) & 1
+        elif cmd in ('w', 'write'):
+            return self.command(_PI_CMD_WRITE, args[0], args[1])
+        elif cmd in ('m', 'modes'):
+            return self.command(_PI_CMD_MODES, args[0], args[1])
+        elif cmd == 'pads':
+            return 0
+        elif cmd == 'tick':
+            return self.clock.tick()
+        elif cmd == 'wvbsy':
+            return self.wave_busy()
+        elif cmd == 'wvhlt':
+            return self.command(_PI_CMD_WVHLT, 0, 0)
+        elif cmd == 'wvclr':
+            return self.command(_PI_CMD_WVCLR, 0, 0)
+        elif cmd == 'wvtx':
+            return self.command(_PI_CMD_WVTX, args[0], 0)
+        elif cmd == 'wvtxr':
+            return self.command(_PI_CMD_WVTXR, args[0], 0)
+        raise ScriptError(PI_BAD_SCRIPT_CMD)
+
+    def command(self, cmd, p1, p2, ext=b''):
+        """Execute one socket command; returns an int or (int, extension bytes)."""
+        self.count(cmd)
+        with self.lock:
+            if cmd == _PI_CMD_MODES:
+                if not 0 <= p1 < 54:
+                    return PI_BAD_GPIO
+                if not 0 <= p2 < 8:
+                    return PI_BAD_MODE
+                self.modes[p1] = p2
+                return 0
+            elif cmd == _PI_CMD_MODEG:
+                return self.modes[p1] if 0 <= p1 < 54 else PI_BAD_GPIO
+            elif cmd == _PI_CMD_READ:
+                return (self.levels() >> p1) & 1 if 0 <= p1 < 54 else PI_BAD_GPIO
+            elif cmd == _PI_CMD_WRITE:
+                if not 0 <= p1 < 54:
+                    return PI_BAD_GPIO
+                if p2 not in (0, 1):
+                    return PI_BAD_LEVEL
+                self.modes[p1] = 1
+                self.outputs = (self.outputs & ~(1 << p1)) | (p2 << p1)
+                return 0
+            elif cmd == _PI_CMD_BR1:
+                return self.levels()
+            elif cmd == _PI_CMD_TICK:
+                return self.clock.tick()
+            elif cmd == _PI_CMD_HWVER:
+                return 0xa02082
+            elif cmd == _PI_CMD_PIGPV:
+                return 79
+            elif cmd == _PI_CMD_PADS:
+                return 0
+            elif cmd == _PI_CMD_NB:
+                if p1 not in self.notifiers:
+                    return PI_BAD_HANDLE
+                self.notifiers[p1][2][0] = p2
+                return 0
+            elif cmd == _PI_CMD_NP:
+                if p1 not in self.notifiers:
+                    return PI_BAD_HANDLE
+                self.notifiers[p1][2][0] = 0
+                return 0
+            elif cmd == _PI_CMD_NC:
+                notifier = self.notifiers.pop(p1, None)
+                if notifier is None:
+                    return PI_BAD_HANDLE
+                try:
+                    notifier[0].shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return 0
+            elif cmd == _PI_CMD_NO:
+                # Only socket notifications (NOIB) are emulated
+                return PI_NO_HANDLE
+
+            # waves
+            elif cmd == _PI_CMD_WVNEW:
+                self.pending_pulses = []
+                return 0
+            elif cmd == _PI_CMD_WVCLR:
+                self.pending_pulses = []
+                self.waves = {}
+                self.tx_wave = None
+                return 0
+            elif cmd == _PI_CMD_WVAG:
+                pulses = list(struct.iter_unpack('III', ext))
+                if len(self.pending_pulses) + len(pulses) > self.max_pulses:
+                    return PI_TOO_MANY_PULSES
+                self.pending_pulses.extend(pulses)
+                return len(self.pending_pulses)
+            elif cmd == _PI_CMD_WVCRE:
+                if not self.pending_pulses:
+                    return PI_EMPTY_WAVEFORM
+                wave = EmulatedWave(self.pending_pulses)
+                if sum(w.cbs for w in self.waves.values()) + wave.cbs > self.max_cbs:
+                    return PI_TOO_MANY_CBS
+                free = [i for i in range(self.max_waves) if i not in self.waves]
+                if not free:
+                    return PI_NO_WAVEFORM_ID
+                self.waves[free[0]] = wave
+                self.pending_pulses = []
+                return free[0]
+            elif cmd == _PI_CMD_WVDEL:
+                if p1 not in self.waves:
+                    return PI_BAD_WAVE_ID
+                if self.tx_wave is self.waves[p1]:
+                    self.tx_wave = None
+                del self.waves[p1]
+                return 0
+            elif cmd in (_PI_CMD_WVTX, _PI_CMD_WVTXR):
+                wave = self.waves.get(p1)
+                if wave is None:
+                    return PI_BAD_WAVE_ID
+                now = self.clock.now()
+                self._apply_outputs(now)
+                self.tx_wave = wave
+                self.tx_start = now
+                self.tx_index = 0
+                self.tx_repeat = (cmd == _PI_CMD_WVTXR)
+                return wave.cbs
+            elif cmd == _PI_CMD_WVBSY:
+                return self.wave_busy()
+            elif cmd == _PI_CMD_WVHLT:
+                self._apply_outputs(self.clock.now())
+                self.tx_wave = None
+                return 0
+
+            # scripts
+            elif cmd == _PI_CMD_PROC:
+                if len(self.scripts) >= self.max_scripts:
+                    return PI_NO_SCRIPT_ROOM
+                try:
+                    script = EmulatedScript(self, ext.decode())
+                except ScriptError as e:
+                    return e.code
+                except ValueError:
+                    return PI_BAD_SCRIPT
+                free = [i for i in range(self.max_scripts) if i not in self.scripts]
+                self.scripts[free[0]] = script
+                return free[0]
+            elif cmd in (_PI_CMD_PROCR, _PI_CMD_PROCU):
+                script = self.scripts.get(p1)
+                if script is None:
+                    return PI_BAD_SCRIPT_ID
+                params = [p for (p,) in struct.iter_unpack('i', ext)]
+                if len(params) > 10:
+                    return PI_TOO_MANY_PARAM
+                if cmd == _PI_CMD_PROCR:
+                    script.start(params)
+                else:
+                    script.params[:len(params)] = params
+                return 0
+            elif cmd in (_PI_CMD_PROCS, _PI_CMD_PROCD):
+                script = self.scripts.get(p1)
+                if script is None:
+                    return PI_BAD_SCRIPT_ID
+                script.stop()
+                if cmd == _PI_CMD_PROCD:
+                    del self.scripts[p1]
+                return 0
+            elif cmd == _PI_CMD_PROCP:
+                script = self.scripts.get(p1)
+                if script is None:
+                    return PI_BAD_SCRIPT_ID
+                return 44, struct.pack('11i', script.status, *script.params)
+
+        return PI_UNKNOWN_COMMAND
+
+class _CommandHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+
+    def recv_exact(self, n):
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.request.recv(n - len(buf))
+            if not chunk:
+                return None
+            buf.extend(chunk)
+        return bytes(buf)
+
+    def handle(self):
+        em = self.server.emulator
+        while True:
+            header = self.recv_exact(16)
+            if header is None:
+                break
+            cmd, p1, p2, p3 = struct.unpack('IIII', header)
+            ext = self.recv_exact(p3) if p3 else b''
+            # Model latency per round trip: commands already queued behind
+            # this one (a pipelined batch) don't pay it again
+            if em.latency and not select.select([self.request], [], [], 0)[0]:
+                time.sleep(em.latency / 1e6)
+            if cmd == _PI_CMD_NOIB:
+                # This connection becomes a notification stream
+                with em.lock:
+                    free = [i for i in range(32) if i not in em.notifiers]
+                    handle = free[0] if free else PI_NO_HANDLE
+                    if free:
+                        em.notifiers[handle] = [self.request, self.send_lock, [0], [0]]
+                result, ext_out = handle, b''
+            else:
+                result = em.command(cmd, p1, p2, ext)
+                result, ext_out = result if isinstance(result, tuple) else (result, b'')
+            try:
+                with self.send_lock:
+                    self.request.sendall(struct.pack('IIIi', cmd, p1, p2, result) + ext_out)
+            except OSError:
+                break
+
+class PiGPIOEmulatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, emulator, host='localhost', port=8888):
+        super().__init__((host, port), _CommandHandler)
+        self.emulator = emulator
+
+    def start(self):
+        """Serve from a background thread, e.g. for tests and benchmarks."""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.emulator.shutdown()
+
+import unittest
+
+class TestEmulator(unittest.TestCase):
+    """Commands are issued directly; notifications go through the socket server."""
+
+    def setUp(self):
+        self.emulator = PiGPIOEmulator(inputs={4: SquareWave(2000, 500)}, max_waves=3)
+
+    def tearDown(self):
+        self.emulator.shutdown()
+
+    def run_script(self, text, *params):
+        em = self.emulator
+        id = em.command(_PI_CMD_PROC, 0, 0, text.encode())
+        self.assertGreaterEqual(id, 0)
+        self.assertEqual(em.command(_PI_CMD_PROCR, id, 0, struct.pack(f'{len(params)}i', *params)), 0)
+        return id
+
+    def script_status(self, id, wait=True):
+        deadline = time.monotonic() + 5
+        while True:
+            _, ext = self.emulator.command(_PI_CMD_PROCP, id, 0)
+            status, *params = struct.unpack('11i', ext)
+            if not wait or status != PI_SCRIPT_RUNNING or time.monotonic() > deadline:
+                return status, params
+            time.sleep(0.001)
+
+    def create_wave(self, *pulses):
+        em = self.emulator
+        em.command(_PI_CMD_WVNEW, 0, 0)
+        em.command(_PI_CMD_WVAG, 0, 0, b''.join(struct.pack('III', *pulse) for pulse in pulses))
+        return em.command(_PI_CMD_WVCRE, 0, 0)
+
+    def test_script(self):
+        id = self.run_script("""
+            ld v0 p0            # count of rising edges to time
+            tag 1 r 4 jnz 1     # wait for input 4 to go low
+            tag 2 r 4 jz 2      # then for its rising edge
+            tick sta p1
+            tag 3 r 4 jnz 3
+            tag 4 r 4 jz 4
+            dcr v0 jnz 3
+            tick sta p2
+            tick sta v1 mics 500 tick sub v1 sta p3
+            ld p4 v0
+            ld p5 42
+            jmp 9
+            ld p5 -1            # skipped
+            tag 9
+        """, 3)
+        status, params = self.script_status(id)
+        self.assertEqual(status, PI_SCRIPT_HALTED)
+        # Three periods of the 2 ms input, give or take polling
+        self.assertAlmostEqual(params[2] - params[1], 6000, delta=500)
+        self.assertGreaterEqual(params[3], 500)
+        self.assertEqual((params[4], params[5]), (0, 42))
+
+    def test_script_stop_and_delete(self):
+        em = self.emulator
+        id = self.run_script("tag 1 inr p0 mics 100 jmp 1")
+        time.sleep(0.01)
+        self.assertEqual(self.script_status(id, wait=False)[0], PI_SCRIPT_RUNNING)
+        self.assertEqual(em.command(_PI_CMD_PROCS, id, 0), 0)
+        status, params = self.script_status(id)
+        self.assertEqual(status, PI_SCRIPT_HALTED)
+        self.assertGreater(params[0], 0)
+        # Parameters can be updated without restarting
+        self.assertEqual(em.command(_PI_CMD_PROCU, id, 0, struct.pack('2i', 7, 8)), 0)
+        self.assertEqual(self.script_status(id)[1][:2], [7, 8])
+        self.assertEqual(em.command(_PI_CMD_PROCD, id, 0), 0)
+        self.assertEqual(em.command(_PI_CMD_PROCP, id, 0), PI_BAD_SCRIPT_ID)
+
+    def test_script_errors(self):
+        em = self.emulator
+        self.assertEqual(em.command(_PI_CMD_PROC, 0, 0, b"evt 1"), PI_BAD_SCRIPT_CMD)
+        self.assertEqual(em.command(_PI_CMD_PROC, 0, 0, b"jmp 5"), PI_BAD_TAG)
+        self.assertEqual(em.command(_PI_CMD_PROC, 0, 0, b"ld p0"), PI_BAD_SCRIPT)
+        # A run time error fails the script
+        with self.assertLogs(level='ERROR'):
+            id = self.run_script("ld 5 p0")
+            self.assertEqual(self.script_status(id)[0], PI_SCRIPT_FAILED)
+
+    def test_waves(self):
+        em = self.emulator
+        self.assertEqual(em.command(_PI_CMD_WVCRE, 0, 0), PI_EMPTY_WAVEFORM)
+        pulses = [(1 << 5, 0, 300), (0, 1 << 5, 200)]
+        ids = [self.create_wave(*pulses) for _ in range(3)]
+        self.assertEqual(ids, [0, 1, 2])
+        self.assertEqual((em.waves[0].duration, em.waves[0].cbs), (500, 4))
+        self.assertEqual(self.create_wave(*pulses), PI_NO_WAVEFORM_ID)
+        # Deleting frees the id for the next wave
+        self.assertEqual(em.command(_PI_CMD_WVDEL, 1, 0), 0)
+        self.assertEqual(em.command(_PI_CMD_WVDEL, 1, 0), PI_BAD_WAVE_ID)
+        self.assertEqual(self.create_wave(*pulses), 1)
+        # Deleting the transmitting wave stops it
+        self.assertEqual(em.command(_PI_CMD_WVTXR, 2, 0), 4)
+        self.assertEqual(em.command(_PI_CMD_WVBSY, 0, 0), 1)
+        self.assertEqual(em.command(_PI_CMD_WVDEL, 2, 0), 0)
+        self.assertEqual(em.command(_PI_CMD_WVBSY, 0, 0), 0)
+        self.assertEqual(em.command(_PI_CMD_WVTX, 2, 0), PI_BAD_WAVE_ID)
+        self.assertEqual(em.command(_PI_CMD_WVCLR, 0, 0), 0)
+        self.assertEqual(em.waves, {})
+
+    def test_wave_limits(self):
+        em = PiGPIOEmulator(max_pulses=4, max_cbs=5)
+        self.addCleanup(em.shutdown)
+        em.command(_PI_CMD_WVNEW, 0, 0)
+        self.assertEqual(em.command(_PI_CMD_WVAG, 0, 0, struct.pack('III', 1, 0, 10) * 3), 3)
+        self.assertEqual(em.command(_PI_CMD_WVAG, 0, 0, struct.pack('III', 1, 0, 10) * 2), PI_TOO_MANY_PULSES)
+        self.assertEqual(em.command(_PI_CMD_WVCRE, 0, 0), PI_TOO_MANY_CBS)
+
+    def notifications(self, bits, count, setup=None):
+        """Open a NOIB stream for `bits` and return its first `count` reports."""
+        server = PiGPIOEmulatorServer(self.emulator, 'localhost', 0).start()
+        self.addCleanup(server.stop)
+        address = server.server_address
+        def command(sock, cmd, p1=0, p2=0):
+            sock.sendall(struct.pack('IIII', cmd, p1, p2, 0))
+            return struct.unpack('IIIi', sock.recv(16))[3]
+        with socket.create_connection(address) as stream, socket.create_connection(address) as control:
+            stream.settimeout(5)
+            handle = command(stream, _PI_CMD_NOIB)
+            self.assertGreaterEqual(handle, 0)
+            self.assertEqual(command(control, _PI_CMD_NB, handle, bits), 0)
+            if setup is not None:
+                setup()
+            data = bytearray()
+            while len(data) < 12 * count:
+                data += stream.recv(12 * count - len(data))
+            self.assertEqual(command(control, _PI_CMD_NC, handle), 0)
+            self.assertEqual(command(control, _PI_CMD_NC, handle), PI_BAD_HANDLE)
+        return list(struct.iter_unpack('HHII', data))
+
+    def test_input_notifications(self):
+        reports = self.notifications(1 << 4, 8)
+        self.assertEqual([seq for seq, _, _, _ in reports], list(range(8)))
+        self.assertEqual({flags for _, flags, _, _ in reports}, {0})
+        # Edges of the 2 ms input, high for 500 µs, reported at their exact ticks
+        levels = [(level >> 4) & 1 for _, _, _, level in reports]
+        self.assertEqual(levels, [levels[0], 1 - levels[0]] * 4)
+        for (_, _, t0, _), (_, _, t1, _), level in zip(reports, reports[1:], levels):
+            self.assertEqual(t1 - t0, 500 if level else 1500)
+
+    def test_wave_chain(self):
+        # A script chains wave a after wave b, as the sequencer does
+        a = self.create_wave((1 << 5, 0, 300), (0, 1 << 5, 200))
+        b = self.create_wave((1 << 6, 0, 400), (0, 1 << 6, 100))
+        id = self.emulator.command(_PI_CMD_PROC, 0, 0, b"""
+            wvtx p0 tag 1 mics 50 wvbsy jnz 1
+            wvtx p1 tag 2 mics 50 wvbsy jnz 2
+        """)
+        start = lambda: self.emulator.command(_PI_CMD_PROCR, id, 0, struct.pack('2i', a, b))
+        reports = self.notifications((1 << 5) | (1 << 6), 4, start)
+        self.assertEqual([(level >> 5) & 3 for _, _, _, level in reports], [1, 0, 2, 0])
+        ticks = [tick for _, _, tick, _ in reports]
+        self.assertEqual(ticks[1] - ticks[0], 300)
+        self.assertGreaterEqual(ticks[2] - ticks[0], 500)
+        self.assertEqual(ticks[3] - ticks[2], 400)
+
+def main():
+    parser = argparse.ArgumentParser(description='Local pigpiod emulator')
+    parser.add_argument('--host', type=str, default='localhost', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8888, help='Port to listen on')
+    parser.add_argument('--speed', type=float, default=1.0, help='Virtual clock speed relative to wall time')
+    parser.add_argument('--start-tick', type=int, default=0, help='Initial value of the tick counter')
+    parser.add_argument('--latency', type=float, default=0, help='Simulated round-trip latency in µs')
+    parser.add_argument('--field-period', type=int, default=8333, help='Period of the simulated SLM field inputs in µs')
+    parser.add_argument('--log-level', type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], default='INFO', help='Set the logging level')
+    args = parser.parse_args()
+
+    fmt = "%(threadName)-10s %(asctime)-15s %(levelname)-5s %(name)s: %(message)s"
+    logging.basicConfig(level=getattr(logging, args.log_level), format=fmt)
+
+    clock = VirtualClock(speed=args.speed, start_tick=args.start_tick)
+    emulator = PiGPIOEmulator(clock=clock, inputs=sequential_field_inputs(period=args.field_period),
+                              latency=args.latency)
+    server = PiGPIOEmulatorServer(emulator, args.host, args.port)
+    logging.info(f"pigpiod emulator listening on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Ctrl-C pressed. Bailing out")
+    finally:
+        server.server_close()
+        emulator.shutdown()
+        logging.info(f"command counts: {dict(emulator.counts)}")
+
+if __name__ == '__main__':
+    main()
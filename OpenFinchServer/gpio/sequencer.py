@@ -1,5 +1,6 @@
 from enum import Enum
 import pigpio
+import dataclasses
 from dataclasses import dataclass
 from gpio.wavegen import WaveGen
 import logging
@@ -77,8 +78,10 @@ class PiGPIOScript:
 
     def __del__(self):
         # print(f"{self} finalizing")
-        self.stop()
-        self.delete()
+        # At interpreter exit the connection may already be closed
+        if getattr(getattr(self, 'pig', None), 'connected', False):
+            self.stop()
+            self.delete()
 
     def __str__(self):
         return f"PiGPIOScript({self.pig}, id={self.id})"
@@ -153,13 +156,17 @@ def start_pig(host="localhost", port=8888):
     return pig
 
 class PiGPIOWave:
-    def __init__(self, pig, config, trigger_camera=True):
+    def __init__(self, pig, config, trigger_camera=True, id=None):
         self.pig = pig
         self.config = config
         # self.kwargs = config.__dict__
         self.wavegen = WaveGen()
         self.trigger_camera = trigger_camera
-        self.id = self.generate_wave(trigger_camera=trigger_camera)
+        if id is None:
+            self.id = self.generate_wave(trigger_camera=trigger_camera)
+        else:
+            # The wave was created elsewhere (e.g. by a PipelinedConnection)
+            self.id = id
 
     def __str__(self):
         return f"PiGPIOWave{self.pig}, id={self.id}, trigger_camera={self.trigger_camera}"
@@ -168,7 +175,9 @@ class PiGPIOWave:
         return self.__str__()
 
     def __del__(self):
-        self.delete()
+        # At interpreter exit the connection may already be closed
+        if getattr(getattr(self, 'pig', None), 'connected', False):
+            self.delete()
 
     def delete(self):
         # logging.debug(f"Deleting wave {self}")
@@ -176,8 +185,9 @@ class PiGPIOWave:
             self.pig.wave_delete(self.id)
             self.id = -1
 
-    def generate_wave(self, trigger_camera=True):
+    def generate_pulses(self, trigger_camera=True):
         cf = self.config
+        self.wavegen = WaveGen()
         
         RED_WIDTH = cf.LED_WIDTH
         GRN_WIDTH = cf.LED_WIDTH
@@ -227,10 +237,13 @@ class PiGPIOWave:
         # Add a final event to pad to desired duration
         self.wavegen.change_bit(cf.STROBE_IN, 1, cf.WAVE_DURATION)
         
+        return self.wavegen.wave_vector[:]
+
+    def generate_wave(self, trigger_camera=True):
         # Convert the wavegen changes to pigpio wave format
         wave = [
             pigpio.pulse(set_mask, clr_mask, delay)
-            for set_mask, clr_mask, delay in self.wavegen.wave_vector
+            for set_mask, clr_mask, delay in self.generate_pulses(trigger_camera)
         ]
         self.pig.wave_add_new()
         self.pig.wave_add_generic(wave)
@@ -239,12 +252,15 @@ class PiGPIOWave:
         return id
 
 class Sequencer:
-    def __init__(self, pig, config):
+    def __init__(self, pig, config, multiplex=False):
         self.pig = pig
         self.config = config
+        self.multiplex = multiplex
+        self.waves = []
+        # Waves replaced by an update that the script may still transmit
+        self.retired = []
         self.initialize_gpio()
         self.initialize_trigger()
-        self.setup_waves()
 
     def initialize_gpio(self):
         cf = self.config
@@ -255,28 +271,132 @@ class Sequencer:
         for pin in [cf.TRIG_IN, cf.RED_IN, cf.GRN_IN, cf.BLU_IN, cf.STROBE_IN]:
             self.pig.set_mode(pin, pigpio.INPUT)
 
-    def setup_waves(self):
-        self.wave_RGB = PiGPIOWave(self.pig, self.config, trigger_camera=False)
-        self.wave_RGB_trig = PiGPIOWave(self.pig, self.config, trigger_camera=True)
+    @property
+    def wave_RGB(self):
+        return self.waves[0]
+
+    @property
+    def wave_RGB_trig(self):
+        return self.waves[1]
+
+    def wave_configs(self, config):
+        """
+        The (config, trigger_camera) of each wave handed to the script, in
+        script parameter order.
+        """
+        if not self.multiplex:
+            return [(config, False), (config, True)]
+
+        # One triggered wave per colour field (B, G, R), each firing only the
+        # LEDs assigned to that field, then an idle wave for the frames in between
+        mode = config.ILLUMINATION_MODE
+        if not (len(mode) == 3 and all(c in '01234567' for c in mode)):
+            logging.warning(f"Invalid ILLUMINATION_MODE '{mode}'. Using default '421'.")
+            mode = '421'
+        field_modes = ['00' + mode[2], '0' + mode[1] + '0', mode[0] + '00']
+        waves = [(dataclasses.replace(config, ILLUMINATION_MODE=m), True) for m in field_modes]
+        waves.append((dataclasses.replace(config, ILLUMINATION_MODE='000'), False))
+        return waves
+
+    def setup_waves(self, config=None):
+        config = config if config is not None else self.config
+        self.waves = [
+            PiGPIOWave(self.pig, cf, trigger_camera=trig)
+            for cf, trig in self.wave_configs(config)
+        ]
 
     def initialize_trigger(self):
-        self.script = self.trigger_wave_script(self.pig, self.config)
+        if self.multiplex:
+            self.script = self.multiplex_wave_script(self.pig, self.config)
+        else:
+            self.script = self.trigger_wave_script(self.pig, self.config)
         # self.wave = PiGPIOWave(self.pig, self.config)
         self.setup_waves()
 
         # Wait for the script to finish initializing before starting it
         while self.script.initing():
             pass
-        self.script.start(self.wave_RGB.id, self.wave_RGB_trig.id)
+        self.script.start(*[wave.id for wave in self.waves])
+
+    def set_multiplex(self, enabled):
+        if enabled == self.multiplex:
+            return
+        self.script.stop()
+        self.script.delete()
+        for wave in self.waves + self.retired:
+            wave.delete()
+        self.retired = []
+        self.multiplex = enabled
+        self.initialize_trigger()
 
-    def update_wave(self):
-        ### XXX N.B. this implicitly depends on self.config
-        old_RGB = self.wave_RGB
-        old_RGB_trig = self.wave_RGB_trig
-        self.setup_waves()
-        self.script.set_params(self.wave_RGB.id, self.wave_RGB_trig.id)
-        # old_RGB.delete()
-        # old_RGB_trig.delete()
+    def close(self):
+        """Stop the trigger script and free it and all waves in pigpiod."""
+        self.script.stop()
+        self.script.delete()
+        for wave in self.waves + self.retired:
+            wave.delete()
+        self.waves = []
+        self.retired = []
+
+    def update_wave(self, config=None):
+        """Point the script at new waves for `config` (default: self.config)."""
+        old_waves = self.waves
+        self.setup_waves(config)
+        self.script.set_params(*[wave.id for wave in self.waves])
+        for wave in self.retire(old_waves):
+            wave.delete()
+
+    def retire(self, old_waves):
+        """
+        Add `old_waves` to the retired waves and return those that are now
+        safe to delete. The script loads a wave id into v0 before waiting for
+        the trigger, and copies it to p9. Once p9 holds an id of the current
+        waves, the script can't transmit an older one again. Until then it may
+        transmit the wave in p9, or, if it loaded v0 just before the update and
+        hasn't published it yet, any wave of the generation just replaced.
+        """
+        _, params = self.pig.script_status(self.script.id)
+        loaded = params[9]
+        if loaded in [wave.id for wave in self.waves]:
+            keep = []
+        else:
+            keep = [wave for wave in self.retired + old_waves if wave.id == loaded or wave in old_waves]
+        deletable = [wave for wave in self.retired + old_waves if wave not in keep]
+        self.retired = keep
+        return deletable
+
+    def update_wave_pipelined(self, conn, config=None):
+        """
+        Same as update_wave(), but batched over a PipelinedConnection: one
+        round trip creates the new waves and a second one points the script
+        at them. Replaced waves are deleted once the script can no longer
+        be using them (see retire()), possibly in a later update.
+        """
+        config = config if config is not None else self.config
+        waves = [PiGPIOWave(self.pig, cf, trigger_camera=trig, id=-1) for cf, trig in self.wave_configs(config)]
+        commands = []
+        for wave in waves:
+            commands += conn.wave_commands(wave.generate_pulses(wave.trigger_camera))
+        results = conn.execute(commands)
+        # every third result is a wave_create() return value
+        ids = results[2::3]
+        errors = [res for res in results if res < 0]
+        if errors:
+            for id in ids:
+                if id >= 0:
+                    conn.execute([conn.wave_delete_command(id)])
+            raise pigpio.error(pigpio.error_text(errors[0]))
+        for wave, id in zip(waves, ids):
+            wave.id = id
+
+        old_waves = self.waves
+        conn.execute([conn.update_script_command(self.script.id, ids)])
+        self.waves = waves
+        deletable = [wave for wave in self.retire(old_waves) if wave.id >= 0]
+        if deletable:
+            conn.execute([conn.wave_delete_command(wave.id) for wave in deletable])
+        for wave in deletable:
+            wave.id = -1
         
     def trigger_wave_script(self, pig, config):
         script = f"""
@@ -297,12 +417,15 @@ class Sequencer:
         lda v3 or 0 jz 116  # if the wave repeat counter is 0, jmp to 116
         ld v0 p0            # load the RGB wave id into v0
         dcr v3              # decrement the wave repeat counter
-        jmp 120
+        jmp 119
         
     tag 116                 # wave repeat counter is zero
         ld v0 p1            # load the RGB+trig wave id into v0
         lda 3 sta v3        # load the RGB wave repeat counter into v3
-        jmp 120
+        jmp 119
+
+    tag 119
+        ld p9 v0            # publish the wave id we hold, so old waves can be deleted safely
 
     tag 120
         r p2 jnz 121        # read the GPIO and jump out of loop if it's high
@@ -325,3 +448,68 @@ class Sequencer:
         """
 
         return PiGPIOScript(pig, script)
+
+    def multiplex_wave_script(self, pig, config):
+        script = f"""
+        pads 0 16								# set pad drivers to 16 mA
+
+        # we expect the B, G and R field wave ids (each with a camera
+        # trigger) in p0, p1, p2 and the idle wave id in p3
+        lda {config.TRIG_IN} sta p4
+        lda 0 sta v3        # idle waves left before the next triggered wave
+        lda 0 sta v4        # field of the next triggered wave (0=B, 1=G, 2=R)
+
+    tag 100
+        lda p3         		# load the current value of p3
+        or 0 jp 115    		# if p3 is valid (>=0), proceed
+        mics 101      		# otherwise delay for a bit
+        jmp 100       		# and try again
+
+    tag 115
+        lda v3 or 0 jz 116  # if the idle wave counter is 0, jmp to 116
+        ld v0 p3            # load the idle wave id into v0
+        dcr v3              # decrement the idle wave counter
+        jmp 119
+
+    tag 116                 # idle wave counter is zero
+        lda 3 sta v3        # reload the idle wave counter
+        lda v4 or 0 jz 117  # field 0: B
+        lda v4 cmp 1 jz 118 # field 1: G
+        ld v0 p2            # field 2: R
+        lda 0 sta v4
+        jmp 119
+
+    tag 117
+        ld v0 p0
+        lda 1 sta v4
+        jmp 119
+
+    tag 118
+        ld v0 p1
+        lda 2 sta v4
+        jmp 119
+
+    tag 119
+        ld p9 v0            # publish the wave id we hold, so old waves can be deleted safely
+
+    tag 120
+        r p4 jnz 121        # read the GPIO and jump out of loop if it's high
+        mics 101           	# otherwise delay for a bit
+        jmp 120            	# and continue polling
+    tag 121
+
+    tag 130
+        r p4 jnz 130		# wait for falling edge on p4
+
+        wvtx v0				# trigger the wave
+
+    tag 140
+        mics 101			# delay for a bit
+        wvbsy
+        jnz 140 			# wait for wave to finish
+
+        jmp 100				# do it again
+        ret
+        """
+
+        return PiGPIOScript(pig, script)
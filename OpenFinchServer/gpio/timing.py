@@ -0,0 +1,230 @@
+import time
+import logging
+import threading
+import numpy as np
+import pigpio
+
+# One entry per observed GPIO level change. The tick is pigpio's raw 32 bit
+# microsecond counter; timestamp is the same instant in nanoseconds on the
+# camera clock so that edges can be compared directly with SensorTimestamp.
+EDGE_DTYPE = np.dtype([
+    ('timestamp', np.int64),
+    ('tick', np.uint32),
+    ('gpio', np.uint8),
+    ('level', np.uint8),
+])
+
+class EdgeRing:
+    """Fixed-capacity ring buffer of GPIO edges, oldest entries are overwritten."""
+
+    def __init__(self, capacity=16384):
+        self.capacity = capacity
+        self.edges = np.zeros(capacity, dtype=EDGE_DTYPE)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, tick, gpio, level):
+        with self.lock:
+            self.edges[self.count % self.capacity] = (timestamp, tick, gpio, level)
+            self.count += 1
+
+    def snapshot(self):
+        """Return a time-ordered copy of the edges currently held."""
+        with self.lock:
+            if self.count <= self.capacity:
+                return self.edges[:self.count].copy()
+            start = self.count % self.capacity
+            return np.concatenate((self.edges[start:], self.edges[:start]))
+
+    def between(self, t0, t1):
+        """
+        A copy of the edges with t0 <= timestamp <= t1. Edges are appended in
+        time order, so the ring holds at most two sorted runs, each searched
+        with a binary search instead of scanning the whole ring.
+        """
+        with self.lock:
+            held = min(self.count, self.capacity)
+            start = self.count % self.capacity if self.count > self.capacity else 0
+            parts = []
+            for run in (self.edges[start:held], self.edges[:start]):
+                lo = np.searchsorted(run['timestamp'], t0, 'left')
+                hi = np.searchsorted(run['timestamp'], t1, 'right')
+                if hi > lo:
+                    parts.append(run[lo:hi])
+            return np.concatenate(parts) if parts else np.zeros(0, dtype=EDGE_DTYPE)
+
+    def clear(self):
+        with self.lock:
+            self.count = 0
+
+class TimingRecorder:
+    """
+    Records the measured edges of the trigger, strobe and LED lines through
+    pigpio callbacks and joins them to frames by their SensorTimestamp.
+
+    pigpio reports edges with its hardware tick, which is converted to the
+    camera clock (CLOCK_BOOTTIME for libcamera) using an offset that is
+    re-estimated every `sync_interval` seconds to follow drift and wrap.
+    """
+
+    def __init__(self, pig, config, capacity=16384, clock_id=time.CLOCK_BOOTTIME,
+                 sync_interval=10.0, window=20_000_000):
+        self.pig = pig
+        self.config = config
+        self.ring = EdgeRing(capacity)
+        self.clock_id = clock_id
+        self.sync_interval = sync_interval
+        self.window = window  # ns either side of SensorTimestamp to search for the trigger
+        self.callbacks = []
+        self.sync_lock = threading.Lock()
+        self.tick_origin = 0
+        self.clock_origin = 0
+        self.last_sync = 0
+
+        cf = self.config
+        self.led_names = {cf.RED_OUT: 'red', cf.GRN_OUT: 'green', cf.BLU_OUT: 'blue'}
+        self.gpios = [cf.TRIG_IN, cf.STROBE_IN, cf.TRIG_OUT, *self.led_names]
+
+    def __del__(self):
+        self.stop()
+
+    def start(self):
+        self.sync_clock()
+        for gpio in self.gpios:
+            self.callbacks.append(self.pig.callback(gpio, pigpio.EITHER_EDGE, self._on_edge))
+        logging.info(f"TimingRecorder monitoring GPIOs {self.gpios}")
+
+    def stop(self):
+        for cb in self.callbacks:
+            try:
+                cb.cancel()
+            except Exception as e:
+                pass
+        self.callbacks = []
+
+    def sync_clock(self):
+        # Bracket the tick read with two clock reads and take the midpoint
+        t0 = time.clock_gettime_ns(self.clock_id)
+        tick = self.pig.get_current_tick()
+        t1 = time.clock_gettime_ns(self.clock_id)
+        with self.sync_lock:
+            self.tick_origin = tick
+            self.clock_origin = (t0 + t1) // 2
+            self.last_sync = time.monotonic()
+
+    def tick_to_ns(self, tick):
+        with self.sync_lock:
+            # signed 32 bit difference handles the tick wrapping every ~71.6 minutes
+            delta = ((tick - self.tick_origin + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+            return self.clock_origin + delta * 1000
+
+    def _on_edge(self, gpio, level, tick):
+        if level == pigpio.TIMEOUT:
+            return
+        self.ring.append(self.tick_to_ns(tick), tick, gpio, level)
+
+    def maybe_sync(self):
+        if time.monotonic() - self.last_sync >= self.sync_interval:
+            try:
+                self.sync_clock()
+            except Exception as e:
+                logging.exception("TimingRecorder.sync_clock()")
+
+    def frame_timing(self, sensor_timestamp):
+        """
+        Find the measured edges belonging to the frame exposed at
+        `sensor_timestamp` (ns). Returns a dict of timestamps in ns, or
+        None if no trigger edge was seen near that time.
+        """
+        cf = self.config
+        # Only the edges that can belong to this frame: the trigger within
+        # `window`, the TRIG_IN edge before it and the wave after it
+        edges = self.ring.between(sensor_timestamp - 2 * self.window,
+                                  sensor_timestamp + self.window + cf.WAVE_DURATION * 1000)
+
+        # The camera trigger is active low, so exposure starts on the falling edge
+        trig = edges[(edges['gpio'] == cf.TRIG_OUT) & (edges['level'] == 0)]
+        if len(trig) == 0:
+            return None
+        nearest = np.argmin(np.abs(trig['timestamp'] - sensor_timestamp))
+        trig_time = int(trig['timestamp'][nearest])
+        if abs(trig_time - sensor_timestamp) > self.window:
+            return None
+
+        timing = {'TriggerTimestamp': trig_time}
+
+        # The wave (and hence the trigger) is started by the falling edge of TRIG_IN
+        trig_in = edges[(edges['gpio'] == cf.TRIG_IN) & (edges['level'] == 0)
+                        & (edges['timestamp'] <= trig_time)]
+        if len(trig_in):
+            timing['TriggerInTimestamp'] = int(trig_in['timestamp'][-1])
+
+        wave_end = trig_time + cf.WAVE_DURATION * 1000
+        in_wave = edges[(edges['timestamp'] >= trig_time) & (edges['timestamp'] <= wave_end)]
+
+        strobe = in_wave[(in_wave['gpio'] == cf.STROBE_IN) & (in_wave['level'] == 1)]
+        if len(strobe):
+            timing['StrobeTimestamp'] = int(strobe['timestamp'][0])
+
+        leds = {}
+        for gpio, name in self.led_names.items():
+            on = in_wave[(in_wave['gpio'] == gpio) & (in_wave['level'] == 1)]
+            if len(on):
+                leds[name] = [int(t) for t in on['timestamp']]
+        timing['LedTimestamps'] = leds
+        return timing
+
+    def annotate(self, metadata):
+        """
+        Add the measured frame timing to `metadata`, in place so that other
+        frames sharing the dict (e.g. a lores view) get it too. Returns it.
+        """
+        self.maybe_sync()
+        sensor_timestamp = metadata.get('SensorTimestamp')
+        if sensor_timestamp is None:
+            return metadata
+        timing = self.frame_timing(sensor_timestamp)
+        if timing is not None:
+            metadata.update(timing)
+            # LED delay relative to the trigger, in µs, to compare with LED_TIME
+            metadata['LedDelays'] = {
+                name: [(t - timing['TriggerTimestamp']) // 1000 for t in times]
+                for name, times in timing['LedTimestamps'].items()
+            }
+        return metadata
+
+
+import unittest
+
+class TestFrameTiming(unittest.TestCase):
+    def test_between_across_wrap(self):
+        ring = EdgeRing(capacity=8)
+        for t in range(20):
+            ring.append(t * 10, t, 0, t & 1)
+        self.assertEqual(list(ring.between(125, 175)['timestamp']), [130, 140, 150, 160, 170])
+        self.assertEqual(list(ring.between(0, 115)['timestamp']), [])
+        self.assertEqual(len(ring.between(0, 1000)), 8)
+
+    def test_frame_timing(self):
+        from gpio.sequencer import TriggerConfig
+        cf = TriggerConfig()
+        recorder = TimingRecorder(None, cf, capacity=64)
+        # No pigpio here; the edges below are already in clock time
+        recorder.last_sync = time.monotonic()
+        period = 10_000_000
+        for frame in range(10):
+            t = frame * period
+            recorder.ring.append(t, 0, cf.TRIG_IN, 0)
+            recorder.ring.append(t + 50_000, 0, cf.TRIG_OUT, 0)
+            recorder.ring.append(t + 450_000, 0, cf.RED_OUT, 1)
+        metadata = recorder.annotate({'SensorTimestamp': 5 * period + 100_000})
+        self.assertEqual(metadata['TriggerTimestamp'], 5 * period + 50_000)
+        self.assertEqual(metadata['TriggerInTimestamp'], 5 * period)
+        self.assertEqual(metadata['LedDelays'], {'red': [400]})
+        self.assertNotIn('TriggerTimestamp', recorder.annotate({'SensorTimestamp': 50 * period}))
+
+if __name__ == '__main__':
+    unittest.main()
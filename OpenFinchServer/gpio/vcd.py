@@ -0,0 +1,60 @@
+class VCDWriter:
+    """
+    Incremental Value Change Dump writer for a set of single-bit signals.
+
+    Levels are passed as 32 bit GPIO masks (bit n = GPIO n), and only the
+    signals that actually changed are written. A timestamp line is emitted
+    only when the time advances, so repeated calls at the same time are
+    merged into a single step.
+    """
+
+    def __init__(self, file, signals, timescale="1 us", version="OpenFinch"):
+        # signals maps a bit index to a signal name
+        self.file = file
+        self.signals = dict(sorted(signals.items()))
+        self.timescale = timescale
+        self.version = version
+        # VCD identifiers are short printable strings
+        self.ids = {bit: chr(33 + i) for i, bit in enumerate(self.signals)}
+        self.mask = 0
+        for bit in self.signals:
+            self.mask |= (1 << bit)
+        self.last_levels = None
+        self.last_time = None
+
+    def write_header(self, initial_levels=0, time=0):
+        f = self.file
+        f.write(f"$version {self.version} $end\n")
+        f.write(f"$timescale {self.timescale} $end\n")
+        f.write("$scope module gpio $end\n")
+        for bit, name in self.signals.items():
+            f.write(f"$var wire 1 {self.ids[bit]} {name} $end\n")
+        f.write("$upscope $end\n")
+        f.write("$enddefinitions $end\n")
+        f.write(f"#{time}\n")
+        f.write("$dumpvars\n")
+        for bit in self.signals:
+            f.write(f"{(initial_levels >> bit) & 1}{self.ids[bit]}\n")
+        f.write("$end\n")
+        self.last_levels = initial_levels & self.mask
+        self.last_time = time
+
+    def write(self, time, levels):
+        levels &= self.mask
+        changed = levels ^ self.last_levels
+        if not changed:
+            return
+        if time < self.last_time:
+            raise ValueError("Time of change is less than current time")
+        lines = []
+        if time != self.last_time:
+            lines.append(f"#{time}\n")
+        for bit in self.signals:
+            if (changed >> bit) & 1:
+                lines.append(f"{(levels >> bit) & 1}{self.ids[bit]}\n")
+        self.file.write(''.join(lines))
+        self.last_levels = levels
+        self.last_time = time
+
+    def flush(self):
+        self.file.flush()
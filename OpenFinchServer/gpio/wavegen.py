@@ -1,3 +1,5 @@
+from gpio.vcd import VCDWriter
+
 class WaveGen:
     def __init__(self):
         self._changes = []
@@ -21,38 +23,14 @@ class WaveGen:
         return self.BusVector(self.changes)
 
     def write_vcd(self, filename: str, num_bits: int = 4) -> None:
+        """Write the planned wave to a VCD file, with times in microseconds."""
         with open(filename, 'w') as vcd_file:
-            # Standard VCD file header
-            vcd_file.write("$version Generated by WaveGen $end\n")
-            vcd_file.write("$timescale 1 ns $end\n") # Defining the time scale as 1 nanosecond
-
-            # Variable definitions for each bit
-            for i in range(num_bits):
-                # Defining a separate variable for each bit with an identifier "b" followed by the index
-                vcd_file.write(f"$var wire 1 b{i} bit{i} $end\n")
-
-            # End of the definitions section
-            vcd_file.write("$enddefinitions $end\n")
-            
-            # Initial dummy timestamp to avoid issues with some VCD viewers
-            vcd_file.write("$dumpvars\n")
-            for i in range(num_bits):
-                # Initializing each bit to the value zero
-                vcd_file.write(f"0b{i}\n")
-            vcd_file.write("$end\n")
-            
-            # Changes for wave vector
-            waveform = self.wave_vector
-            cumulative_time = 0
-            for set_mask, clr_mask, delay in waveform:
-                vcd_file.write(f"#{cumulative_time}\n") # Absolute timestamp
-                cumulative_time += delay
-                for i in range(num_bits):
-                    # Check if the bit is set or cleared at this time step
-                    if (set_mask >> i) & 1:
-                        vcd_file.write(f"1b{i}\n")
-                    elif (clr_mask >> i) & 1:
-                        vcd_file.write(f"0b{i}\n")
+            vcd = VCDWriter(vcd_file, {i: f"bit{i}" for i in range(num_bits)}, version="Generated by WaveGen")
+            vcd.write_header(0)
+            # The bus vector holds the absolute time of every state, so
+            # zero-delay steps don't shift the timeline
+            for time, mask in self.bus_vector:
+                vcd.write(time, mask)
                     
     class BusVector:
         def __init__(self, changes):
@@ -190,6 +168,22 @@ class TestWaveGen(unittest.TestCase):
             (0b0000, 0b1000,  0),  # (3, 0, 40)
         ]
         self.assertEqual(wavegen.wave_vector[:], expected_result)
+
+    def test_vcd_writer_times(self):
+        import io
+        wavegen = WaveGen()
+        wavegen.change_bit(0, 1, 10)
+        wavegen.change_bit(1, 1, 10)
+        wavegen.change_bit(0, 0, 20)
+        wavegen.change_bit(1, 0, 40)
+        out = io.StringIO()
+        vcd = VCDWriter(out, {0: "bit0", 1: "bit1"})
+        vcd.write_header(0)
+        for time, mask in wavegen.bus_vector:
+            vcd.write(time, mask)
+        body = out.getvalue().split("$dumpvars\n")[1]
+        expected_result = "0!\n0\"\n$end\n#10\n1!\n1\"\n#20\n0!\n#40\n0\"\n"
+        self.assertEqual(body, expected_result)
     
 def test_vcd_writer():
     wavegen = WaveGen()
@@ -4,8 +4,8 @@ from web.server import CameraServer
 import argparse
 import pigpio
 
-def del_all_procs():
-    pi = pigpio.pi()
+def del_all_procs(host="localhost", port=8888):
+    pi = pigpio.pi(host, port)
     if not pi.connected:
         logging.error("Could not connect to pigpio daemon. Is it running?")
         return
@@ -34,6 +34,16 @@ def main():
     parser.add_argument('--log-file', type=str, help='Direct logging to a specified file')
     parser.add_argument('--delprocs', action='store_true', help='Delete all existing procs')
     parser.add_argument('--set-trigger-mode', type=int, choices=[0, 1], nargs='?', const=1, default=None, help='Set trigger mode for imx296 module (0 or 1, default: 1 if argument given without value)')
+    parser.add_argument('--pigpio-host', type=str, default='localhost', help='Host running pigpiod (or the gpio.emulator stand-in)')
+    parser.add_argument('--pigpio-port', type=int, default=8888, help='Port of pigpiod')
+    parser.add_argument('--camera', type=str, choices=['picamera2', 'synthetic', 'replay'], default='picamera2', help='Camera backend (synthetic and replay need no hardware)')
+    parser.add_argument('--synthetic-size', type=str, default='1456x1088', help='Frame size of the synthetic camera, e.g. 1456x1088')
+    parser.add_argument('--synthetic-format', type=str, choices=['jpeg', 'yuyv', 'yuv420', 'raw'], default='jpeg', help='Frame format of the synthetic camera')
+    parser.add_argument('--synthetic-fps', type=float, default=60.0, help='Frame rate of the synthetic camera')
+    parser.add_argument('--replay-path', type=str, default='recording', help='Base path of the recording to replay (see record_frames)')
+    parser.add_argument('--replay-speed', type=float, default=1.0, help='Replay speed relative to the original timestamps; 0 replays as fast as frames are consumed')
+    parser.add_argument('--replay-loop', action='store_true', help='Restart the replay at the end of the recording')
+    parser.add_argument('--calibration-path', type=str, default='calibration', help='Directory of dark and flat calibration frames')
     parser.add_argument('--color-gains', type=str, help='Set color gains as a comma-separated pair (e.g., "1.5,1.2" for red and blue gains)')
     # Add an argument for setting the logging level
     parser.add_argument('--log-level', type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], default='INFO', help='Set the logging level')
@@ -59,7 +69,7 @@ def main():
         logging.info(f"starting {__name__}")
 
         if args.delprocs:
-            del_all_procs()
+            del_all_procs(args.pigpio_host, args.pigpio_port)
 
         if args.set_trigger_mode is not None:
             set_trigger_mode(args.set_trigger_mode)
@@ -73,7 +83,16 @@ def main():
                 logging.error("Invalid format for --color-gains. Expected format: 'red_gain,blue_gain'")
                 exit(1)
 
-        server = CameraServer()
+        camera_options = {}
+        if args.camera == 'synthetic':
+            width, height = map(int, args.synthetic_size.split('x'))
+            camera_options = dict(width=width, height=height, format=args.synthetic_format, fps=args.synthetic_fps)
+        elif args.camera == 'replay':
+            camera_options = dict(path=args.replay_path, speed=args.replay_speed, loop=args.replay_loop)
+
+        server = CameraServer(pigpio_host=args.pigpio_host, pigpio_port=args.pigpio_port,
+                              camera=args.camera, camera_options=camera_options,
+                              calibration_path=args.calibration_path)
 
         app = web.Application()
         app.router.add_get('/', server.handle_http)
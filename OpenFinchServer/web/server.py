@@ -14,10 +14,20 @@ import base64
 from utils.display import Display
 from camera.controllers.system import SystemController
 from camera.captures.abstract import AbstractCameraController
-from camera.captures.picamera2 import Picamera2Controller
-from camera.captures.v4l2 import V4L2CameraController
 from camera.utils.utils import BoundedQueue
-from camera.utils.utils import BooleanControl, IntegerControl, FloatControl, MenuControl
+from camera.utils.multiplex import SubframeDemultiplexer, pack_field_patterns
+from camera.utils import events
+from camera.utils.history import MetadataHistory
+from camera.utils.binning import bin_image, parse_binning
+from camera.utils.pipeline import make_stage
+from camera.utils.utils import BooleanControl, IntegerControl, FloatControl, MenuControl, npy_bytes
+
+# Encodings a subscriber can receive frames in:
+#   'native'  compressed frames exactly as the camera delivered them, others as JPEG
+#   'jpeg'    grayscale JPEG at JPEG_QUALITY, re-encoding compressed frames
+#   'raw'     8-bit luma, width * height bytes
+FRAME_ENCODINGS = ('native', 'jpeg', 'raw')
+COMPRESSED_FORMATS = ('jpeg', 'MJPEG', 'JPEG')
 
 class MessageHandler:
     def __init__(self, camera_server):
@@ -26,6 +36,7 @@ class MessageHandler:
             'sweep_enable': self.handle_sweep_enable,
             'update_controls': self.handle_update_controls,
             'capture_mode': self.handle_capture_mode,
+            'sensor_roi': self.handle_sensor_roi,
             'JPEG_QUALITY': self.handle_jpeg_quality,
             'LED_TIME': lambda data, ws: self.handle_config_control('LED_TIME', data, ws),
             'LED_WIDTH': lambda data, ws: self.handle_config_control('LED_WIDTH', data, ws),
@@ -48,9 +59,27 @@ class MessageHandler:
             'send_fps_updates': self.handle_fps_updates,
             'stream_frames': self.handle_stream_frames,
             'use_base64_encoding': self.handle_use_base64_encoding,
+            'frame_encoding': self.handle_frame_encoding,
+            'binning': self.handle_binning,
             'image_request': self.handle_image_request,
             'slm_image_url': self.handle_display_image_url,
             'slm_image': self.handle_slm_image,
+            'gpio_capture': self.handle_gpio_capture,
+            'record_frames': self.handle_record_frames,
+            'archive_frames': self.handle_archive_frames,
+            'event_recording': self.handle_event_recording,
+            'history_request': self.handle_history_request,
+            'capture_burst': self.handle_capture_burst,
+            'accumulate': self.handle_accumulate,
+            'stream_accumulated': self.handle_stream_accumulated,
+            'accumulator_request': self.handle_accumulator_request,
+            'pixel_stats': self.handle_pixel_stats,
+            'pixel_stats_request': self.handle_pixel_stats_request,
+            'pipeline': self.handle_pipeline,
+            'calibration': self.handle_calibration,
+            'subframe_multiplex': self.handle_subframe_multiplex,
+            'stream_subframes': self.handle_stream_subframes,
+            'slm_field_patterns': self.handle_slm_field_patterns,
         }
 
     async def parse_message(self, data, ws):
@@ -91,6 +120,17 @@ class MessageHandler:
         self.camera_server.sysctrl.set_capture_mode(mode)
         logging.debug(f"Camera mode set to {mode}")
 
+    async def handle_sensor_roi(self, data, ws):
+        # e.g. {'value': [x, y, width, height]}, {'value': None} for the full sensor, or {} to ask
+        if 'value' not in data:
+            geometry = self.camera_server.sysctrl.get_geometry()
+            await self.camera_server.send_str(ws, json.dumps({'sensor_roi': geometry}))
+            return
+        try:
+            await self.camera_server.set_roi(data['value'])
+        except ValueError as e:
+            await self.camera_server.send_str(ws, json.dumps({'sensor_roi': {'error': str(e)}}))
+
     async def handle_jpeg_quality(self, data, ws):
         self.camera_server.jpeg_quality = int(data.get('value', 10))
 
@@ -116,6 +156,24 @@ class MessageHandler:
         self.camera_server.active_connections[ws]['use_base64_encoding'] = data.get('value', True)
         logging.info(f"base64 encoding {'enabled' if self.camera_server.active_connections[ws]['use_base64_encoding'] else 'disabled'} for {ws}")
 
+    async def handle_frame_encoding(self, data, ws):
+        encoding = data.get('value', 'native')
+        if encoding not in FRAME_ENCODINGS:
+            logging.warning(f"Invalid frame encoding '{encoding}'. Choose one of {FRAME_ENCODINGS}.")
+            return
+        self.camera_server.active_connections[ws]['frame_encoding'] = encoding
+        logging.info(f"Frame encoding set to {encoding} for {ws}")
+
+    async def handle_binning(self, data, ws):
+        # e.g. {'factor': 4, 'mode': 'mean', 'roi': [x, y, w, h]}; factor 1 without a roi turns binning off
+        try:
+            binning = parse_binning(data)
+        except ValueError as e:
+            logging.warning(str(e))
+            return
+        self.camera_server.active_connections[ws]['binning'] = binning
+        logging.info(f"Binning set to {binning} for {ws}")
+
     async def handle_image_request(self, data, ws):
         logging.debug(f"CameraServer.handle_image_request() was called")
         return
@@ -145,6 +203,213 @@ class MessageHandler:
         logging.info(f"img has type {type(img)} and size {img.size}")
         self.camera_server.display.display_image(img)
 
+    async def handle_gpio_capture(self, data, ws):
+        if data.get('value', False):
+            filename = data.get('filename', 'gpio_capture.vcd')
+            format = data.get('format', 'vcd')
+            self.camera_server.sysctrl.start_gpio_capture(filename, format=format)
+            logging.info(f"GPIO capture started to {filename} ({format})")
+        else:
+            self.camera_server.sysctrl.stop_gpio_capture()
+            logging.info("GPIO capture stopped")
+
+    async def handle_record_frames(self, data, ws):
+        if data.get('value', False):
+            path = data.get('path', 'recording')
+            max_frames = int(data.get('max_frames', 10000))
+            self.camera_server.sysctrl.start_recording(path, max_frames=max_frames)
+            logging.info(f"Frame recording started to {path} ({max_frames} frames)")
+        else:
+            self.camera_server.sysctrl.stop_recording()
+            logging.info("Frame recording stopped")
+
+    async def handle_archive_frames(self, data, ws):
+        if data.get('value', False):
+            path = data.get('path', 'archive')
+            codec = data.get('codec', 'zlib')
+            self.camera_server.sysctrl.start_archive(path, codec=codec, level=data.get('level'),
+                                                     chunk_frames=int(data.get('chunk_frames', 16)))
+            logging.info(f"Frame archiving started to {path} ({codec})")
+        else:
+            self.camera_server.sysctrl.stop_archive()
+            logging.info("Frame archiving stopped")
+
+    async def handle_event_recording(self, data, ws):
+        if not data.get('value', False):
+            self.camera_server.sysctrl.stop_event_recording()
+            logging.info("Event recording stopped")
+            return
+        # e.g. {'key': 'roi_sum', 'roi': [x, y, w, h], 'threshold': 1e6, 'trigger': 'above'}
+        key = data.get('key', 'roi_sum')
+        threshold = float(data.get('threshold', 0))
+        if key == 'roi_sum':
+            statistic = events.roi_sum(data.get('roi'))
+        elif key == 'saturation_count':
+            statistic = events.saturation_count(int(data.get('level', 255)))
+        else:
+            # Trigger on a metadata value
+            statistic = None
+        if data.get('trigger', 'above') == 'jump':
+            predicate = events.jump(key, threshold)
+        else:
+            predicate = events.above(key, threshold)
+        path = data.get('path', 'event')
+        self.camera_server.sysctrl.start_event_recording(
+            path, predicate, statistic=statistic,
+            pre_seconds=float(data.get('pre_seconds', 2.0)),
+            post_seconds=float(data.get('post_seconds', 2.0)),
+            max_bytes=int(data.get('max_bytes', 256 << 20)))
+        logging.info(f"Event recording to {path}_* when {key} {data.get('trigger', 'above')} {threshold}")
+
+    async def handle_history_request(self, data, ws):
+        # e.g. {'columns': ['sensor_timestamp', 'led_delay'], 'start': 1000, 'stop': 2000, 'by': 'frame_number'}
+        try:
+            blob = self.camera_server.history.query_npy(
+                data.get('columns'), data.get('start'), data.get('stop'), data.get('by', 'frame_number'))
+        except ValueError as e:
+            await self.camera_server.send_str(ws, json.dumps({'history_response': {'error': str(e)}}))
+            return
+        await self.camera_server.send_str_and_bytes(ws, json.dumps({
+            'history_response': {'format': 'npy', 'request': data}}), blob)
+
+    async def handle_capture_burst(self, data, ws):
+        # e.g. {'n': 32, 'after_seq': 1234, 'roi': [x, y, width, height]}
+        try:
+            burst = await self.camera_server.capture_burst(
+                int(data.get('n', 16)), data.get('after_seq'), data.get('roi'))
+        except ValueError as e:
+            await self.camera_server.send_str(ws, json.dumps({'burst_response': {'error': str(e)}}))
+            return
+        await self.camera_server.send_str_and_bytes(ws, json.dumps({
+            'burst_response': {'format': 'npz', 'request': data, **burst.summary()}}), burst.to_npz())
+
+    async def handle_accumulate(self, data, ws):
+        # e.g. {'value': True, 'n': 64, 'mode': 'mean', 'roi': [x, y, w, h]}, or {'value': False} to stop
+        sysctrl = self.camera_server.sysctrl
+        if not data.get('value', True):
+            sysctrl.stop_accumulator()
+            logging.info("Frame accumulation stopped")
+            return
+        try:
+            sysctrl.start_accumulator(n=int(data.get('n', 16)), mode=data.get('mode', 'mean'),
+                                      alpha=float(data.get('alpha', 0.1)), roi=data.get('roi'))
+        except ValueError as e:
+            await self.camera_server.send_str(ws, json.dumps({'accumulator_response': {'error': str(e)}}))
+
+    async def handle_stream_accumulated(self, data, ws):
+        self.camera_server.active_connections[ws]['stream_accumulated'] = data.get('value', True)
+        logging.info(f"Accumulated image streaming {'enabled' if self.camera_server.active_connections[ws]['stream_accumulated'] else 'disabled'} for {ws}")
+
+    async def handle_accumulator_request(self, data, ws):
+        # {'partial': True} returns the accumulation in progress rather than the last published result
+        accumulator = self.camera_server.sysctrl.accumulator
+        result = None
+        if accumulator is not None:
+            result = accumulator.snapshot() if data.get('partial', False) else accumulator.latest
+        if result is None:
+            await self.camera_server.send_str(ws, json.dumps({'accumulator_response': {'error': 'nothing accumulated'}}))
+            return
+        image, info = result
+        await self.camera_server.send_str_and_bytes(ws, json.dumps({
+            'accumulator_response': {'format': 'npy', **info}}), npy_bytes(image))
+
+    async def handle_pixel_stats(self, data, ws):
+        # e.g. {'value': True, 'window': 1000, 'minmax': True}, {'reset': True}, or {'value': False} to stop
+        sysctrl = self.camera_server.sysctrl
+        if data.get('reset', False) and sysctrl.pixel_stats is not None:
+            sysctrl.pixel_stats.reset()
+            return
+        if not data.get('value', True):
+            sysctrl.stop_pixel_stats()
+            logging.info("Pixel statistics stopped")
+            return
+        window = data.get('window')
+        try:
+            sysctrl.start_pixel_stats(window=int(window) if window else None,
+                                      minmax=data.get('minmax', False), roi=data.get('roi'))
+        except ValueError as e:
+            await self.camera_server.send_str(ws, json.dumps({'pixel_stats_response': {'error': str(e)}}))
+
+    async def handle_pixel_stats_request(self, data, ws):
+        # e.g. {'map': 'variance'}
+        name = data.get('map', 'mean')
+        try:
+            blob = self.camera_server.pixel_map_npy(name)
+        except ValueError as e:
+            await self.camera_server.send_str(ws, json.dumps({'pixel_stats_response': {'error': str(e)}}))
+            return
+        await self.camera_server.send_str_and_bytes(ws, json.dumps({
+            'pixel_stats_response': {'format': 'npy', 'map': name}}), blob)
+
+    async def handle_pipeline(self, data, ws):
+        # e.g. {'value': True, 'stages': [{'name': 'gaussian_blur', 'sigma': 1.5}], 'workers': 4}, or {'value': False}
+        sysctrl = self.camera_server.sysctrl
+        if not data.get('value', True):
+            sysctrl.stop_pipeline()
+            logging.info("Frame pipeline stopped")
+            return
+        try:
+            stages = []
+            for params in data.get('stages', []):
+                params = dict(params)
+                name = params.pop('name')
+                stages.append((name, make_stage(name, **params)))
+            workers = data.get('workers')
+            max_in_flight = data.get('max_in_flight')
+            sysctrl.start_pipeline(stages, workers=int(workers) if workers else None,
+                                   max_in_flight=int(max_in_flight) if max_in_flight else None)
+        except (KeyError, TypeError, ValueError) as e:
+            await self.camera_server.send_str(ws, json.dumps({'pipeline_response': {'error': str(e)}}))
+
+    async def handle_calibration(self, data, ws):
+        # e.g. {'capture': 'dark', 'n': 32}, {'value': True, 'dark': True, 'flat': True}, {'value': False} or {'list': True}
+        sysctrl = self.camera_server.sysctrl
+        try:
+            if 'capture' in data:
+                entry = await self.camera_server.capture_calibration(data['capture'], int(data.get('n', 32)))
+                await self.camera_server.send_str(ws, json.dumps({'calibration_response': {'captured': entry}}))
+            elif 'value' in data:
+                if data['value']:
+                    sysctrl.enable_calibration(dark=data.get('dark', True), flat=data.get('flat', True))
+                else:
+                    sysctrl.disable_calibration()
+                logging.info(f"Calibration {'enabled' if data['value'] else 'disabled'}")
+            else:
+                await self.camera_server.send_str(ws, json.dumps({
+                    'calibration_response': {'calibrations': sysctrl.calibrations.entries()}}))
+        except ValueError as e:
+            await self.camera_server.send_str(ws, json.dumps({'calibration_response': {'error': str(e)}}))
+
+    async def handle_subframe_multiplex(self, data, ws):
+        enabled = data.get('value', False)
+        try:
+            self.camera_server.sysctrl.set_multiplex(enabled)
+        except RuntimeError as e:
+            logging.error(str(e))
+            await self.camera_server.send_str(ws, json.dumps({'subframe_response': {'error': str(e)}}))
+            return
+        demultiplexer = self.camera_server.demultiplexer
+        demultiplexer.reset()
+        if enabled and not demultiplexer.running:
+            demultiplexer.start()
+        elif not enabled:
+            demultiplexer.stop()
+        logging.info(f"Sub-frame multiplexing {'enabled' if enabled else 'disabled'}")
+
+    async def handle_stream_subframes(self, data, ws):
+        self.camera_server.active_connections[ws]['stream_subframes'] = data.get('value', True)
+        logging.info(f"Sub-frame streaming {'enabled' if self.camera_server.active_connections[ws]['stream_subframes'] else 'disabled'} for {ws}")
+
+    async def handle_slm_field_patterns(self, data, ws):
+        # Three base64 encoded 8 bit patterns, one per colour field
+        patterns = {}
+        for field in ('blue', 'green', 'red'):
+            if data.get(field):
+                patterns[field] = Image.open(BytesIO(base64.b64decode(data[field])))
+        img = pack_field_patterns(**patterns)
+        logging.info(f"SLM field patterns {list(patterns)} packed into {img.size} image")
+        self.camera_server.display.display_image(img)
+
     async def handle_illumination_mode(self, data, ws):
         mode = data.get('value', '777')  # Default to '777' (all LEDs on for all fields)
         
@@ -158,16 +423,36 @@ class MessageHandler:
             self.camera_server.sysctrl.config.ILLUMINATION_MODE = '421'
             self.camera_server.sysctrl.update_wave()
 
+def make_camera_controller(camera='picamera2', **kwargs):
+    # Backends are imported on demand so hosts without picamera2/libcamera
+    # can still run the synthetic camera
+    if camera == 'picamera2':
+        from camera.captures.picamera2 import Picamera2Controller
+        return Picamera2Controller(device_id=0, controls={})
+    elif camera == 'synthetic':
+        from camera.captures.synthetic import SyntheticCameraController
+        return SyntheticCameraController(**kwargs)
+    elif camera == 'replay':
+        from camera.captures.replay import ReplayCameraController
+        return ReplayCameraController(**kwargs)
+    else:
+        raise ValueError(f"Unknown camera '{camera}'. Choose one of 'picamera2', 'synthetic' or 'replay'.")
+
 class CameraServer:
-    def __init__(self):
-        self.camctrl = Picamera2Controller(device_id=0, controls={})
-        self.sysctrl = SystemController(camera_controller=self.camctrl)
+    def __init__(self, pigpio_host="localhost", pigpio_port=8888, camera='picamera2', camera_options={},
+                 calibration_path='calibration'):
+        self.camctrl = make_camera_controller(camera, **camera_options)
+        self.sysctrl = SystemController(camera_controller=self.camctrl,
+                                        pigpio_host=pigpio_host, pigpio_port=pigpio_port,
+                                        calibration_path=calibration_path)
         self.sysctrl.set_cam_triggered()
         self.control_descriptors = self.generate_control_descriptors(self.camctrl.get_control_descriptors())
         
         self.persistent_metadata = {
             'frame_number': 0,
         }
+        self.history = MetadataHistory()
+        self.history.start(self.camctrl.frame_ring, self.sysctrl.config)
 
         self.active_connections = {}
         self.message_queues = defaultdict(lambda: BoundedQueue(3))
@@ -176,6 +461,9 @@ class CameraServer:
         self.jpeg_quality = 75
 
         self.message_handler = MessageHandler(self) # Initialize the message handler
+        self.demultiplexer = SubframeDemultiplexer(self.camctrl.frame_ring, self.sysctrl.config)
+        self.subframes_sent = 0
+        self.accumulated_sent = 0
 
         try:
             self.initialize_display()
@@ -185,6 +473,8 @@ class CameraServer:
 
     def shutdown(self):
         # self.camctrl.shutdown()
+        self.history.stop()
+        self.demultiplexer.stop()
         self.sysctrl.shutdown()
 
     async def handle_ws(self, request):
@@ -193,7 +483,8 @@ class CameraServer:
         self.active_connections[ws] = {
             'stream_frames': False,
             "use_base64_encoding" : False,
-            'send_fps_updates': False
+            'send_fps_updates': False,
+            'frame_encoding': 'native',
         }
         logging.debug(f"WebSocket connection established: {ws}")
 
@@ -287,12 +578,17 @@ class CameraServer:
 
     async def on_startup(self, app):
         app.router.add_get('/controls', self.handle_controls_endpoint)
+        app.router.add_get('/history', self.handle_history_endpoint)
+        app.router.add_get('/burst', self.handle_burst_endpoint)
+        app.router.add_get('/pixel_stats', self.handle_pixel_stats_endpoint)
+        app.router.add_get('/frame', self.handle_frame_endpoint)
         app['task'] = asyncio.create_task(self.periodic_task())
 
     async def periodic_task(self):
         while True:
             try:
                 await self.send_captured_image()
+                await self.send_accumulated()
                 await self.send_fps_update()
                 await asyncio.sleep(0.001)
             except Exception as e:
@@ -347,6 +643,91 @@ class CameraServer:
         # control_descriptors = self.generate_control_descriptors(self.camctrl.get_control_descriptors())
         return web.json_response(self.control_descriptors)
 
+    async def handle_history_endpoint(self, request):
+        # /history?columns=sensor_timestamp,led_delay&start=...&stop=...&by=sensor_timestamp
+        query = request.query
+        columns = query['columns'].split(',') if 'columns' in query else None
+        try:
+            start = int(query['start']) if 'start' in query else None
+            stop = int(query['stop']) if 'stop' in query else None
+            blob = self.history.query_npy(columns, start, stop, query.get('by', 'frame_number'))
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        return web.Response(body=blob, content_type='application/octet-stream')
+
+    async def set_roi(self, roi=None):
+        # Reconfiguring the camera blocks until its streams restart, so it runs off the event loop
+        loop = asyncio.get_running_loop()
+        geometry, stopped = await loop.run_in_executor(None, self.sysctrl.set_roi, roi)
+        # Sub-frame fields of the old geometry can't be combined with the new one
+        self.demultiplexer.reset()
+        await self.broadcast_to_active_connections(self.send_str, json.dumps({
+            'sensor_roi': {**geometry, 'stopped': stopped}}))
+
+    async def capture_calibration(self, kind, n):
+        # Averaging waits for frames, so it runs off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.sysctrl.capture_calibration, kind, n)
+
+    async def capture_burst(self, n, after_seq=None, roi=None):
+        # The burst waits for frames, so it runs off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.sysctrl.capture_burst, n, after_seq, roi)
+
+    async def handle_burst_endpoint(self, request):
+        # /burst?n=32&after_seq=1234&roi=x,y,width,height
+        query = request.query
+        try:
+            n = int(query.get('n', 16))
+            after_seq = int(query['after_seq']) if 'after_seq' in query else None
+            roi = [int(v) for v in query['roi'].split(',')] if 'roi' in query else None
+            burst = await self.capture_burst(n, after_seq, roi)
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        summary = burst.summary()
+        return web.Response(body=burst.to_npz(), content_type='application/octet-stream', headers={
+            'X-Burst-First-Seq': str(summary['first_seq']),
+            'X-Burst-Last-Seq': str(summary['last_seq']),
+            'X-Burst-Gaps': json.dumps(summary['gaps']),
+        })
+
+    def pixel_map_npy(self, name):
+        pixel_stats = self.sysctrl.pixel_stats
+        if pixel_stats is None:
+            raise ValueError("Pixel statistics are not running")
+        image = pixel_stats.map(name)
+        if image is None:
+            raise ValueError("No frames in the statistics yet")
+        return npy_bytes(image)
+
+    async def handle_pixel_stats_endpoint(self, request):
+        # /pixel_stats?map=variance
+        try:
+            blob = self.pixel_map_npy(request.query.get('map', 'mean'))
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        return web.Response(body=blob, content_type='application/octet-stream')
+
+    async def handle_frame_endpoint(self, request):
+        # /frame?factor=4&mode=sum&roi=x,y,width,height: the latest frame's luma as .npy, optionally binned
+        query = request.query
+        latest = self.camctrl.frame_ring.latest()
+        if latest is None:
+            raise web.HTTPServiceUnavailable(text="No frame captured yet")
+        seq, frame = latest
+        try:
+            binning = parse_binning({
+                'factor': query.get('factor', 1),
+                'mode': query.get('mode', 'mean'),
+                'roi': query['roi'].split(',') if 'roi' in query else None})
+            img = frame.to_grayscale()
+            if binning is not None:
+                img = bin_image(img, *binning)
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        return web.Response(body=npy_bytes(img), content_type='application/octet-stream',
+                            headers={'X-Frame-Seq': str(seq)})
+
     def initialize_display(self):
         # Initialize display and script/wave-related components
         self.display = Display()
@@ -378,11 +759,52 @@ class CameraServer:
 
     def image_to_blob(self, img, quality):
         encodedImage = BytesIO()
-        img = ImageOps.grayscale(Image.fromarray(img))
+        img = Image.fromarray(img)
+        if img.mode != 'L':
+            img = ImageOps.grayscale(img)
         img.save(encodedImage, 'JPEG', quality=quality)
         encodedImage.seek(0)
         return encodedImage.read()
 
+    def frame_to_blob(self, frame, encoding='native', binning=None):
+        """
+        Returns (blob, description) for `frame` in one of FRAME_ENCODINGS,
+        binned if `binning` = (factor, mode, roi) is given.
+        """
+        if encoding == 'native' and binning is None and frame.format in COMPRESSED_FORMATS:
+            # Pass-through: the camera's JPEG is sent without being decoded or encoded
+            return frame.to_bytes(), {'encoding': 'jpeg'}
+        img = frame.to_grayscale()
+        description = {}
+        if binning is not None:
+            factor, mode, roi = binning
+            if encoding != 'raw':
+                # Sums don't fit in a JPEG
+                mode = 'mean'
+            img = bin_image(img, factor, mode, roi)
+            description['binning'] = {'factor': factor, 'mode': mode, 'roi': roi}
+        if encoding == 'raw':
+            height, width = img.shape
+            return np.ascontiguousarray(img).tobytes(), {
+                'encoding': 'raw', 'width': width, 'height': height, 'dtype': img.dtype.str, **description}
+        return self.image_to_blob(img, self.jpeg_quality), {'encoding': 'jpeg', **description}
+
+    def frame_blobs(self, frame):
+        """
+        Memoised frame_to_blob(): each encoding of `frame` is produced at
+        most once, and only if some subscriber asks for it.
+        """
+        blobs = {}
+        def blob(encoding, binning=None):
+            if encoding == 'native' and (binning is not None or frame.format not in COMPRESSED_FORMATS):
+                # Uncompressed or binned frames are sent natively as JPEG; share that encode
+                encoding = 'jpeg'
+            key = (encoding, binning)
+            if key not in blobs:
+                blobs[key] = self.frame_to_blob(frame, encoding, binning)
+            return blobs[key]
+        return blob
+
     async def send_captured_image(self):
         frame = self.sysctrl.capture_frame()
         if frame is not None:
@@ -394,7 +816,7 @@ class CameraServer:
                 self.sysctrl.update_wave()
             # XXX end section to be factored out
 
-            img_bin = frame.to_bytes()
+            blob = self.frame_blobs(frame)
             current_frame_metadata = frame.metadata
 
             # Update the frame number and any other relevant fields
@@ -407,6 +829,7 @@ class CameraServer:
             # Loop through each connection and check if stream_frames is True
             for ws, prefs in self.active_connections.copy().items():
                 if prefs.get('stream_frames', True):
+                    img_bin, encoding = blob(prefs.get('frame_encoding', 'native'), prefs.get('binning'))
                     if prefs.get('use_base64_encoding', False):
                         # Convert the image to base64
                         img_base64 = base64.b64encode(img_bin).decode('utf-8')
@@ -415,15 +838,59 @@ class CameraServer:
                             'image_response': {
                                 'image': 'here',
                                 'metadata': self.persistent_metadata,
+                                **encoding,
                                 'image_base64': img_base64}}))
                     else:
                         # Send the 'next' message followed by the image blob
                         await self.send_str_and_bytes(ws, json.dumps({
                             'image_response': {
                                 'image': 'next',
-                                'metadata': self.persistent_metadata
+                                'metadata': self.persistent_metadata,
+                                **encoding,
                             }}), img_bin)
 
+            self.sysctrl.frame_delivered(frame)
+
+            if self.sysctrl.multiplex:
+                await self.send_subframes()
+
+    async def send_accumulated(self):
+        accumulator = self.sysctrl.accumulator
+        if accumulator is None or accumulator.published == self.accumulated_sent:
+            return
+        self.accumulated_sent = accumulator.published
+        image, info = accumulator.latest
+        blob = None
+        for ws, prefs in self.active_connections.copy().items():
+            if prefs.get('stream_accumulated', False):
+                if blob is None:
+                    blob = npy_bytes(image)
+                await self.send_str_and_bytes(ws, json.dumps({
+                    'accumulator_response': {'format': 'npy', **info}}), blob)
+
+    async def send_subframes(self):
+        # Sets are assembled from the camera's FrameRing, so none is broken by frames skipped here
+        demultiplexer = self.demultiplexer
+        if demultiplexer.completed == self.subframes_sent:
+            return
+        self.subframes_sent = demultiplexer.completed
+        subframes = demultiplexer.latest
+        fields = list(subframes)
+        blobs = {field: self.frame_blobs(subframes[field]) for field in fields}
+        for ws, prefs in self.active_connections.copy().items():
+            if prefs.get('stream_subframes', False):
+                encoded = [blobs[field](prefs.get('frame_encoding', 'native'), prefs.get('binning')) for field in fields]
+                message = json.dumps({
+                    'subframe_response': {
+                        'fields': fields,
+                        'metadata': {field: subframes[field].metadata for field in fields},
+                        'encodings': [encoding for _, encoding in encoded],
+                        'completed': self.demultiplexer.completed,
+                        'discarded': self.demultiplexer.discarded,
+                    }})
+                # The JSON header is followed by one image blob per field, in 'fields' order
+                await self.message_queues[ws].put((message, *(blob for blob, _ in encoded)))
+
     async def update_led_time(self, new_value):
         await self.broadcast_to_active_connections(self.send_str, json.dumps({'LED_TIME': {'value': new_value}}))
 
@@ -440,8 +907,13 @@ class CameraServer:
             fps_data = {
                 'image_capture_reader_fps': self.sysctrl.get_reader_fps(),
                 'image_capture_capture_fps': self.sysctrl.get_capture_fps(),
-                'system_controller_fps': self.sysctrl.get_controller_fps()
+                'system_controller_fps': self.sysctrl.get_controller_fps(),
+                'capture': self.sysctrl.get_capture_stats(),
             }
+            if self.sysctrl.archive is not None:
+                fps_data['archive'] = self.sysctrl.archive.stats()
+            if self.sysctrl.pipeline is not None:
+                fps_data['pipeline'] = self.sysctrl.pipeline.stats()
             # await self.broadcast_to_active_connections(
             #     self.send_str, json.dumps({'fps_update': fps_data})
             # )